@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+'''Precomputed atlas of DRRs over a grid of poses
+
+build_atlas renders every pose of a regular grid over [rx, ry, rz, tx,
+ty, tz] into one .npy file, memory-mapped, with a JSON sidecar holding
+the grid (the pose index) and the error bound of the lookups. DRRAtlas
+then returns the DRR of any pose in the range of the grid without ray
+casting:
+
+    renderer = main_functions.DRRRenderer(..., backend='numpy')
+    build_atlas(renderer, 'knee_atlas', [range(-10, 11, 2), range(-10, 11, 2), [0], [0], [0], [0]])
+    atlas = DRRAtlas('knee_atlas')
+    drr = atlas.nearest([3.2, -1., 0, 0, 0, 0])      # A view of the file, no copy
+    drr = atlas.blend([3.2, -1., 0, 0, 0, 0])        # Multilinear blend of the neighbouring entries
+
+The error bound is measured when the atlas is built. Random poses within
+the grid are rendered and compared with both lookups. The maximum
+absolute difference and the minimum normalized cross correlation found
+are stored in the sidecar (atlas.error_bound). It is an empirical
+bound: use the atlas as a first stage filter and render the selected
+poses exactly.
+'''
+
+import json
+import numpy as np
+import similarity
+import atomic_file
+
+def get_atlas_files(file_name):
+    '''Paths of the array and the sidecar of an atlas.'''
+    base = file_name[:-4] if file_name.endswith('.npy') else file_name
+    return base + '.npy', base + '.json'
+
+def write_sidecar(header, sidecar_file_name):
+    '''Write the sidecar of an atlas, replacing the previous one atomically.'''
+    with atomic_file.open_atomic(sidecar_file_name) as sidecar:
+        json.dump(header, sidecar)
+
+class DRRAtlas(object):
+    '''Lookup of the DRRs of an atlas written by build_atlas.
+
+    Poses outside the grid are clamped to it.
+
+    Args:
+        file_name (string): Atlas file, with or without the .npy extension
+    '''
+    def __init__(self, file_name):
+        array_file_name, sidecar_file_name = get_atlas_files(file_name)
+        with open(sidecar_file_name) as sidecar:
+            self.header = json.load(sidecar)
+        self.axes = [np.asarray(values, dtype=np.float64) for values in self.header['axes']]
+        if any(np.any(np.diff(values) <= 0.) for values in self.axes):
+            raise ValueError('The values of the axes of the atlas {} must be increasing, without duplicates.'.format(file_name))
+        self.shape = tuple(len(values) for values in self.axes)
+        images = np.load(array_file_name, mmap_mode='r')
+        self.images = images.reshape(self.shape + images.shape[1:])    # Indexed [rx, ry, rz, tx, ty, tz, y, x]
+        self.error_bound = self.header.get('error_bound')
+
+    def __len__(self):
+        return int(np.prod(self.shape))
+
+    def get_poses(self):
+        '''N x 6 array of the poses of the atlas, in the order of its entries.'''
+        grid = np.meshgrid(*self.axes, indexing='ij')
+        return np.stack([values.ravel() for values in grid], axis=1)
+
+    def get_neighbours(self, pose):
+        '''Lower grid index and weight of the upper neighbour along every axis.'''
+        lower, weight = [], []
+        for values, value in zip(self.axes, pose):
+            if values.size == 1:
+                lower.append(0)
+                weight.append(0.)
+                continue
+            value = min(max(value, values[0]), values[-1])
+            index = min(np.searchsorted(values, value, side='right') - 1, values.size - 2)
+            lower.append(int(index))
+            weight.append((value - values[index]) / (values[index + 1] - values[index]))
+        return lower, weight
+
+    def nearest_index(self, pose):
+        '''Grid index of the entry nearest to pose, parameter by parameter.'''
+        lower, weight = self.get_neighbours(pose)
+        return tuple(int(index) + int(w > 0.5) for index, w in zip(lower, weight))
+
+    def nearest(self, pose):
+        '''DRR of the grid pose nearest to pose, a read-only view of the atlas.'''
+        return self.images[self.nearest_index(pose)]
+
+    def blend(self, pose):
+        '''Multilinear interpolation of the DRRs of the grid poses around pose.'''
+        lower, weight = self.get_neighbours(pose)
+        moving = [axis for axis in range(6) if weight[axis] > 0.]
+        result = np.zeros(self.images.shape[6:], dtype=np.float64)
+        for corner in range(2 ** len(moving)):
+            index = list(lower)
+            factor = 1.
+            for bit, axis in enumerate(moving):
+                if corner >> bit & 1:
+                    index[axis] += 1
+                    factor *= weight[axis]
+                else:
+                    factor *= 1. - weight[axis]
+            result += factor * self.images[tuple(index)]
+        return result
+
+    def lookup(self, pose, mode='nearest'):
+        '''DRR of pose from the atlas, mode is 'nearest' or 'blend'.'''
+        if mode == 'nearest':
+            return self.nearest(pose)
+        if mode == 'blend':
+            return self.blend(pose)
+        raise ValueError('Unknown mode "{}". Use "nearest" or "blend".'.format(mode))
+
+def measure_error(atlas, renderer, poses):
+    '''Error of the lookups of an atlas against exact renders of poses.
+
+    Returns:
+        dict:   For 'nearest' and 'blend', the maximum and RMS absolute differences and the minimum NCC
+    '''
+    exact = renderer.render_batch(poses).astype(np.float64)
+    error = {}
+    for mode in ('nearest', 'blend'):
+        approximations = np.stack([atlas.lookup(pose, mode) for pose in poses]).astype(np.float64)
+        difference = approximations - exact
+        ncc = [similarity.TargetImage(image).ncc(approximation)[0] for image, approximation in zip(exact, approximations)]
+        error[mode] = {
+            'max_abs':  float(np.abs(difference).max()),
+            'rms':      float(np.sqrt(np.mean(difference ** 2))),
+            'min_ncc':  float(np.min(ncc)),
+        }
+    return error
+
+def build_atlas(renderer, file_name, axes, chunk_size=64, validation_poses=32, seed=0, verbose=False):
+    '''Render the DRRs of a grid of poses into an atlas.
+
+    Args:
+        renderer (DRRRenderer):     Renderer of the volume and detector, see main_functions
+        file_name (string):         Atlas file, .npy is added if needed and the sidecar is .json
+        axes (list):                Six lists of values of rx, ry, rz (degrees), tx, ty, tz, sorted and de-duplicated
+        chunk_size (int):           Number of poses rendered in one batch
+        validation_poses (int):     Number of random poses rendered to measure the error bound, 0 to skip
+        seed (int):                 Seed of the validation poses
+        verbose (bool):             Print the progress
+
+    Returns:
+        DRRAtlas:                   The atlas
+    '''
+    assert len(axes) == 6, 'One list of values is needed per pose parameter'
+    axes = [sorted(set(float(value) for value in values)) for values in axes]
+    array_file_name, sidecar_file_name = get_atlas_files(file_name)
+    grid = np.meshgrid(*axes, indexing='ij')
+    poses = np.stack([values.ravel() for values in grid], axis=1)
+
+    images = None
+    for first in range(0, poses.shape[0], chunk_size):
+        batch = renderer.render_batch(poses[first:first + chunk_size])
+        if images is None:
+            images = np.lib.format.open_memmap(array_file_name, mode='w+', dtype=batch.dtype,
+                                               shape=(poses.shape[0],) + batch.shape[1:])
+        images[first:first + batch.shape[0]] = batch
+        if verbose:
+            print('Atlas: {}/{} poses rendered'.format(first + batch.shape[0], poses.shape[0]))
+    images.flush()
+    shape = images.shape[1:]
+    del images
+
+    # Written last: an atlas without sidecar is incomplete
+    header = {'axes': axes, 'image_shape': list(shape), 'error_bound': None}
+    write_sidecar(header, sidecar_file_name)
+
+    atlas = DRRAtlas(file_name)
+
+    if validation_poses:
+        random = np.random.RandomState(seed)
+        low = np.array([values[0] for values in axes])
+        high = np.array([values[-1] for values in axes])
+        samples = low + random.uniform(size=(validation_poses, 6)) * (high - low)
+        header['error_bound'] = measure_error(atlas, renderer, samples)
+        header['validation_poses'] = validation_poses
+        write_sidecar(header, sidecar_file_name)
+        atlas.error_bound = header['error_bound']
+        atlas.header = header
+    return atlas
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+'''Atomic replacement of files shared between processes
+
+Caches, catalogs, stacks and job outputs are read by other processes, or
+other nodes, while they are written. A file is written under a temporary
+name in its own directory and renamed over the destination once it is
+complete, so that a reader sees either the old or the new file, never a
+partial one:
+
+    with open_atomic('catalog.json') as catalog:
+        json.dump(entries, catalog)
+
+    with atomic_path('drr_0001.nii.gz') as temporary:
+        itk.imwrite(image, temporary)       # Same extension, so the same ImageIO
+
+The temporary file is removed if the write fails. Concurrent writers of the
+same file do not corrupt it, the last rename wins.
+'''
+
+import os
+import uuid
+import contextlib
+
+# Atomic rename over an existing file (os.rename on Python 2, where it is only atomic on POSIX)
+replace_file = getattr(os, 'replace', os.rename)
+
+def get_temporary_name(file_name):
+    '''Unique hidden name next to file_name, ending with its base name so that the extension is kept.'''
+    directory, base_name = os.path.split(os.path.abspath(file_name))
+    return os.path.join(directory, '.tmp_{}_{}'.format(uuid.uuid4().hex, base_name))
+
+@contextlib.contextmanager
+def atomic_path(file_name):
+    '''Temporary path to write file_name to, renamed over file_name when the block succeeds.'''
+    temporary = get_temporary_name(file_name)
+    try:
+        yield temporary
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    replace_file(temporary, file_name)
+
+@contextlib.contextmanager
+def open_atomic(file_name, mode='w'):
+    '''Open a temporary file to write file_name, renamed over file_name when the block succeeds.'''
+    with atomic_path(file_name) as temporary:
+        with open(temporary, mode) as output:
+            yield output
+
+def write_atomic(text, file_name):
+    '''Write text to file_name atomically.'''
+    with open_atomic(file_name) as output:
+        output.write(text)
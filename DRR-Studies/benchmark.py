@@ -0,0 +1,318 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+'''Benchmarks of the DRR, rigid transform, DICOM ingest and worker startup paths
+
+The volumes are synthetic knee-like phantoms generated locally, so the
+numbers only depend on the code and the machine. Every benchmark case runs
+in its own process so that its peak resident memory is its own. Each
+case is repeated and summarized by its mean and confidence interval
+(dicom_functions.mean_confidence_interval). The results are written as JSON
+to compare commits:
+
+    python benchmark.py --sizes 128 256 --detectors 256x350 --repeats 5 --output before.json
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from timeit import default_timer as timer
+import itk
+import numpy as np
+import dicom_functions as dfun
+import itk_helpers as Functions
+import main_functions
+import rigid_transform
+import startup
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+def make_phantom(size, spacing=0.5, pixel_type=np.float32):
+    '''Knee-like phantom: two bone cylinders with a denser cortex in a soft tissue cylinder, in air.
+
+    Args:
+        size (int):         Number of voxels along every axis
+        spacing (float):    Isotropic voxel spacing in mm
+        pixel_type:         NumPy type of the voxels
+
+    Returns:
+        itk.Image:          The phantom, in Hounsfield units shifted by +1000 (air is 0)
+    '''
+    z, y, x = np.ogrid[0:size, 0:size, 0:size]
+    x = (x - size / 2.) / size
+    y = (y - size / 2.) / size
+    z = (z - size / 2.) / size
+
+    volume = np.zeros((size, size, size), dtype=pixel_type)
+    volume[...] = np.where(x ** 2 + y ** 2 < 0.4 ** 2, 1040, 0)             # Soft tissue
+    for center, radius in ((-0.22, 0.12), (0.22, 0.10)):                    # Femur (z < 0) and tibia (z > 0)
+        bone = ((x ** 2 + y ** 2) < radius ** 2) & (np.sign(z) == np.sign(center)) & (np.abs(z) > 0.02)
+        cortex = bone & ((x ** 2 + y ** 2) > (0.7 * radius) ** 2)
+        volume[bone & ~cortex] = 1300
+        volume[cortex] = 2200
+    volume[np.abs(z).ravel() > 0.45] = 0                                         # Air above and below the knee
+
+    image = itk.image_from_array(volume)
+    image.SetSpacing([spacing] * 3)
+    image.SetOrigin([-size * spacing / 2.] * 3)
+    return image
+
+def write_dicom_phantom(image, directory):
+    '''Write a phantom as an int16 DICOM series, one file per slice.'''
+    volume = itk.array_view_from_image(image).astype(np.int16)
+    origin = np.array(image.GetOrigin())
+    spacing = np.array(image.GetSpacing())
+    SliceType = itk.Image[itk.SS, 2]
+    for index in range(volume.shape[0]):
+        image_slice = itk.image_from_array(volume[index].copy())
+        image_slice.SetSpacing(spacing[:2])
+        dictionary = image_slice.GetMetaDataDictionary()
+        dictionary['0008|0060'] = 'CT'
+        dictionary['0020|000d'] = '1.2.826.0.1.3680043.2.1125.1'
+        dictionary['0020|000e'] = '1.2.826.0.1.3680043.2.1125.1.1'
+        dictionary['0008|0018'] = '1.2.826.0.1.3680043.2.1125.1.1.{}'.format(index + 1)
+        dictionary['0020|0013'] = str(index + 1)
+        dictionary['0020|0032'] = '\\'.join('{:.6f}'.format(value) for value in origin + [0., 0., index * spacing[2]])
+        dictionary['0020|0037'] = '1\\0\\0\\0\\1\\0'
+        dictionary['0018|0050'] = '{:.6f}'.format(spacing[2])
+
+        imageIO = itk.GDCMImageIO.New()
+        imageIO.KeepOriginalUIDOn()
+        writer = itk.ImageFileWriter[SliceType].New()
+        writer.SetImageIO(imageIO)
+        writer.SetInput(image_slice)
+        writer.SetFileName(os.path.join(directory, 'slice{:05d}.dcm'.format(index)))
+        writer.Update()
+
+def get_peak_rss():
+    '''Peak resident memory of this process in MB, None if unknown.'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024.**2 if sys.platform == 'darwin' else peak / 1024.     # Bytes on macOS, kB on Linux
+
+def poses_for(number):
+    '''A fixed set of poses spread over +-20 degrees.'''
+    angles = np.linspace(-20., 20., number)
+    return [[angle, angle / 2., -angle / 4., 0., 0., 0.] for angle in angles]
+
+def bench_drr(case):
+    '''Render a batch of poses. Stages: phantom, setup (renderer), render.'''
+    stages = {}
+    start = timer()
+    image = make_phantom(case['size'])
+    stages['phantom'] = timer() - start
+
+    width, height = case['detector']
+    spacing = 0.5 * case['size'] * 1.2 / max(width, height)    # Detector covers the phantom
+    ImageType = type(image)
+    def make_renderer(image):
+        return main_functions.DRRRenderer(image, [0., 0., 1000.], [-width * spacing / 2., -height * spacing / 2., -200.],
+                                          [width, height, 1], [spacing, spacing, 1.], np.eye(3), 0., ImageType, ImageType,
+                                          backend=case['backend'])
+    make_renderer(make_phantom(8))      # Load the ITK modules outside of the timed stages
+    start = timer()
+    renderer = make_renderer(image)
+    stages['setup'] = timer() - start
+
+    poses = poses_for(case['poses'])
+    start = timer()
+    renderer.render_batch(poses)
+    stages['render'] = timer() - start
+
+    return {
+        'stages':   stages,
+        'rays_per_second':  width * height * len(poses) / stages['render'],
+        'drrs_per_second':  len(poses) / stages['render'],
+    }
+
+def bench_rigid_transform(case):
+    '''Rigid transform of a phantom, from file to file or in memory. Stages: phantom, transform.'''
+    stages = {}
+    directory = tempfile.mkdtemp(prefix='drr_benchmark_')
+    try:
+        start = timer()
+        image = make_phantom(case['size'], pixel_type=np.int16)
+        input_filename = os.path.join(directory, 'phantom.nii')
+        itk.imwrite(image, input_filename)
+        stages['phantom'] = timer() - start
+
+        start = timer()
+        if case.get('mode') == 'rigid_body_transform3D_image':
+            rigid_transform.rigid_body_transform3D_image(image, ([10., -5., 3.], [2., 1., -3.]))
+        else:
+            Functions.rigid_body_transform3D(input_filename, os.path.join(directory, 'transformed.nii'), rot=[10., -5., 3.], t=[2., 1., -3.])
+        stages['transform'] = timer() - start
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'stages':   stages,
+        'voxels_per_second':    case['size'] ** 3 / stages['transform'],
+    }
+
+def bench_dicom_ingest(case):
+    '''Read a phantom DICOM series. Stages: phantom, read.'''
+    stages = {}
+    directory = tempfile.mkdtemp(prefix='drr_benchmark_')
+    try:
+        start = timer()
+        write_dicom_phantom(make_phantom(case['size']), directory)
+        stages['phantom'] = timer() - start
+
+        start = timer()
+        if case['reader'] == 'dicom_reader':
+            dfun.dicom_reader(directory, False)
+        else:
+            dfun.read_dicom_series(directory, False)
+        stages['read'] = timer() - start
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'stages':   stages,
+        'slices_per_second':    case['size'] / stages['read'],
+    }
+
+def bench_startup(case):
+    '''Start a new worker and render its first DRR, with or without warm-up. Stages: see startup.run_startup.'''
+    result = startup.measure_startup(backend=case['backend'], warm=case['warm_up'])
+    stages = dict(('import_' + name, seconds) for name, seconds in result['import'].items())
+    stages['first_drr'] = result['first_drr']
+    stages['process'] = result['process']
+    if result['warm_up'] is not None:
+        stages['warm_up'] = result['warm_up']
+    return {'stages': stages}
+
+BENCHMARKS = {
+    'drr':          bench_drr,
+    'transform':    bench_rigid_transform,
+    'dicom':        bench_dicom_ingest,
+    'startup':      bench_startup,
+}
+
+def run_case(case):
+    '''Run one repetition of a benchmark case and add its peak memory.'''
+    result = BENCHMARKS[case['benchmark']](case)
+    result['peak_rss_mb'] = get_peak_rss()
+    return result
+
+def run_isolated(case):
+    '''Run one repetition in a new process, so that the peak memory is the one of the case.'''
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(run_case, (case,))
+    finally:
+        pool.close()
+        pool.join()
+
+def summarize(values, confidence=0.95):
+    '''Mean and confidence interval of repeated measurements.'''
+    values = [value for value in values if value is not None]
+    if len(values) == 0:
+        return None
+    if len(values) == 1:
+        return {'mean': values[0], 'low': values[0], 'high': values[0], 'n': 1}
+    mean, low, high = dfun.mean_confidence_interval(values, confidence)
+    return {'mean': float(mean), 'low': float(low), 'high': float(high), 'n': len(values)}
+
+def run_benchmark(case, repeats=5, isolate=True, confidence=0.95):
+    '''Repeat a benchmark case and summarize every metric.
+
+    Args:
+        case (dict):        Benchmark name and parameters
+        repeats (int):      Number of repetitions
+        isolate (bool):     Run every repetition in a new process
+        confidence (float): Confidence level of the intervals
+
+    Returns:
+        dict:               The case, the raw runs and the summary of every metric and stage
+    '''
+    runs = [run_isolated(case) if isolate else run_case(case) for _ in range(repeats)]
+    summary = {}
+    for metric in runs[0]:
+        if metric == 'stages':
+            for stage in runs[0]['stages']:
+                summary['stage_' + stage + '_seconds'] = summarize([run['stages'][stage] for run in runs], confidence)
+        else:
+            summary[metric] = summarize([run[metric] for run in runs], confidence)
+    return {'case': case, 'runs': runs, 'summary': summary}
+
+def get_environment():
+    '''Machine, versions and commit the benchmarks ran on.'''
+    try:
+        with open(os.devnull, 'w') as devnull:
+            commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                             stderr=devnull).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit':       commit,
+        'date':         time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform':     platform.platform(),
+        'python':       platform.python_version(),
+        'itk':          itk.Version.GetITKVersion(),
+        'numpy':        np.__version__,
+        'cpu_count':    multiprocessing.cpu_count(),
+    }
+
+def make_cases(benchmarks, sizes, detectors, backends, poses):
+    '''List the cases of the requested benchmarks.'''
+    cases = []
+    for size in sizes:
+        if 'drr' in benchmarks:
+            for detector in detectors:
+                for backend in backends:
+                    cases.append({'benchmark': 'drr', 'size': size, 'detector': detector, 'backend': backend, 'poses': poses})
+        if 'transform' in benchmarks:
+            for mode in ('rigid_body_transform3D', 'rigid_body_transform3D_image'):
+                cases.append({'benchmark': 'transform', 'size': size, 'mode': mode})
+        if 'startup' in benchmarks and size == sizes[0]:     # Independent of the size
+            for backend in backends:
+                for warm_up in (False, True):
+                    cases.append({'benchmark': 'startup', 'backend': backend, 'warm_up': warm_up})
+        if 'dicom' in benchmarks:
+            for reader in ('dicom_reader', 'read_dicom_series'):
+                cases.append({'benchmark': 'dicom', 'size': size, 'reader': reader})
+    return cases
+
+def parse_detector(text):
+    '''Parse a detector size written WIDTHxHEIGHT.'''
+    width, height = text.lower().split('x')
+    return [int(width), int(height)]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the DRR, rigid transform, DICOM ingest and worker startup paths.')
+    parser.add_argument('--benchmarks', nargs='+', default=sorted(BENCHMARKS), choices=sorted(BENCHMARKS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[128, 256, 512], help='Phantom sizes (voxels per axis)')
+    parser.add_argument('--detectors', nargs='+', type=parse_detector, default=[[256, 350], [1024, 1400]], help='Detector sizes, WIDTHxHEIGHT')
+    parser.add_argument('--backends', nargs='+', default=['itk', 'numpy'], choices=['itk', 'numpy'])
+    parser.add_argument('--poses', type=int, default=10, help='Poses rendered per DRR repetition')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--no-isolate', dest='isolate', action='store_false', help='Run the repetitions in this process')
+    parser.add_argument('--output', default='benchmark.json', help='JSON results file')
+    args = parser.parse_args(argv)
+
+    results = {'environment': get_environment(), 'results': []}
+    for case in make_cases(args.benchmarks, args.sizes, args.detectors, args.backends, args.poses):
+        print('Benchmark {}'.format(json.dumps(case, sort_keys=True)))
+        result = run_benchmark(case, args.repeats, args.isolate, args.confidence)
+        for metric, value in sorted(result['summary'].items()):
+            if value is not None:
+                print('  {: <28} {:.4g} [{:.4g}, {:.4g}]'.format(metric, value['mean'], value['low'], value['high']))
+        results['results'].append(result)
+
+        with open(args.output, 'w') as output:   # Rewritten after every case, to keep partial results
+            json.dump(results, output, indent=2, sort_keys=True)
+    print('Results written to {}'.format(args.output))
+
+if __name__ == '__main__':
+    main()
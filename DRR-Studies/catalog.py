@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+'''Catalog of the headers of a collection of volumes
+
+Planning a batch job over hundreds of CTs needs their pixel types and
+geometries, and reading every header on shared storage, once per job or
+per call of read_image, is slow. VolumeCatalog scans directories once,
+reads every header with a single ImageIO (read_image.get_image_header)
+and keeps them in a JSON index:
+
+    catalog = VolumeCatalog('volumes.catalog.json')
+    catalog.scan('/data/ct')                            # Only reads new or changed files
+    knees = catalog.find('*knee*', max_spacing=0.5)     # Largest spacing below 0.5 mm
+    ImageType = catalog.get_itk_image_type(knees[0])    # No file access
+
+A file is read again only when its size or modification time changed,
+and files which disappeared are dropped, so refresh() is cheap on an
+unchanged collection. The content hash (SHA-1 of the file) identifies
+the same volume under several names (see duplicates). It is optional
+and the choice is saved with the catalog. Files that no itk.ImageIO can
+read are kept with a None header, and files whose header or content
+cannot be read (corrupt, truncated, unreadable) also with the error (see
+errors), so they are not read again until they change. DICOM series are
+not cataloged.
+
+The catalog can also be used from the command line:
+
+    python catalog.py volumes.catalog.json scan /data/ct
+    python catalog.py volumes.catalog.json find --pattern "*knee*" --max-spacing 0.5
+'''
+
+import os
+import json
+import fnmatch
+import hashlib
+import argparse
+import read_image
+import atomic_file
+
+# Increase when the entries change, older catalogs are then rebuilt
+CATALOG_VERSION = 1
+
+# Files cataloged by default, the data files of split formats (.raw, .img) are read through their headers
+DEFAULT_PATTERNS = ('*.nii', '*.nii.gz', '*.nrrd', '*.nhdr', '*.mha', '*.mhd', '*.hdr')
+
+def get_file_hash(file_name, block_size=1 << 20):
+    '''SHA-1 of the content of a file, read in blocks.'''
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as input_file:
+        block = input_file.read(block_size)
+        while block:
+            sha.update(block)
+            block = input_file.read(block_size)
+    return sha.hexdigest()
+
+class VolumeCatalog(object):
+    '''Persistent index of the headers of the volumes of some directories.
+
+    Args:
+        file_name (string):     JSON file of the catalog, created by the first save
+        content_hash (bool):    Hash the content of new and changed files (reads them once). None keeps
+                                the choice saved in an existing catalog, and hashes for a new one.
+    '''
+    def __init__(self, file_name, content_hash=None):
+        self.file_name = file_name
+        self.directories = {}
+        self.entries = {}
+        saved_content_hash = True
+        if os.path.exists(file_name):
+            with open(file_name) as catalog:
+                data = json.load(catalog)
+            if data.get('version') == CATALOG_VERSION:
+                self.directories = data['directories']
+                self.entries = data['entries']
+                saved_content_hash = data.get('content_hash', True)
+        self.content_hash = saved_content_hash if content_hash is None else content_hash
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, file_name):
+        return os.path.abspath(file_name) in self.entries
+
+    def save(self):
+        '''Write the catalog file, replacing the previous one atomically.'''
+        with atomic_file.open_atomic(self.file_name) as catalog:
+            json.dump({'version': CATALOG_VERSION, 'content_hash': self.content_hash, 'directories': self.directories,
+                       'entries': self.entries}, catalog)
+
+    def scan(self, directory, patterns=DEFAULT_PATTERNS, recursive=True, save=True):
+        '''Add the volumes of a directory, reading only the new and changed files.
+
+        Args:
+            directory (string):     Directory of the volumes
+            patterns (list):        Shell patterns of the file names cataloged
+            recursive (bool):       Also scan the subdirectories
+            save (bool):            Save the catalog afterwards
+
+        Returns:
+            dict:                   Number of 'added', 'updated', 'removed' and 'unchanged' files,
+                                    and of files which could not be read ('errors')
+        '''
+        directory = os.path.abspath(directory)
+        self.directories[directory] = {'patterns': list(patterns), 'recursive': recursive}
+        counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0, 'errors': 0}
+
+        found = set()
+        for root, subdirectories, files in os.walk(directory):
+            if not recursive:
+                del subdirectories[:]
+            for name in files:
+                if not any(fnmatch.fnmatch(name.lower(), pattern) for pattern in patterns):
+                    continue
+                file_name = os.path.join(root, name)
+                found.add(file_name)
+                status = self.update_entry(file_name)
+                counts[status] += 1
+                if file_name in self.entries and self.entries[file_name].get('error') is not None:
+                    counts['errors'] += 1
+
+        # Drop the files of this directory which disappeared
+        prefix = os.path.join(directory, '')
+        for file_name in list(self.entries):
+            if file_name.startswith(prefix) and file_name not in found and not self.is_scanned_elsewhere(file_name, directory):
+                del self.entries[file_name]
+                counts['removed'] += 1
+
+        if save:
+            self.save()
+        return counts
+
+    def is_scanned_elsewhere(self, file_name, directory):
+        '''Whether file_name still exists and is under another scanned directory.'''
+        return os.path.exists(file_name) and any(file_name.startswith(os.path.join(other, '')) for other in self.directories if other != directory)
+
+    def update_entry(self, file_name):
+        '''Read the header of file_name if it is new or changed. Returns 'added', 'updated', 'unchanged' or 'removed'.'''
+        entry = self.entries.get(file_name)
+        try:
+            stat = os.stat(file_name)
+        except OSError:             # Removed since it was listed
+            self.entries.pop(file_name, None)
+            return 'unchanged' if entry is None else 'removed'
+        if entry is not None and entry['mtime'] == stat.st_mtime and entry['file_size'] == stat.st_size:
+            return 'unchanged'
+        header = file_hash = error = None
+        try:
+            header = read_image.get_image_header(file_name)
+            file_hash = get_file_hash(file_name) if self.content_hash else None
+        except (RuntimeError, EnvironmentError, ValueError, KeyError) as exception:
+            # ITK exceptions of a corrupt or truncated header, unreadable file: cataloged as an error
+            header = file_hash = None
+            error = '{}: {}'.format(type(exception).__name__, str(exception).strip())
+        self.entries[file_name] = {
+            'mtime':        stat.st_mtime,
+            'file_size':    stat.st_size,
+            'header':       header,
+            'hash':         file_hash,
+            'error':        error,
+        }
+        return 'added' if entry is None else 'updated'
+
+    def refresh(self, save=True):
+        '''Scan again every directory of the catalog.
+
+        Returns:
+            dict:   Number of 'added', 'updated', 'removed', 'unchanged' and 'errors' files
+        '''
+        counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0, 'errors': 0}
+        for directory, options in sorted(self.directories.items()):
+            if not os.path.isdir(directory):
+                continue
+            for status, count in self.scan(directory, options['patterns'], options['recursive'], save=False).items():
+                counts[status] += count
+        if save:
+            self.save()
+        return counts
+
+    def errors(self):
+        '''Cataloged files whose header or content could not be read, with the error.'''
+        return dict((file_name, entry['error']) for file_name, entry in self.entries.items() if entry.get('error') is not None)
+
+    def get_header(self, file_name):
+        '''Header of a cataloged file, see read_image.get_image_header. Raises KeyError if it is not cataloged.'''
+        return self.entries[os.path.abspath(file_name)]['header']
+
+    def get_itk_image_type(self, file_name):
+        '''ITK image type of a cataloged file, as read_image.get_itk_image_type, without reading the file.'''
+        header = self.get_header(file_name)
+        return None if header is None else read_image.get_itk_image_type(file_name, header=header)
+
+    def get_itk_homogeneous_coordinate_matrix(self, file_name):
+        '''Homogeneous coordinates matrix of a cataloged file, as read_image.get_itk_homogeneous_coordinate_matrix, without reading the file.'''
+        header = self.get_header(file_name)
+        return None if header is None else read_image.get_itk_homogeneous_coordinate_matrix(file_name, header=header)
+
+    def find(self, pattern=None, pixel_type=None, dimensions=None, min_spacing=None, max_spacing=None,
+             min_size=None, max_size=None, where=None):
+        '''Cataloged volumes matching every given condition.
+
+        Args:
+            pattern (string):       Shell pattern matched against the path, case insensitive (e.g. '*knee*')
+            pixel_type (string):    ImageIO component type (e.g. 'float', 'short')
+            dimensions (int):       Number of dimensions
+            min_spacing (float):    Smallest spacing at least min_spacing
+            max_spacing (float):    Largest spacing below max_spacing
+            min_size (list):        Size at least min_size along every axis
+            max_size (list):        Size at most max_size along every axis
+            where (function):       Called with the path and the entry, kept if it returns True
+
+        Returns:
+            list:                   Sorted paths of the matching volumes
+        '''
+        matches = []
+        for file_name, entry in self.entries.items():
+            header = entry['header']
+            if header is None:
+                continue
+            if pattern is not None and not fnmatch.fnmatch(file_name.lower(), pattern.lower()):
+                continue
+            if pixel_type is not None and header['pixel_type'] != pixel_type:
+                continue
+            if dimensions is not None and header['dimensions'] != dimensions:
+                continue
+            if min_spacing is not None and min(header['spacing']) < min_spacing:
+                continue
+            if max_spacing is not None and max(header['spacing']) >= max_spacing:
+                continue
+            if min_size is not None and any(size < minimum for size, minimum in zip(header['size'], min_size)):
+                continue
+            if max_size is not None and any(size > maximum for size, maximum in zip(header['size'], max_size)):
+                continue
+            if where is not None and not where(file_name, entry):
+                continue
+            matches.append(file_name)
+        return sorted(matches)
+
+    def duplicates(self):
+        '''Groups of cataloged files with the same content hash.'''
+        groups = {}
+        for file_name, entry in self.entries.items():
+            if entry['hash'] is not None:
+                groups.setdefault(entry['hash'], []).append(file_name)
+        return sorted(sorted(group) for group in groups.values() if len(group) > 1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Catalog the headers of a collection of volumes.')
+    parser.add_argument('catalog', help='JSON file of the catalog')
+    commands = parser.add_subparsers(dest='command')
+    scan = commands.add_parser('scan', help='Add the volumes of directories, reading only new and changed files')
+    scan.add_argument('directories', nargs='+')
+    scan.add_argument('--patterns', nargs='+', default=list(DEFAULT_PATTERNS))
+    scan.add_argument('--hash', dest='content_hash', action='store_const', const=True, help='Hash the content of the files (default of a new catalog)')
+    scan.add_argument('--no-hash', dest='content_hash', action='store_const', const=False, help='Do not hash the content of the files')
+    commands.add_parser('refresh', help='Scan again the directories of the catalog')
+    find = commands.add_parser('find', help='List the volumes matching conditions')
+    find.add_argument('--pattern')
+    find.add_argument('--pixel-type')
+    find.add_argument('--dimensions', type=int)
+    find.add_argument('--min-spacing', type=float)
+    find.add_argument('--max-spacing', type=float)
+    args = parser.parse_args(argv)
+
+    if args.command == 'scan':
+        catalog = VolumeCatalog(args.catalog, args.content_hash)
+        for directory in args.directories:
+            print('{}: {}'.format(directory, catalog.scan(directory, args.patterns)))
+        for file_name, error in sorted(catalog.errors().items()):
+            print('Could not read {}: {}'.format(file_name, error))
+    elif args.command == 'refresh':
+        print(VolumeCatalog(args.catalog).refresh())
+    elif args.command == 'find':
+        for file_name in VolumeCatalog(args.catalog).find(args.pattern, args.pixel_type, args.dimensions, args.min_spacing, args.max_spacing):
+            print(file_name)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -12,11 +12,12 @@ import os
 import sys
 from read_image import get_itk_image_type
 import numpy as np
-import scipy as sp
-import scipy.stats
+import threading
+from multiprocessing.pool import ThreadPool
 #%%
 
-def dicom_reader(input_dicom_directory,verbose):
+def dicom_reader(input_dicom_directory,verbose,pixel_type=itk.F):
+    # pixel_type : itk.F by default, itk.SS to read a CT series in half the memory (rescale slope and intercept applied).
     #%%
     # Check that the input exists
     if not os.path.isdir(input_dicom_directory):
@@ -40,7 +41,7 @@ def dicom_reader(input_dicom_directory,verbose):
     # Determine pixel type and read in stack
     print('Reading DICOM files into a stack')
     # image_type = get_itk_image_type(input_file_names[0]) # it seems that the dicom reader doesn't work with the double data type. perhaps due to the large data size. Float, and short seemed to lead to the same resutls so short was selected.
-    image_type = itk.Image[itk.F,3]
+    image_type = itk.Image[pixel_type,3]
     #%%
     ReaderType = itk.ImageSeriesReader[image_type]
     reader = ReaderType.New()
@@ -59,18 +60,126 @@ def dicom_reader(input_dicom_directory,verbose):
     if verbose:
         print("Read image information are as follows:\n")
         print(reader.GetOutput())
-    itk.imwrite(reader.GetOutput(),'/Volumes/Storage/Payam/Desktop/bob.nii')
 #%%
     return reader
 #%%
-def dicom_writer(image,output_file_name,force):
-    # Check if the output exists, prompt to overwrite
-    if not force:
-        if os.path.exists(output_file_name):
-            answer = input('Output file \"{outputImage}\" exists. Overwrite? [Y/n] '.format(outputImage=output_file_name))
-            if str(answer).lower() not in set(['yes','y', 'ye', '']):
-                os.sys.exit('Will not overwrite \"{inputFile}\". Exiting...'.
-                format(inputFile=output_file_name))
+# Integer types of the stored values of a series, see read_dicom_series
+STORED_DTYPES = {itk.SS: np.int16, itk.US: np.uint16}
+
+def get_dicom_series(input_dicom_directory,verbose=False):
+    # Series UID and sorted file names of the DICOM series in a directory.
+    if not os.path.isdir(input_dicom_directory):
+        os.sys.exit('Input \"{}\" is not a directory. Exiting...'.format(input_dicom_directory))
+
+    names_generator = itk.GDCMSeriesFileNames.New()
+    names_generator.SetInputDirectory(str(input_dicom_directory))
+    names_generator.SetGlobalWarningDisplay(False)
+    names_generator.SetUseSeriesDetails(True)
+    input_file_names = names_generator.GetInputFileNames()
+    series_uids = names_generator.GetSeriesUIDs()
+    if len(input_file_names) == 0:
+        os.sys.exit('No DICOM series found in \"{}\". Exiting...'.format(input_dicom_directory))
+    if verbose:
+        print('  Found {} files of series {}'.format(len(input_file_names),series_uids[0]))
+    return series_uids[0], list(input_file_names)
+
+def read_dicom_series(input_dicom_directory,verbose=False,pixel_type=itk.F,threads=None,progress=None,stored_values=False):
+    # Read a DICOM series decoding the slices in parallel.
+    # The slices are decoded by a pool of threads and copied into one preallocated volume.
+    # pixel_type    : itk.F like dicom_reader, or itk.SS to keep the int16 values of CT (rescale slope and intercept applied).
+    # threads       : number of decoding threads, defaults to the number of cores.
+    # progress      : called as progress(slices_read, number_of_slices), defaults to printing when verbose.
+    # stored_values : keep the values stored in the files in a volume of pixel_type (itk.SS or itk.US) and set the rescale_slope
+    #                 and rescale_intercept attributes of the image instead, for series whose rescaled values do not fit pixel_type.
+    #                 DRRRenderer applies them on the fly. The slope and intercept must be the same for all the slices.
+    if stored_values and pixel_type not in STORED_DTYPES:
+        raise ValueError('The stored values are kept as itk.SS or itk.US, not {}.'.format(pixel_type))
+    series_uid, input_file_names = get_dicom_series(input_dicom_directory,verbose)
+    number_of_slices = len(input_file_names)
+
+    ReadPixelType = itk.F if stored_values else pixel_type      # GDCMImageIO always rescales, the stored values are recovered from floats
+    ImageType = itk.Image[ReadPixelType,3]
+    first_slice = itk.imread(str(input_file_names[0]),ReadPixelType)
+    slice_array = itk.array_view_from_image(first_slice)
+    dtype = STORED_DTYPES[pixel_type] if stored_values else slice_array.dtype
+    volume = np.empty((number_of_slices,)+slice_array.shape[-2:],dtype=dtype)   # Preallocated volume [z,y,x]
+    origins = np.zeros((number_of_slices,3))
+    rescales = np.zeros((number_of_slices,2))
+
+    readers = threading.local()     # One reader per thread, reused for all its slices
+    def read_slice(index):
+        if not hasattr(readers,'reader'):
+            readers.reader = itk.ImageFileReader[ImageType].New()
+            readers.dicomIO = itk.GDCMImageIO.New()
+            readers.reader.SetImageIO(readers.dicomIO)
+        readers.reader.SetFileName(str(input_file_names[index]))
+        readers.reader.Update()
+        image = readers.reader.GetOutput()
+        slice_array = itk.array_view_from_image(image).reshape(volume.shape[1:])
+        if stored_values:
+            rescales[index] = readers.dicomIO.GetRescaleSlope(), readers.dicomIO.GetRescaleIntercept()
+            slice_array = np.rint((slice_array-rescales[index,1])/rescales[index,0])
+        volume[index] = slice_array
+        origins[index] = image.GetOrigin()
+        return index
+
+    def print_progress(done,total):
+        if done % max(1,total//10) == 0 or done == total:
+            print('  Read {}/{} slices'.format(done,total))
+    if progress is None and verbose:
+        progress = print_progress
+
+    print('Reading {} DICOM files with {} threads'.format(number_of_slices,threads if threads else 'all'))
+    pool = ThreadPool(threads)
+    try:
+        for done, _ in enumerate(pool.imap_unordered(read_slice,range(number_of_slices)),1):
+            if progress is not None:
+                progress(done,number_of_slices)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Geometry of the volume from the first slice, slice spacing from the slice positions like ImageSeriesReader
+    spacing = list(first_slice.GetSpacing())
+    if number_of_slices > 1:
+        spacing[2] = np.linalg.norm(origins[-1]-origins[0])/(number_of_slices-1)
+    image = itk.image_view_from_array(volume)
+    image.SetOrigin(first_slice.GetOrigin())
+    image.SetSpacing(spacing)
+    image.SetDirection(first_slice.GetDirection())
+    image.shared_array = volume     # Keep the buffer alive with the image
+    image.series_uid = series_uid
+    if stored_values:
+        if not np.allclose(rescales,rescales[0]):
+            raise ValueError('The rescale slope and intercept of the series {} change between slices.'.format(series_uid))
+        image.rescale_slope, image.rescale_intercept = float(rescales[0,0]), float(rescales[0,1])
+    print("Image Read Successfully")
+    return image
+#%%
+def check_output_file(output_file_name,overwrite='prompt'):
+    # Apply the overwrite policy to an output file. Returns True if the file should be written.
+    # overwrite : 'prompt' asks on the terminal, 'overwrite' replaces the file, 'skip' keeps the existing file and 'error' raises an IOError.
+    if overwrite not in ('prompt','overwrite','skip','error'):
+        raise ValueError('Unknown overwrite policy "{}". Use "prompt", "overwrite", "skip" or "error".'.format(overwrite))
+    if overwrite == 'overwrite' or not os.path.exists(output_file_name):
+        return True
+    if overwrite == 'skip':
+        print('Output file \"{}\" exists. Skipping.'.format(output_file_name))
+        return False
+    if overwrite == 'error':
+        raise IOError('Output file \"{}\" exists.'.format(output_file_name))
+    answer = input('Output file \"{outputImage}\" exists. Overwrite? [Y/n] '.format(outputImage=output_file_name))
+    if str(answer).lower() not in set(['yes','y', 'ye', '']):
+        os.sys.exit('Will not overwrite \"{inputFile}\". Exiting...'.
+        format(inputFile=output_file_name))
+    return True
+
+def dicom_writer(image,output_file_name,force,overwrite='prompt'):
+    # Check if the output exists, prompt to overwrite (see check_output_file for the non-interactive policies)
+    if force:
+        overwrite = 'overwrite'
+    if not check_output_file(output_file_name,overwrite):
+        return
 
     
     print('Writing to {}'.format(output_file_name))
@@ -79,6 +188,8 @@ def dicom_writer(image,output_file_name,force):
     
 
 def mean_confidence_interval(data, confidence=0.95):
+    import scipy as sp      # Imported here, scipy.stats is slow to load for the DRR workers which do not need it
+    import scipy.stats
     a = 1.0*np.array(data)
     n = len(a)
     m, se = np.mean(a), scipy.stats.sem(a)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+'''Cache of rendered DRRs
+
+A DRR only depends on the volume, the pose and the detector geometry.
+DRRCache stores rendered DRRs under a hash of the volume content and of the
+canonicalized geometry, in a size-bounded in-memory LRU tier and
+optionally in a persistent directory. Repeated requests are then read back
+instead of being rendered again.
+
+The center of rotation (cor) of main_functions.drr is not part of the key
+since the renderer does not use it.
+'''
+
+import os
+import json
+import hashlib
+import shutil
+import collections
+import threading
+import itk
+import numpy as np
+import atomic_file
+
+# Increase when the rendering changes, so that older disk entries are no longer used
+CACHE_VERSION = 1
+
+def get_volume_digest(inputImage):
+    '''Hash of the voxels and geometry of a volume.
+
+    The digest is computed once per image and kept as the volume_digest
+    attribute of the image.
+
+    Args:
+        inputImage (itk.Image): The volume
+
+    Returns:
+        string:                 Hexadecimal SHA-1 digest
+    '''
+    digest = getattr(inputImage, 'volume_digest', None)
+    if digest is not None:
+        return digest
+
+    array = np.ascontiguousarray(itk.array_view_from_image(inputImage))
+    sha = hashlib.sha1()
+    sha.update(json.dumps({
+        'dtype':        array.dtype.str,
+        'shape':        list(array.shape),
+        'origin':       canonicalize(inputImage.GetOrigin()),
+        'spacing':      canonicalize(inputImage.GetSpacing()),
+        'direction':    canonicalize(itk.array_from_matrix(inputImage.GetDirection())),
+    }, sort_keys=True).encode('utf-8'))
+    sha.update(array.view(np.uint8).reshape(-1))
+    digest = sha.hexdigest()
+    inputImage.volume_digest = digest
+    return digest
+
+def canonicalize(values, decimals=9):
+    '''Round a (nested) list of numbers so that equal geometries give equal keys.
+
+    Values are rounded to the given number of decimals and -0.0 becomes 0.0.
+    '''
+    return [float(value) + 0. for value in np.round(np.asarray(values, dtype=np.float64), decimals).reshape(-1)]
+
+def get_drr_key(volume_digest, rot, t, focalPoint, originOutput, sizeOutput, spaceOutput, directionOutput, threshold, backend='itk', output_type=''):
+    '''Key of a DRR in the cache.
+
+    Args:
+        volume_digest (string):     Digest of the volume, see get_volume_digest
+        rot (list):                 Rotation in degrees in x, y and z
+        t (list):                   Translation in x, y and z
+        focalPoint (list):          Location of the x-ray source (x,y,z)
+        originOutput (list):        Origin of the output image (x,y,z)
+        sizeOutput (list):          Size of the output image (x,y,z)
+        spaceOutput (list):         Spacing of the output image (x,y,z)
+        directionOutput (np.array): Direction matrix of the output image
+        threshold (float):          Only intensities above the threshold are integrated
+        backend (string):           Ray casting backend
+        output_type (string):       Name of the output image type
+
+    Returns:
+        string:                     Hexadecimal SHA-1 key
+    '''
+    geometry = {
+        'version':          CACHE_VERSION,
+        'volume':           volume_digest,
+        'rot':              canonicalize(rot),
+        't':                canonicalize(t),
+        'focalPoint':       canonicalize(focalPoint),
+        'originOutput':     canonicalize(originOutput),
+        'sizeOutput':       [int(s) for s in sizeOutput],
+        'spaceOutput':      canonicalize(spaceOutput),
+        'directionOutput':  canonicalize(directionOutput),
+        'threshold':        canonicalize([threshold]),
+        'backend':          backend,
+        'output_type':      str(output_type),
+    }
+    return hashlib.sha1(json.dumps(geometry, sort_keys=True).encode('utf-8')).hexdigest()
+
+class DRRCache(object):
+    '''Two tier cache of DRR arrays.
+
+    Every entry holds the DRR array and the intensity range of the ray cast
+    image before rescaling (see DRRRenderer.get_intensity_range).
+
+    Args:
+        max_bytes (int):        Size of the in-memory tier. 0 disables it.
+        directory (string):     Directory of the persistent tier, None disables it
+    '''
+    def __init__(self, max_bytes=256*1024**2, directory=None):
+        self.max_bytes  = max_bytes
+        self.directory  = directory
+        self.memory     = collections.OrderedDict()
+        self.bytes      = 0
+        self.lock       = threading.Lock()
+
+        self.hits       = 0
+        self.disk_hits  = 0
+        self.misses     = 0
+        self.evictions  = 0
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_file_name(self, key):
+        '''File of an entry in the persistent tier.'''
+        return os.path.join(self.directory, key[:2], key + '.npz')
+
+    def get(self, key):
+        '''Look up a DRR.
+
+        Args:
+            key (string):   Key from get_drr_key
+
+        Returns:
+            tuple:          (array, intensity range) or None on a miss
+        '''
+        with self.lock:
+            if key in self.memory:
+                entry = self.memory.pop(key)
+                self.memory[key] = entry        # Most recently used goes last
+                self.hits += 1
+                return entry
+
+        if self.directory is not None and os.path.exists(self.get_file_name(key)):
+            with np.load(self.get_file_name(key)) as data:
+                entry = (data['image'], tuple(data['range']))
+            self._remember(key, entry)
+            with self.lock:
+                self.hits += 1
+                self.disk_hits += 1
+            return entry
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, image, intensity_range=(0., 0.)):
+        '''Store a DRR. The array is copied.
+
+        Args:
+            key (string):           Key from get_drr_key
+            image (np.array):       The DRR
+            intensity_range (tuple):Minimum and maximum before rescaling
+        '''
+        entry = (np.array(image), tuple(float(value) for value in intensity_range))
+        entry[0].setflags(write=False)      # Entries are shared by every caller of get
+        self._remember(key, entry)
+
+        if self.directory is not None:
+            file_name = self.get_file_name(key)
+            if not os.path.isdir(os.path.dirname(file_name)):
+                try:
+                    os.makedirs(os.path.dirname(file_name))
+                except OSError:             # Created by another process in the meantime
+                    pass
+            with atomic_file.open_atomic(file_name, 'wb') as output:
+                np.savez(output, image=entry[0], range=np.array(entry[1]))
+
+    def _remember(self, key, entry):
+        size = entry[0].nbytes
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.memory:
+                self.bytes -= self.memory.pop(key)[0].nbytes
+            self.memory[key] = entry
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.memory.popitem(last=False)
+                self.bytes -= evicted[0].nbytes
+                self.evictions += 1
+
+    def clear(self, disk=False):
+        '''Empty the in-memory tier, and the persistent tier if disk is True.'''
+        with self.lock:
+            self.memory.clear()
+            self.bytes = 0
+        if disk and self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory)
+
+    def stats(self):
+        '''Counters of the cache.
+
+        Returns:
+            dict:   hits (of both tiers), disk_hits, misses, evictions, entries and bytes of the in-memory tier
+        '''
+        with self.lock:
+            return {
+                'hits':         self.hits,
+                'disk_hits':    self.disk_hits,
+                'misses':       self.misses,
+                'evictions':    self.evictions,
+                'entries':      len(self.memory),
+                'bytes':        self.bytes,
+            }
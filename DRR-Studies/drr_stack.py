@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+'''Store a large batch of DRRs in one container instead of one file per pose
+
+DRRStackWriter appends DRRs to
+    - a .npy stack, memory-mappable, with a .index.npy table of the poses
+      and the intensity range of every DRR, or
+    - an HDF5 file (requires h5py) with one chunk per DRR, optionally
+      compressed, holding the same table,
+and writes the detector geometry to a .json sidecar. The sidecar is
+written last, under a temporary name which is then renamed, and marks the
+stack complete. A stack whose writer was closed by an exception is marked
+incomplete, and DRRStack refuses to read it.
+
+The output of the pipeline is rescaled to 0-255, so the DRRs are stored as
+uint8 by default (a quarter of the float32 size). uint16 keeps the
+fraction of the rescaled values (0-255 is stored as 0-65535) and float32
+stores them as they are. The intensity range saved for every DRR maps the
+stored values back to the ray sums (see DRRStack.read_ray_sums).
+
+    with DRRStackWriter('drrs', [60, 80], capacity=len(poses), dtype='uint8', geometry=geometry) as stack:
+        for pose in poses:
+            image = renderer.render(pose[:3], pose[3:])
+            stack.append(image, pose, renderer.get_intensity_range())
+
+    drrs = DRRStack('drrs')
+    image = drrs.get_by_pose([0, 5, 0, 0, 0, 0])
+'''
+
+import os
+import json
+import numpy as np
+import atomic_file
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+DTYPES = {
+    'uint8':    (np.uint8, 1.),
+    'uint16':   (np.uint16, 65535. / 255.),
+    'float32':  (np.float32, 1.),
+}
+
+INDEX_DTYPE = np.dtype([('pose', np.float64, (6,)), ('range', np.float64, (2,))])
+
+def get_stack_files(file_name, storage='npy'):
+    '''Paths of the images, the index and the sidecar of a stack.'''
+    base = os.path.splitext(file_name)[0] if file_name.endswith(('.npy', '.h5', '.json')) else file_name
+    if storage == 'hdf5':
+        return base + '.h5', base + '.h5', base + '.json'
+    return base + '.npy', base + '.index.npy', base + '.json'
+
+def to_dtype(image, dtype):
+    '''Convert a 0-255 DRR to the stored dtype.'''
+    numpy_dtype, scale = DTYPES[dtype]
+    image = np.asarray(image, dtype=np.float64) * scale
+    if numpy_dtype == np.float32:
+        return image.astype(numpy_dtype)
+    return np.clip(np.rint(image), 0, np.iinfo(numpy_dtype).max).astype(numpy_dtype)
+
+class DRRStackWriter(object):
+    '''Append DRRs and their poses to a single container.
+
+    Args:
+        file_name (string): Output file, the extensions are added
+        image_shape (list): (H, W) of the DRRs
+        capacity (int):     Maximum number of DRRs, needed by the npy storage
+        dtype (string):     'uint8', 'uint16' or 'float32'
+        storage (string):   'npy' or 'hdf5'
+        compression (string):   HDF5 compression filter, e.g. 'gzip' or 'lzf', None for none
+        geometry (dict):    Detector geometry and other metadata saved in the sidecar (JSON serializable)
+    '''
+    def __init__(self, file_name, image_shape, capacity=None, dtype='uint8', storage='npy', compression=None, geometry=None):
+        if dtype not in DTYPES:
+            raise ValueError('Unknown dtype "{}". Use one of {}.'.format(dtype, sorted(DTYPES)))
+        self.image_shape = tuple(int(s) for s in image_shape[-2:])
+        self.dtype = dtype
+        self.storage = storage
+        self.count = 0
+        self.image_file_name, self.index_file_name, self.sidecar_file_name = get_stack_files(file_name, storage)
+        self.header = {
+            'storage':      storage,
+            'dtype':        dtype,
+            'scale':        DTYPES[dtype][1],
+            'image_shape':  list(self.image_shape),
+            'count':        0,
+            'geometry':     geometry,
+        }
+
+        if storage == 'npy':
+            if capacity is None:
+                raise ValueError('The npy storage needs the capacity of the stack.')
+            self.capacity = int(capacity)
+            self.images = np.lib.format.open_memmap(self.image_file_name, mode='w+', dtype=DTYPES[dtype][0],
+                                                    shape=(self.capacity,) + self.image_shape)
+            self.index = np.lib.format.open_memmap(self.index_file_name, mode='w+', dtype=INDEX_DTYPE, shape=(self.capacity,))
+        elif storage == 'hdf5':
+            if h5py is None:
+                raise ImportError('The hdf5 storage requires h5py.')
+            self.capacity = None if capacity is None else int(capacity)
+            self.file = h5py.File(self.image_file_name, 'w')
+            self.images = self.file.create_dataset('images', shape=(0,) + self.image_shape, maxshape=(self.capacity,) + self.image_shape,
+                                                   dtype=DTYPES[dtype][0], chunks=(1,) + self.image_shape, compression=compression)
+            self.index = self.file.create_dataset('index', shape=(0,), maxshape=(self.capacity,), dtype=INDEX_DTYPE)
+            self.header['compression'] = compression
+        else:
+            raise ValueError('Unknown storage "{}". Use "npy" or "hdf5".'.format(storage))
+
+    def append(self, image, pose, intensity_range=(0., 255.)):
+        '''Append a 0-255 DRR (itk.Image or array) of the pose [rx, ry, rz, tx, ty, tz].
+
+        intensity_range is the range of the ray sums mapped to 0-255,
+        e.g. DRRRenderer.get_intensity_range().'''
+        if self.capacity is not None and self.count >= self.capacity:
+            raise IndexError('The stack is full ({} DRRs).'.format(self.capacity))
+        if not isinstance(image, np.ndarray):
+            import itk
+            image = itk.array_view_from_image(image)
+        image = to_dtype(np.reshape(image, self.image_shape), self.dtype)
+        entry = np.zeros((), dtype=INDEX_DTYPE)
+        entry['pose'] = np.ravel(pose)
+        entry['range'] = intensity_range
+
+        if self.storage == 'hdf5':
+            self.images.resize(self.count + 1, axis=0)
+            self.index.resize(self.count + 1, axis=0)
+        self.images[self.count] = image
+        self.index[self.count] = entry
+        self.count += 1
+
+    def append_batch(self, images, poses, intensity_ranges=None):
+        '''Append an (N, H, W) batch, e.g. from DRRRenderer.render_batch(poses, return_range=True).'''
+        poses = np.atleast_2d(poses)
+        if intensity_ranges is None:
+            intensity_ranges = [(0., 255.)] * poses.shape[0]
+        for image, pose, intensity_range in zip(images, poses, intensity_ranges):
+            self.append(image, pose, intensity_range)
+
+    def close(self, complete=True):
+        '''Flush the DRRs and write the sidecar, marking the stack complete or not.'''
+        if self.images is None:
+            return
+        if self.storage == 'npy':
+            self.images.flush()
+            self.index.flush()
+        else:
+            self.file.close()
+        self.images = self.index = None
+        self.header['count'] = self.count
+        self.header['complete'] = complete
+        with atomic_file.open_atomic(self.sidecar_file_name) as sidecar:
+            json.dump(self.header, sidecar)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)      # An aborted render leaves an incomplete stack
+        return False
+
+class DRRStack(object):
+    '''Random access to the DRRs of a stack written by DRRStackWriter.
+
+    Args:
+        file_name (string): Stack file, with or without extension
+
+    Raises a ValueError if the writer of the stack was interrupted.
+    '''
+    def __init__(self, file_name):
+        sidecar_file_name = get_stack_files(file_name)[2]
+        with open(sidecar_file_name) as sidecar:
+            self.header = json.load(sidecar)
+        if not self.header.get('complete', True):
+            raise ValueError('The stack {} is incomplete, its writer was interrupted after {} DRRs.'.format(file_name, self.header['count']))
+        self.storage = self.header['storage']
+        self.count = self.header['count']
+        self.geometry = self.header['geometry']
+        image_file_name, index_file_name, _ = get_stack_files(file_name, self.storage)
+        if self.storage == 'npy':
+            self.images = np.load(image_file_name, mmap_mode='r')[:self.count]
+            self.index = np.load(index_file_name, mmap_mode='r')[:self.count]
+        else:
+            if h5py is None:
+                raise ImportError('Reading an hdf5 stack requires h5py.')
+            self.file = h5py.File(image_file_name, 'r')
+            self.images = self.file['images']
+            self.index = self.file['index'][:]
+        self.poses = np.array(self.index['pose'])
+        self.ranges = np.array(self.index['range'])
+        self.pose_index = dict((tuple(np.round(pose, 6)), ii) for ii, pose in enumerate(self.poses))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        '''Stored DRR(s) at index, as stored (dtype of the stack).'''
+        return self.images[index]
+
+    def read(self, index):
+        '''DRR at index as 0-255 floats.'''
+        return np.asarray(self.images[index], dtype=np.float64) / self.header['scale']
+
+    def read_ray_sums(self, index):
+        '''DRR at index mapped back to the ray sums through its intensity range.'''
+        low, high = self.ranges[index]
+        return low + self.read(index) * ((high - low) / 255.)
+
+    def find(self, pose, nearest=False):
+        '''Index of the DRR of pose, or of the closest pose if nearest. None if not found.'''
+        index = self.pose_index.get(tuple(np.round(np.ravel(pose).astype(np.float64), 6)))
+        if index is None and nearest and self.count:
+            index = int(np.argmin(np.sum((self.poses - np.ravel(pose)) ** 2, axis=1)))
+        return index
+
+    def get_by_pose(self, pose, nearest=False):
+        '''Stored DRR of pose, see find. Raises KeyError if the pose is not in the stack.'''
+        index = self.find(pose, nearest)
+        if index is None:
+            raise KeyError('No DRR of the pose {} in the stack.'.format(list(np.ravel(pose))))
+        return self.images[index]
+
+    def close(self):
+        '''Close the HDF5 file.'''
+        if self.storage == 'hdf5':
+            self.file.close()
+
+def render_to_stack(renderer, poses, file_name, dtype='uint8', storage='npy', compression=None, chunk_size=64, geometry=None):
+    '''Render an N x 6 array of poses with a DRRRenderer into a stack.
+
+    Returns:
+        DRRStack:   The stack
+    '''
+    poses = np.atleast_2d(np.asarray(poses, dtype=np.float64))
+    if geometry is None:
+        geometry = {
+            'focalPoint':       [float(value) for value in renderer.focalPoint],
+            'originOutput':     [float(value) for value in renderer.originOutput],
+            'sizeOutput':       [int(value) for value in renderer.sizeOutput],
+            'spaceOutput':      [float(value) for value in renderer.spaceOutput],
+            'directionOutput':  np.asarray(renderer.directionOutput, dtype=np.float64).tolist(),
+            'threshold':        float(renderer.threshold),
+        }
+    size = [int(value) for value in renderer.sizeOutput]
+    with DRRStackWriter(file_name, [size[1], size[0]], poses.shape[0], dtype, storage, compression, geometry) as stack:
+        for first in range(0, poses.shape[0], chunk_size):
+            images, ranges = renderer.render_batch(poses[first:first + chunk_size], return_range=True)
+            stack.append_batch(images, poses[first:first + chunk_size], ranges)
+    return DRRStack(file_name)
@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+'''Resumable and shardable batch DRR jobs
+
+A job is described by a JSON spec instead of paths and loops edited in
+script_main.py:
+
+    {
+        "volumes":      ["/data/knee_ct.nii"],
+        "pixel_type":   null,
+        "geometry":     {"focalPoint": [0, 0, 1000], "originOutput": [-85.5, -116.9, -200],
+                         "sizeOutput": [1024, 1400, 1], "spaceOutput": [0.167, 0.167, 1],
+                         "directionOutput": [[1, 0, 0], [0, 1, 0], [0, 0, 1]], "threshold": 0},
+        "backend":      "numpy",
+        "poses":        {"grid": {"rx": [-10, 0, 10], "ry": {"start": -20, "stop": 20, "num": 41}}},
+        "output":       {"sink": "files", "directory": "/data/drrs"},
+        "shard_size":   100
+    }
+
+The poses are a "grid" (values, or start/stop/num, of rx, ry, rz, tx, ty
+and tz, 0 if omitted, rx being the outer loop as in sweep.pose_grid), a
+"list" of [rx, ry, rz, tx, ty, tz] or a "file" (.npy or .json N x 6).
+The output "sink" is "files" (one image per pose, named by "pattern") or
+"stack" (one drr_stack.DRRStackWriter stack per shard, "dtype" and
+"storage" as there). The optional "precision" ("double" or "single") and
+"stored_values" (DICOM series kept in their int16 stored values, with
+"pixel_type" "short") are those of main_functions.DRRRenderer and
+volume_cache.load_volume, for the numpy backend. The ray sums are cast
+to "output_pixel_type" ("float" by default) before they are rescaled to
+the 0-255 DRR.
+
+The poses of every volume are split into shards of shard_size poses. Any
+number of processes, on one node or on several nodes sharing the work
+directory, run the same job. Each one claims a free shard by creating its
+lock file in the work directory, renders it and marks it done:
+
+    python jobs.py job.json /shared/job_dir run --processes 8
+    python jobs.py job.json /shared/job_dir status
+
+The poses of the files sink are checkpointed as they are written, so a
+shard interrupted by a crash is resumed where it stopped, and a rerun
+skips the finished shards. A claim whose lock file was not touched for
+lease_seconds (its worker died) is taken over by the next worker. A lock
+file holds the token of its owner: a worker only removes its own lock,
+and one whose claim was taken over (ClaimLostError when it renews its
+lease) gives the shard up without marking it done. Every output is
+written under a temporary name and renamed, so a shard rendered twice by
+mistake only costs time.
+'''
+
+import os
+import json
+import time
+import errno
+import socket
+import argparse
+import multiprocessing
+import itk
+import numpy as np
+import main_functions
+import volume_cache
+import drr_stack
+import atomic_file
+
+# Order of the pose parameters in the spec and in the pose arrays
+POSE_PARAMETERS = ('rx', 'ry', 'rz', 'tx', 'ty', 'tz')
+
+DEFAULT_PATTERN = '{volume}_rx_{rx:g}_ry_{ry:g}_rz_{rz:g}_tx_{tx:g}_ty_{ty:g}_tz_{tz:g}.nii'
+
+def load_spec(file_name):
+    '''Read and check a job spec.'''
+    with open(file_name) as spec_file:
+        spec = json.load(spec_file)
+    check_spec(spec)
+    return spec
+
+def check_spec(spec):
+    '''Raise a ValueError if the spec misses a required entry.'''
+    for key in ('volumes', 'geometry', 'poses', 'output'):
+        if key not in spec:
+            raise ValueError('The job spec needs "{}".'.format(key))
+    for key in ('focalPoint', 'originOutput', 'sizeOutput', 'spaceOutput'):
+        if key not in spec['geometry']:
+            raise ValueError('The geometry of the job spec needs "{}".'.format(key))
+    if not any(key in spec['poses'] for key in ('grid', 'list', 'file')):
+        raise ValueError('The poses of the job spec need a "grid", a "list" or a "file".')
+    if spec['output'].get('sink', 'files') not in ('files', 'stack'):
+        raise ValueError('Unknown output sink "{}". Use "files" or "stack".'.format(spec['output']['sink']))
+
+def get_axis_values(values):
+    '''Values of a pose parameter of a grid: a list, a single value, or {"start", "stop", "num"}.'''
+    if isinstance(values, dict):
+        return np.linspace(values['start'], values['stop'], values['num']).tolist()
+    return list(np.atleast_1d(values).astype(np.float64))
+
+def get_poses(spec):
+    '''N x 6 array of the poses of a job spec.'''
+    poses = spec['poses']
+    if 'grid' in poses:
+        axes = [get_axis_values(poses['grid'].get(name, [0.])) for name in POSE_PARAMETERS]
+        grid = np.meshgrid(*axes, indexing='ij')
+        return np.stack([values.ravel() for values in grid], axis=1)
+    if 'list' in poses:
+        return np.atleast_2d(np.asarray(poses['list'], dtype=np.float64))
+    if poses['file'].endswith('.npy'):
+        return np.atleast_2d(np.load(poses['file']).astype(np.float64))
+    with open(poses['file']) as pose_file:
+        return np.atleast_2d(np.asarray(json.load(pose_file), dtype=np.float64))
+
+def get_shards(spec, number_of_poses):
+    '''Shards of a job: (name, volume index, first pose, last pose + 1).'''
+    shard_size = int(spec.get('shard_size', 100))
+    shards = []
+    for volume in range(len(spec['volumes'])):
+        for first in range(0, number_of_poses, shard_size):
+            shards.append(('{:03d}_{:08d}'.format(volume, first), volume, first, min(first + shard_size, number_of_poses)))
+    return shards
+
+def get_volume_name(file_name):
+    '''Name of a volume in the output file names, its file name without extensions.'''
+    name = os.path.basename(os.path.normpath(file_name))
+    for extension in ('.gz', '.nii', '.nrrd', '.nhdr', '.mha', '.mhd'):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return name
+
+class ClaimLostError(RuntimeError):
+    '''Raised when the claim of a shard was taken over by another worker.'''
+
+def read_owner(path):
+    '''Owner token of a lock file, None if there is no lock. It is '' while the owner is writing it.'''
+    try:
+        with open(path) as lock:
+            return lock.read()
+    except (IOError, OSError):
+        return None
+
+def restore_lock(moved, path):
+    '''Put back a lock file moved away by mistake, unless a new lock was created at path in the meantime.'''
+    try:
+        os.link(moved, path)    # Fails if path exists, unlike a rename
+    except OSError:
+        pass
+    os.remove(moved)
+
+class JobRunner(object):
+    '''Claim, render and checkpoint the shards of a job.
+
+    Args:
+        spec (dict):            Job spec, see the module documentation
+        work_directory (string):    Directory of the locks, checkpoints and done markers, shared by all the workers
+        lease_seconds (float):  A claim not touched for this long is taken over by another worker
+        verbose (bool):         Print the progress
+    '''
+    def __init__(self, spec, work_directory, lease_seconds=600., verbose=False):
+        check_spec(spec)
+        self.spec = spec
+        self.work_directory = work_directory
+        self.lease_seconds = lease_seconds
+        self.verbose = verbose
+        self.poses = get_poses(spec)
+        self.shards = get_shards(spec, self.poses.shape[0])
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), time.time())
+        self.renderers = {}
+
+    def get_path(self, kind, shard=None):
+        '''Path of the spec, or of the claim, checkpoint or done marker of a shard.'''
+        if kind == 'spec':
+            return os.path.join(self.work_directory, 'spec.json')
+        extension = {'claims': '.lock', 'checkpoints': '.txt', 'done': '.json'}[kind]
+        return os.path.join(self.work_directory, kind, shard + extension)
+
+    def prepare(self):
+        '''Create the work directory, or check that it belongs to the same spec.'''
+        for kind in ('claims', 'checkpoints', 'done'):
+            directory = os.path.join(self.work_directory, kind)
+            try:
+                os.makedirs(directory)
+            except OSError:     # Created before, or by another worker in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        spec_file_name = self.get_path('spec')
+        text = json.dumps(self.spec, sort_keys=True, indent=1)
+        if not os.path.exists(spec_file_name):
+            atomic_file.write_atomic(text, spec_file_name)
+        with open(spec_file_name) as spec_file:
+            if json.load(spec_file) != json.loads(text):
+                raise ValueError('The work directory {} belongs to another job spec.'.format(self.work_directory))
+
+    def is_done(self, shard):
+        return os.path.exists(self.get_path('done', shard))
+
+    def claim(self, shard, take_over=True):
+        '''Create the lock file of a shard, holding the owner token. Returns False if another live worker holds it.'''
+        path = self.get_path('claims', shard)
+        try:
+            handle = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+            owner = read_owner(path)
+            if owner is None:       # Released in the meantime
+                return self.claim(shard, take_over)
+            if not take_over or not self.is_stale(path):
+                return False
+            # Move the stale lock away, only one worker can rename it. Another worker may have
+            # taken it over and created a fresh lock since it was checked, so check the moved file again.
+            moved = self.move_lock(path)
+            if moved is None:
+                return False
+            if read_owner(moved) != owner or not self.is_stale(moved):
+                restore_lock(moved, path)
+                return False
+            os.remove(moved)
+            if self.verbose:
+                print('Taking over the stale shard {} of {}'.format(shard, owner))
+            return self.claim(shard, take_over=False)
+        with os.fdopen(handle, 'w') as lock:
+            lock.write(self.owner)
+        return True
+
+    def move_lock(self, path):
+        '''Rename a lock file to a name of this worker. Returns the new name, None if the lock is gone.'''
+        moved = '{}.{}.moved'.format(path, self.owner.replace(':', '_'))
+        try:
+            os.rename(path, moved)
+        except OSError:
+            return None
+        return moved
+
+    def is_stale(self, path):
+        try:
+            return time.time() - os.path.getmtime(path) > self.lease_seconds
+        except OSError:         # Released in the meantime
+            return False
+
+    def touch(self, shard):
+        '''Renew the lease of a claimed shard. Raises a ClaimLostError if another worker took it over.'''
+        path = self.get_path('claims', shard)
+        owner = read_owner(path)
+        if owner != self.owner:
+            raise ClaimLostError('The claim of shard {} was taken over by {}.'.format(shard, owner))
+        os.utime(path, None)
+
+    def release(self, shard):
+        '''Remove the lock file of a shard, if this worker still owns it.'''
+        path = self.get_path('claims', shard)
+        if read_owner(path) != self.owner:
+            return
+        moved = self.move_lock(path)
+        if moved is None:
+            return
+        if read_owner(moved) == self.owner:
+            os.remove(moved)
+        else:                   # Taken over between the check and the rename
+            restore_lock(moved, path)
+
+    def read_checkpoint(self, shard):
+        '''Indices of the poses of a shard already rendered.'''
+        path = self.get_path('checkpoints', shard)
+        if not os.path.exists(path):
+            return set()
+        with open(path) as checkpoint:
+            return set(int(line) for line in checkpoint if line.strip())
+
+    def get_renderer(self, volume):
+        '''DRRRenderer of a volume, built once per worker.'''
+        if volume not in self.renderers:
+            self.renderers.clear()      # Shards are in volume order, keep a single volume in memory
+            spec = self.spec
+            pixel_type = None if spec.get('pixel_type') is None else itk.ctype(spec['pixel_type'])
+            inputImage = volume_cache.load_volume(spec['volumes'][volume], spec.get('volume_cache'), pixel_type=pixel_type,
+                                                  stored_values=spec.get('stored_values', False))
+            InputImageType = type(inputImage)
+            # Float ray sums by default, an integer input type (e.g. the stored values of a CT) would saturate them
+            OutputImageType = itk.Image[itk.ctype(spec.get('output_pixel_type') or 'float'), 3]
+            geometry = spec['geometry']
+            self.renderers[volume] = main_functions.DRRRenderer(
+                inputImage, geometry['focalPoint'], geometry['originOutput'], geometry['sizeOutput'], geometry['spaceOutput'],
+                np.asarray(geometry.get('directionOutput', np.eye(3)), dtype=np.float64), geometry.get('threshold', 0.),
+                InputImageType, OutputImageType, backend=spec.get('backend', 'itk'), precision=spec.get('precision', 'double'))
+        return self.renderers[volume]
+
+    def render_files(self, shard, volume, first, last):
+        '''Render the poses of a shard to one file each, checkpointing every pose.'''
+        output = self.spec['output']
+        directory = output['directory']
+        pattern = output.get('pattern', DEFAULT_PATTERN)
+        volume_name = get_volume_name(self.spec['volumes'][volume])
+        finished = self.read_checkpoint(shard)
+        with open(self.get_path('checkpoints', shard), 'a') as checkpoint:
+            for index in range(first, last):
+                if index in finished:
+                    continue
+                pose = self.poses[index]
+                renderer = self.get_renderer(volume)
+                image = renderer.render(pose[:3], pose[3:])
+                names = dict(zip(POSE_PARAMETERS, pose))
+                file_name = os.path.join(directory, pattern.format(volume=volume_name, index=index, **names))
+                with atomic_file.atomic_path(file_name) as temporary:
+                    itk.imwrite(image, temporary)       # Same extension, so the same ImageIO
+                checkpoint.write('{}\n'.format(index))
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+                self.touch(shard)
+
+    def render_stack(self, shard, volume, first, last):
+        '''Render the poses of a shard into one stack, which is complete once its sidecar is written.'''
+        output = self.spec['output']
+        renderer = self.get_renderer(volume)
+        geometry = dict(self.spec['geometry'], volume=self.spec['volumes'][volume], first_pose=first)
+        size = [int(value) for value in self.spec['geometry']['sizeOutput']]
+        chunk_size = int(output.get('chunk_size', 16))
+        with drr_stack.DRRStackWriter(os.path.join(output['directory'], shard), [size[1], size[0]], last - first,
+                                      output.get('dtype', 'uint8'), output.get('storage', 'npy'), output.get('compression'),
+                                      geometry) as stack:
+            for start in range(first, last, chunk_size):
+                poses = self.poses[start:min(start + chunk_size, last)]
+                images, ranges = renderer.render_batch(poses, return_range=True)
+                stack.append_batch(images, poses, ranges)
+                self.touch(shard)
+
+    def run_shard(self, shard, volume, first, last):
+        '''Render a claimed shard and mark it done.'''
+        start = time.time()
+        directory = self.spec['output']['directory']
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:     # Created by another worker in the meantime
+                pass
+        if self.spec['output'].get('sink', 'files') == 'stack':
+            self.render_stack(shard, volume, first, last)
+        else:
+            self.render_files(shard, volume, first, last)
+        self.touch(shard)       # Still the owner
+        atomic_file.write_atomic(json.dumps({'owner': self.owner, 'poses': last - first, 'seconds': time.time() - start}), self.get_path('done', shard))
+
+    def run(self, max_shards=None):
+        '''Claim and render shards until none is left, or max_shards were rendered.
+
+        Returns:
+            int:    Number of shards rendered by this worker
+        '''
+        self.prepare()
+        rendered = 0
+        for shard, volume, first, last in self.shards:
+            if max_shards is not None and rendered >= max_shards:
+                break
+            if self.is_done(shard) or not self.claim(shard):
+                continue
+            try:
+                if not self.is_done(shard):     # Finished by another worker between the check and the claim
+                    if self.verbose:
+                        print('Rendering shard {} (poses {} to {} of volume {})'.format(shard, first, last - 1, volume))
+                    self.run_shard(shard, volume, first, last)
+                    rendered += 1
+            except ClaimLostError as error:
+                print('{} Its poses are left to the new owner.'.format(error))
+            finally:
+                self.release(shard)
+        return rendered
+
+    def status(self):
+        '''Number of shards 'done', 'running' (claimed) and 'pending', and of poses checkpointed.'''
+        counts = {'done': 0, 'running': 0, 'pending': 0, 'shards': len(self.shards), 'poses_done': 0}
+        for shard, volume, first, last in self.shards:
+            if self.is_done(shard):
+                counts['done'] += 1
+                counts['poses_done'] += last - first
+            else:
+                counts['running' if os.path.exists(self.get_path('claims', shard)) else 'pending'] += 1
+                counts['poses_done'] += len(self.read_checkpoint(shard))
+        return counts
+
+def run_worker(spec, work_directory, lease_seconds, max_shards, verbose):
+    '''Entry point of a worker process.'''
+    return JobRunner(spec, work_directory, lease_seconds, verbose).run(max_shards)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a resumable, shardable batch DRR job.')
+    parser.add_argument('spec', help='JSON job spec')
+    parser.add_argument('work_directory', help='Directory of the locks and checkpoints, shared by all the workers of the job')
+    parser.add_argument('command', choices=['run', 'status'])
+    parser.add_argument('--processes', type=int, default=1, help='Worker processes started on this node')
+    parser.add_argument('--max-shards', type=int, help='Shards rendered per worker before it exits')
+    parser.add_argument('--lease', type=float, default=600., help='Seconds after which the claim of a silent worker is taken over')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    spec = load_spec(args.spec)
+    runner = JobRunner(spec, args.work_directory, args.lease, args.verbose)
+    if args.command == 'status':
+        print(json.dumps(runner.status(), sort_keys=True))
+        return
+    runner.prepare()
+    if args.processes == 1:
+        rendered = runner.run(args.max_shards)
+    else:
+        pool = multiprocessing.Pool(args.processes)
+        try:
+            rendered = sum(pool.map(run_worker_args, [(spec, args.work_directory, args.lease, args.max_shards, args.verbose)] * args.processes))
+        finally:
+            pool.close()
+            pool.join()
+    print('{} shards rendered, {}'.format(rendered, json.dumps(runner.status(), sort_keys=True)))
+
+def run_worker_args(args):
+    '''run_worker with its arguments in a tuple (Pool.map).'''
+    return run_worker(*args)
+
+if __name__ == '__main__':
+    main()
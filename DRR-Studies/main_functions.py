@@ -1,125 +1,502 @@
-import sys
 import itk
 import itk_helpers as Functions
 import numpy as np
 import dicom_functions as dfun
+import raycast
+import drr_cache
+import profiler as profiling
 
-def drr(inputImage,output_filename,rot,t,focalPoint,originOutput,sizeOutput,cor,spaceOutput,directionOutput,threshold,InputImageType,OutputImageType,verbose):
-    #%% Transfomration 
+# Types in which the numpy backend interpolates and sums the rays
+PRECISIONS = {'double': np.float64, 'single': np.float32}
+
+def set_drr_transform(transform,inputImage,rot,t):
+    '''Set the pose (rot, t) of the x-ray source on a CenteredEuler3DTransform.
+
+    The rotation (degrees) and translation are expressed in the frame of the input image.'''
+    #%% Transfomration
     inOrigin     = inputImage.GetOrigin()                   # Get the origin of the image.
     inSpacing    = inputImage.GetSpacing()                  # Get the resolution of the input image.
     inSize       = inputImage.GetBufferedRegion().GetSize() # Get the size of the input image.
     inDirection  = inputImage.GetDirection()
-    
-    #%% ------------------ Transformation 
-    # This part is inevitable since the interpolator (Ray-cast) and resample Image
-    # image filter uses a Transformation -- Here we set it to identity. 
-    TransformType = itk.CenteredEuler3DTransform[itk.D]
-    transform     = TransformType.New()
-    
+
     direction_mat = Functions.get_vnl_matrix(inDirection.GetVnlMatrix())
-    
+
     rot_mod = np.dot(-1,rot)           # Due to Direction of transform mapping ( 8.3.1 in the ITK manual)
     t_mod   = np.dot(-1,t  )           # Due to Direction of transform mapping ( 8.3.1 in the ITK manual)
-    # Since this transform is for the movement of x-ray source and not the rigid body, therefore, no need to invert the rotation. 
+    # Since this transform is for the movement of x-ray source and not the rigid body, therefore, no need to invert the rotation.
     #
     #
-    rot_mod = direction_mat.dot(np.transpose(rot_mod))           
-    t_mod   = direction_mat.dot(np.transpose(t_mod  ))          
-    
-    
+    rot_mod = direction_mat.dot(np.transpose(rot_mod))
+    t_mod   = direction_mat.dot(np.transpose(t_mod  ))
+
+
     transform.SetRotation(np.deg2rad(rot_mod[0]),np.deg2rad(rot_mod[1]),np.deg2rad(rot_mod[2])) # Setting the rotation of the transform
     transform.SetTranslation(itk.Vector.D3(t_mod))    # Setting the translation of the transform
-    transform.SetComputeZYX(True)  # The order of rotation will be ZYX. 
-    
-    center = direction_mat.dot(inOrigin)+ np.multiply(inSpacing,inSize)/2. # Setting the center of rotation as center of 3D object + offset determined by cor. 
-    center = direction_mat.dot(center)-t # Convert the image to the local coordinate system. 
-    transform.SetCenter(center)                     # Setting the center of rotation. 
-    
-    if verbose:
-        print(transform)
-    
-    #%% Raycast interpolator
-    ScalarType = itk.D
-    InterpolatorType = itk.RayCastInterpolateImageFunction[InputImageType,ScalarType]       # Defining the interpolator type from the template. 
-    interpolator     = InterpolatorType.New()               # Pointer to the interpolator
-    
-    interpolator.SetInputImage(inputImage)                  # Setting the input image data
-    interpolator.SetThreshold(threshold)                    # Setting the output threshold
-    interpolator.SetFocalPoint(itk.Point.D3(focalPoint))    # Setting the focal point (x-ray source location)
-    interpolator.SetTransform(transform)                    # Setting the transform -- 
-    
-    if verbose:
-        print(interpolator)
-    #%% filtering
-    #%----------------- Resample Image Filter ------------------------
-        # In this part the resample image filter to map a 3D image to 2D image plane with desired specs is designed
-        
-    FilterType = itk.ResampleImageFilter[InputImageType,OutputImageType]                    # Defining the resample image filter type. 
-    resamplefilter = FilterType.New()               # Pointer to the filter
-    
-    resamplefilter.SetInput(inputImage)             # Setting the input image data 
-    resamplefilter.SetDefaultPixelValue( 0 )      # Setting the default Pixel value
-    resamplefilter.SetInterpolator(interpolator)    # Setting the interpolator
-    resamplefilter.SetTransform(transform)          # Setting the transform
-    resamplefilter.SetSize(sizeOutput)              # Setting the size of the output image. 
-    resamplefilter.SetOutputSpacing(spaceOutput)    # Setting the spacing(resolution) of the output image. 
-    resamplefilter.SetOutputOrigin(originOutput)    # Setting the output origin of the image
-    Functions.change_image_direction(oldDirection=resamplefilter.GetOutputDirection(),newDirection=directionOutput,DimensionOut=3)     # Setting the output direction of the image  --- resamplefilter.SetImageDirection(args) was not working properly
-    resamplefilter.Update()                         # Updating the resample image filter.
-    
-    filteringOutput = resamplefilter.GetOutput()
-    
-    if verbose:
-        print(resamplefilter)
-    #%%---------------- Rescaler Image Filter --------------------------
-    RescalerFilterType = itk.RescaleIntensityImageFilter[InputImageType,OutputImageType]    # Defining the rescale image filter. 
-    rescaler = RescalerFilterType.New()             # Pointer to the rescale filter
-    rescaler.SetOutputMinimum(0)                    # Minimum output
-    rescaler.SetOutputMaximum(255)                  # Maximum output 
-    rescaler.SetInput(resamplefilter.GetOutput())   # Setting the input to the image filter. 
-    
-    filteringOutput = rescaler.GetOutput()
-    
-    if verbose:
-        print(rescaler)
-    
-    #%%---------------- Flip Axis filter ------------------------------
-    
-    FlipFilterType = itk.FlipImageFilter[OutputImageType] 
-    flipfilter = FlipFilterType.New()
-    
-    flipfilter.SetFlipAxes([0,0,0]) # Flip the axes along x and y but leave z intact.  
-    flipfilter.SetInput(filteringOutput) # Setting the input to the flip filter.
-    
-    filteringOutput = flipfilter.GetOutput()
-    
-    if verbose:
-        print(flipfilter)
-    
-     
-    last_filter_output = filteringOutput    
-    
-    #%% ------------------ Writer ------------------------------------
-    # The output of the resample filter can then be passed to a writer to
-    # save the DRR image to a file.
-    
-    WriterType = itk.ImageFileWriter[OutputImageType]
-    writer = WriterType.New()
-    
-    writer.SetFileName(output_filename)
-    writer.SetInput(last_filter_output) # set the input as the output of filtering process. 
-    
-    try:
+    transform.SetComputeZYX(True)  # The order of rotation will be ZYX.
+
+    center = direction_mat.dot(inOrigin)+ np.multiply(inSpacing,inSize)/2. # Setting the center of rotation as center of 3D object + offset determined by cor.
+    center = direction_mat.dot(center)-t # Convert the image to the local coordinate system.
+    transform.SetCenter(center)                     # Setting the center of rotation.
+
+def get_raycast_options(inputImage,backend='numpy',precision='double',rescale=None):
+    '''Options (dtype, slope, intercept) of the raycast.py functions for a precision and rescale, see DRRRenderer.
+
+    Raises a ValueError for an unknown precision, or a single precision or a rescale with the itk backend.'''
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision "{}". Use "double" or "single".'.format(precision))
+    if rescale is None:
+        rescale = (getattr(inputImage,'rescale_slope',1.),getattr(inputImage,'rescale_intercept',0.))
+    rescale = (float(rescale[0]),float(rescale[1]))
+    if backend == 'itk' and (precision != 'double' or rescale != (1.,0.)):
+        raise ValueError('The itk backend casts the rays in double precision on the values of the volume. Use the numpy backend for a single precision or a rescale.')
+    return {'dtype': PRECISIONS[precision], 'slope': rescale[0], 'intercept': rescale[1]}
+
+def get_drr_transform_derivatives(transform,inputImage):
+    '''Derivatives of the matrix and offset of a transform set by set_drr_transform.
+
+    The transform maps x to M * x + offset. The derivatives are taken with
+    respect to the pose [rx, ry, rz, tx, ty, tz] given to set_drr_transform
+    (degrees and the units of the image).
+
+    Returns the 6x3x3 derivatives of M and the 6x3 derivatives of the offset.'''
+    direction_mat = Functions.get_vnl_matrix(inputImage.GetDirection().GetVnlMatrix())
+    angles = [transform.GetAngleX(),transform.GetAngleY(),transform.GetAngleZ()]
+    center = np.array([transform.GetCenter()[ii] for ii in range(3)],dtype=np.float64)
+    matrix, offset = raycast.get_transform_matrix_offset(transform)
+
+    # Rotations about x, y, z and their derivatives, composed as Rz * Ry * Rx (SetComputeZYX)
+    rotations, derivatives = [], []
+    for axis, angle in enumerate(angles):
+        u, v = [ii for ii in range(3) if ii != axis]
+        rotation, derivative = np.eye(3), np.zeros((3,3))
+        rotation[[u,u,v,v],[u,v,u,v]] = [np.cos(angle),-np.sin(angle),np.sin(angle),np.cos(angle)]
+        derivative[[u,u,v,v],[u,v,u,v]] = [-np.sin(angle),-np.cos(angle),np.cos(angle),-np.sin(angle)]
+        if axis == 1:       # The rotation about y is written the other way in ITK
+            rotation, derivative = rotation.T, derivative.T
+        rotations.append(rotation)
+        derivatives.append(derivative)
+    angle_derivatives = [rotations[2].dot(rotations[1]).dot(derivatives[0]),
+                         rotations[2].dot(derivatives[1]).dot(rotations[0]),
+                         derivatives[2].dot(rotations[1]).dot(rotations[0])]
+
+    matrix_derivatives = np.zeros((6,3,3))
+    offset_derivatives = np.zeros((6,3))
+    for jj in range(3):
+        # The angles are -direction * rot in radians, the offset is center + translation - M * center
+        for axis in range(3):
+            matrix_derivatives[jj] += angle_derivatives[axis]*(-np.deg2rad(1.)*direction_mat[axis,jj])
+        offset_derivatives[jj] = -matrix_derivatives[jj].dot(center)
+        # The translation is -direction * t and the center moves by -t
+        unit = np.zeros(3)
+        unit[jj] = 1.
+        offset_derivatives[3+jj] = (matrix-np.eye(3)).dot(unit) - direction_mat.dot(unit)
+    return matrix_derivatives, offset_derivatives
+
+class DRRRenderer(object):
+    '''Render DRRs of one volume and detector geometry for many poses.
+
+    The transform, interpolator, resample, rescale, flip and writer of the
+    pipeline are created once. render(rot,t) only updates the transform
+    parameters and re-executes the pipeline.
+
+    The returned image belongs to the pipeline and is overwritten by the
+    next call to render. Use itk.array_from_image to keep a copy.
+
+    With a writer_queue.WriterQueue the files are written in background
+    threads while the next pose is rendered. Call flush or close on the
+    queue to wait for the files and get the write errors.
+
+    With a drr_cache.DRRCache, render_array and render_batch read poses
+    rendered before from the cache instead of rendering them again.
+
+    Several renderers can share one transform (see multiview.py). The pose
+    is then set once and update() re-executes each pipeline.
+
+    With a profiler.PipelineProfiler the time and memory of every stage
+    (transform, raycast or resample, output or rescale and flip, write)
+    are recorded per pose.
+
+    By default the rescale and flip run as one fused output stage (see
+    fused_output) which writes the DRR directly into a buffer allocated
+    once, in output_pixel_type if given. fused=False runs the ITK
+    RescaleIntensityImageFilter and FlipImageFilter instead, which give
+    the same pixels with a full-size buffer each.
+    '''
+    def __init__(self,inputImage,focalPoint,originOutput,sizeOutput,spaceOutput,directionOutput,threshold,InputImageType,OutputImageType,verbose=False,backend='itk',writer_queue=None,cache=None,transform=None,skip_empty=True,profiler=None,fused=True,output_pixel_type=None,precision='double',rescale=None,centerImage=None):
+        # backend : 'itk' casts the rays with RayCastInterpolateImageFunction, 'numpy' with the vectorized ray caster in raycast.py
+        # skip_empty : with the numpy backend, jump over the blocks of the volume below threshold (same DRR, see raycast.build_occupancy_grid)
+        # fused : rescale and flip in one pass into a single output buffer, see fused_output
+        # output_pixel_type : ITK pixel type of the fused output (e.g. itk.UC for the 0-255 DRR), the pixel type of OutputImageType if None
+        # precision : 'double' or 'single' (float32), type in which the numpy backend interpolates and sums the rays. The itk backend is double only.
+        # rescale : (slope, intercept) of the stored values of the volume (e.g. the int16 values of a CT), applied on the fly by the numpy backend.
+        #           Defaults to the rescale_slope and rescale_intercept attributes of the image (see dicom_functions.read_dicom_series), or (1, 0).
+        #           The threshold is in rescaled units.
+        # centerImage : image whose geometry sets the center of rotation of the poses (see set_drr_transform), the input image if None.
+        #               A shrunk copy of a volume (see pyramid.py) is given the original one, so that a pose projects the same at every resolution.
+        self.inputImage      = inputImage
+        self.centerImage     = inputImage if centerImage is None else centerImage
+        self.focalPoint      = focalPoint
+        self.originOutput    = originOutput
+        self.sizeOutput      = sizeOutput
+        self.spaceOutput     = spaceOutput
+        self.directionOutput = directionOutput
+        self.threshold       = threshold
+        self.verbose         = verbose
+        self.backend         = backend
+        self.writer_queue    = writer_queue
+        self.cache           = cache
+        self.OutputImageType = OutputImageType
+        self.profiler        = profiler
+        self.fused           = fused
+        if output_pixel_type is not None and not fused:
+            raise ValueError('output_pixel_type needs the fused output stage.')
+        self.precision       = precision
+        self.raycastOptions  = get_raycast_options(inputImage,backend,precision,rescale)     # Options of the raycast.py functions
+        self.rescale         = (self.raycastOptions['slope'],self.raycastOptions['intercept'])
+
+        #%% ------------------ Transformation
+        # This part is inevitable since the interpolator (Ray-cast) and resample Image
+        # image filter uses a Transformation -- Here we set it to identity.
+        if transform is None:
+            TransformType = itk.CenteredEuler3DTransform[itk.D]
+            self.transform = TransformType.New()
+            set_drr_transform(self.transform,self.centerImage,[0.,0.,0.],[0.,0.,0.])
+        else:
+            self.transform = transform  # Shared with other renderers, the pose is set by the owner
+
+        if backend == 'numpy':
+            #%% Vectorized ray casting over all detector pixels at once
+            self.detectorPoints = raycast.get_detector_points(originOutput,sizeOutput,spaceOutput,directionOutput)  # Physical location of the detector pixels
+            storedThreshold = raycast.get_stored_threshold(threshold,*self.rescale)       # Threshold on the values of the volume
+            self.occupancy = raycast.build_occupancy_grid(itk.array_view_from_image(inputImage),storedThreshold) if skip_empty else None
+
+            self.raycastOutput = OutputImageType.New()  # Image holding the ray cast result with the same geometry as the resample filter
+            self.raycastOutput.SetRegions(Functions.create_itk_image_region(3,[0,0,0],sizeOutput))
+            self.raycastOutput.Allocate()
+            self.raycastOutput.SetOrigin(originOutput)
+            self.raycastOutput.SetSpacing(spaceOutput)
+            Functions.change_image_direction(oldDirection=self.raycastOutput.GetDirection(),newDirection=directionOutput,DimensionOut=3)
+
+            filteringOutput = self.raycastOutput
+        elif backend == 'itk':
+            #%% Raycast interpolator
+            ScalarType = itk.D
+            InterpolatorType = itk.RayCastInterpolateImageFunction[InputImageType,ScalarType]       # Defining the interpolator type from the template.
+            self.interpolator = InterpolatorType.New()                   # Pointer to the interpolator
+
+            self.interpolator.SetInputImage(inputImage)                  # Setting the input image data
+            self.interpolator.SetThreshold(threshold)                    # Setting the output threshold
+            self.interpolator.SetFocalPoint(itk.Point.D3(focalPoint))    # Setting the focal point (x-ray source location)
+            self.interpolator.SetTransform(self.transform)               # Setting the transform --
+
+            if verbose:
+                print(self.interpolator)
+            #%% filtering
+            #%----------------- Resample Image Filter ------------------------
+            # In this part the resample image filter to map a 3D image to 2D image plane with desired specs is designed
+
+            FilterType = itk.ResampleImageFilter[InputImageType,OutputImageType]                    # Defining the resample image filter type.
+            self.resamplefilter = FilterType.New()                  # Pointer to the filter
+
+            self.resamplefilter.SetInput(inputImage)                # Setting the input image data
+            self.resamplefilter.SetDefaultPixelValue( 0 )           # Setting the default Pixel value
+            self.resamplefilter.SetInterpolator(self.interpolator)  # Setting the interpolator
+            self.resamplefilter.SetTransform(self.transform)        # Setting the transform
+            self.resamplefilter.SetSize(sizeOutput)                 # Setting the size of the output image.
+            self.resamplefilter.SetOutputSpacing(spaceOutput)       # Setting the spacing(resolution) of the output image.
+            self.resamplefilter.SetOutputOrigin(originOutput)       # Setting the output origin of the image
+            Functions.change_image_direction(oldDirection=self.resamplefilter.GetOutputDirection(),newDirection=directionOutput,DimensionOut=3)     # Setting the output direction of the image  --- resamplefilter.SetImageDirection(args) was not working properly
+
+            filteringOutput = self.resamplefilter.GetOutput()
+        else:
+            raise ValueError('Unknown backend "{}". Use "itk" or "numpy".'.format(backend))
+
+        #%%---------------- Rescaler Image Filter --------------------------
+        # Not needed by the fused output, which saves loading its ITK module (see startup.py)
+        if not fused:
+            RescalerFilterType = itk.RescaleIntensityImageFilter[InputImageType,OutputImageType]    # Defining the rescale image filter.
+            self.rescaler = RescalerFilterType.New()        # Pointer to the rescale filter
+            self.rescaler.SetOutputMinimum(0)               # Minimum output
+            self.rescaler.SetOutputMaximum(255)             # Maximum output
+            self.rescaler.SetInput(filteringOutput)         # Setting the input to the image filter.
+            filteringOutput = self.rescaler.GetOutput()
+
+            if verbose:
+                print(self.rescaler)
+
+        #%%---------------- Flip Axis filter ------------------------------
+
+        FlipFilterType = itk.FlipImageFilter[OutputImageType]
+        self.flipfilter = FlipFilterType.New()
+
+        self.flipfilter.SetFlipAxes([0,0,0])                # Flip the axes along x and y but leave z intact.
+        self.flipfilter.SetInput(filteringOutput)           # Setting the input to the flip filter.
+
+        if verbose:
+            print(self.flipfilter)
+
+        #%%---------------- Fused rescale and flip -----------------------
+        # One output image allocated once, written in place by fused_output.
+        # The flip filter above only gives the geometry and the flip axes.
+        if fused:
+            self.flipfilter.UpdateOutputInformation()
+            self.outputImage = itk.Image[itk.template(OutputImageType)[1][0] if output_pixel_type is None else output_pixel_type,3].New()
+            self.outputImage.SetRegions(self.flipfilter.GetOutput().GetLargestPossibleRegion())
+            self.outputImage.Allocate()
+            self.update_output_geometry()
+            self.outputArray = itk.array_view_from_image(self.outputImage)
+            self.intensityRange = (0.,0.)
+            lastOutput = self.outputImage
+        else:
+            lastOutput = self.flipfilter.GetOutput()
+        self.outputType = type(lastOutput)
+
+        #%% ------------------ Writer ------------------------------------
+        # The output of the filtering can then be passed to a writer to
+        # save the DRR image to a file.
+
+        WriterType = itk.ImageFileWriter[self.outputType]
+        self.writer = WriterType.New()
+        self.writer.SetInput(lastOutput)   # set the input as the output of filtering process.
+
+    def stage(self,name):
+        '''Context manager recording a stage of the pipeline in the profiler, if there is one.'''
+        if self.profiler is None:
+            return profiling.NullStage()
+        return self.profiler.stage(name,backend=self.backend)
+
+    def set_pose(self,rot,t,new_pose=True):
+        '''Update the transform parameters for a new pose.'''
+        if self.profiler is not None and new_pose:
+            self.profiler.begin_pose(rot,t)
+        with self.stage('transform'):
+            set_drr_transform(self.transform,self.centerImage,rot,t)
+
+        if self.verbose:
+            print(self.transform)
+
+    def render(self,rot,t,output_filename=None):
+        '''Render the DRR for the pose (rot, t) and optionally write it to output_filename.'''
+        self.set_pose(rot,t)
+        return self.update(output_filename)
+
+    def update(self,output_filename=None,drrArray=None):
+        '''Render the DRR for the current parameters of the transform.
+
+        With the numpy backend, drrArray can give the ray sums when they
+        were already cast, e.g. together with the rays of other cameras.'''
+        if self.backend == 'numpy':
+            with self.stage('raycast'):
+                if drrArray is None:
+                    drrArray = raycast.raycast_drr(self.inputImage,self.transform,self.focalPoint,self.originOutput,self.sizeOutput,self.spaceOutput,self.directionOutput,self.threshold,points=self.detectorPoints,occupancy=self.occupancy,**self.raycastOptions)
+                raycastArray = itk.array_view_from_image(self.raycastOutput)
+                raycastArray[:] = raycast.cast_ray_sums(np.reshape(drrArray,raycastArray.shape),raycastArray.dtype)     # Clamped to the output pixel type, as by the resample filter
+                self.raycastOutput.Modified()       # The buffer was changed in place, let the rescaler know.
+        else:
+            self.resamplefilter.Modified()      # The transform was changed in place, force the resampling.
+            if self.profiler is not None:
+                with self.stage('resample'):
+                    self.resamplefilter.UpdateLargestPossibleRegion()
+
+        if self.fused:
+            if self.backend == 'itk' and self.profiler is None:
+                self.resamplefilter.UpdateLargestPossibleRegion()
+            with self.stage('output'):
+                self.fused_output(self.get_raycast_array())
+            last_filter_output = self.outputImage
+        else:
+            if self.profiler is not None:           # Update the filters one by one to time them separately
+                with self.stage('rescale'):
+                    self.rescaler.Update()
+            with self.stage('flip'):
+                self.flipfilter.Update()
+            last_filter_output = self.flipfilter.GetOutput()
+
+        if self.verbose and self.backend == 'itk':
+            print(self.resamplefilter)
+
+        if output_filename is not None:
+            with self.stage('write'):
+                self.write(output_filename)
+
+        return last_filter_output
+
+    def render_gradient(self,rot,t):
+        '''Render the DRR for the pose (rot, t) with its derivatives with respect to the pose (numpy backend).
+
+        The derivatives are those of the ray sums (get_raycast_array) with
+        respect to [rx, ry, rz, tx, ty, tz], computed in the same traversal
+        of the rays, see raycast.cast_rays_gradient. The pipeline output is
+        updated as by render.
+
+        Returns the [z,y,x] ray sums and the (6, z, y, x) derivatives.'''
+        if self.backend != 'numpy':
+            raise ValueError('Pose derivatives need the "numpy" backend.')
+        self.set_pose(rot,t)
+        with self.stage('raycast_gradient'):
+            matrix_derivatives, offset_derivatives = get_drr_transform_derivatives(self.transform,self.inputImage)
+            drrArray, gradient = raycast.raycast_drr_gradient(self.inputImage,self.transform,self.focalPoint,self.detectorPoints,self.threshold,
+                                                              matrix_derivatives,offset_derivatives,occupancy=self.occupancy,
+                                                              slope=self.rescale[0],intercept=self.rescale[1])
+        shape = [int(s) for s in self.sizeOutput][::-1]
+        self.update(drrArray=drrArray)
+        return np.reshape(drrArray,shape), np.reshape(gradient,[6]+shape)
+
+    def fused_output(self,raycastArray,rows=64):
+        '''Rescale to 0-255 and flip the ray sums into the output image in one pass.
+
+        The minimum and maximum are those of the whole image, then the
+        rows are rescaled in blocks, as RescaleIntensityImageFilter does
+        (in double, clamped, cast to the output pixel type), and written
+        to their flipped position, so no full-size intermediate image is
+        allocated.'''
+        minimum, maximum = float(raycastArray.min()), float(raycastArray.max())
+        if minimum != maximum:
+            scale = 255./(maximum-minimum)
+        elif maximum != 0:
+            scale = 255./maximum
+        else:
+            scale = 0.
+        shift = -minimum*scale
+        self.intensityRange = (minimum,maximum)
+
+        if self.get_flip_state() != self.flipState:
+            self.update_output_geometry()       # The flip axes were changed on the flip filter
+        flipAxes = self.flipState[0]
+        output = self.outputArray[tuple(slice(None,None,-1 if flipAxes[2-axis] else None) for axis in range(3))]  # Flip as a view of the output, indexed [z,y,x]
+        source = raycastArray.reshape(output.shape)
+        block = np.empty((output.shape[0],min(rows,output.shape[1]),output.shape[2]))
+        for first in range(0,output.shape[1],rows):
+            values = block[:,:source.shape[1]-first] if first+rows > source.shape[1] else block
+            values[:] = source[:,first:first+rows]      # In double, as the rescaler
+            values *= scale
+            values += shift
+            np.clip(values,0.,255.,out=values)
+            np.copyto(output[:,first:first+rows],values,casting='unsafe')
+        self.outputImage.Modified()
+
+    def get_flip_state(self):
+        '''Flip axes and flip about origin of the flip filter, which set the pixels and geometry of the output.'''
+        return tuple(bool(axis) for axis in self.flipfilter.GetFlipAxes()), bool(self.flipfilter.GetFlipAboutOrigin())
+
+    def update_output_geometry(self):
+        '''Copy the geometry of the flip filter output to the fused output image.'''
+        self.flipfilter.UpdateOutputInformation()
+        self.outputImage.CopyInformation(self.flipfilter.GetOutput())
+        self.flipState = self.get_flip_state()
+
+    def get_output(self):
+        '''Output image of the pipeline, holding the last rendered DRR.'''
+        return self.outputImage if self.fused else self.flipfilter.GetOutput()
+
+    def get_raycast_array(self):
+        '''View of the ray sums of the last render, before rescaling, indexed [z,y,x].'''
+        if self.backend == 'numpy':
+            return itk.array_view_from_image(self.raycastOutput)
+        return itk.array_view_from_image(self.resamplefilter.GetOutput())
+
+    def get_intensity_range(self):
+        '''Minimum and maximum of the last ray cast image, as mapped to 0-255 by the rescaler.'''
+        if self.fused:
+            return self.intensityRange
+        return self.rescaler.GetInputMinimum(), self.rescaler.GetInputMaximum()
+
+    def get_cache_backend(self):
+        '''Backend in the cache keys, with the precision and rescale when they are not the defaults.'''
+        if self.precision == 'double' and self.rescale == (1.,0.):
+            return self.backend
+        return '{} {} {} {}'.format(self.backend,self.precision,*self.rescale)
+
+    def render_array(self,rot,t,output_filename=None):
+        '''Render the DRR for the pose (rot, t) into a new array, through the cache if there is one.
+
+        Returns the [z,y,x] array and the intensity range before rescaling.'''
+        if self.cache is None:
+            image = self.render(rot,t,output_filename)
+            return itk.array_from_image(image), self.get_intensity_range()
+
+        key = drr_cache.get_drr_key(drr_cache.get_volume_digest(self.inputImage),rot,t,self.focalPoint,self.originOutput,self.sizeOutput,
+                                    self.spaceOutput,self.directionOutput,self.threshold,self.get_cache_backend(),self.outputType)
+        if self.profiler is not None:
+            self.profiler.begin_pose(rot,t)
+        with self.stage('cache'):
+            entry = self.cache.get(key)
+        if entry is None:
+            self.set_pose(rot,t,new_pose=False)
+            image = self.update(output_filename)
+            entry = (itk.array_from_image(image), self.get_intensity_range())
+            self.cache.put(key,entry[0],entry[1])
+        elif output_filename is not None:
+            image = itk.image_from_array(entry[0])      # Same geometry as the output of the pipeline
+            self.flipfilter.UpdateOutputInformation()
+            image.CopyInformation(self.flipfilter.GetOutput())
+            with self.stage('write'):
+                self.write(output_filename,image)
+        return entry
+
+    def render_batch(self,poses,output_filenames=None,return_range=False):
+        '''Render a batch of poses into an (N, H, W) array.
+
+        poses is an N x 6 array of [rx, ry, rz, tx, ty, tz]. Files are only
+        written if output_filenames (one per pose) is given. With
+        return_range the (N, 2) minimum and maximum of every ray cast
+        image before rescaling are returned as well.'''
+        poses = np.atleast_2d(np.asarray(poses,dtype=np.float64))
+        assert poses.shape[1] == 6, 'poses must be an N x 6 array of [rx, ry, rz, tx, ty, tz]'
+        if output_filenames is not None:
+            assert len(output_filenames) == poses.shape[0], 'One output file name is needed per pose'
+
+        images = None
+        ranges = np.zeros((poses.shape[0],2))
+        for index, pose in enumerate(poses):
+            output_filename = None if output_filenames is None else output_filenames[index]
+            if self.cache is None:
+                image = itk.array_view_from_image(self.render(pose[:3],pose[3:],output_filename))   # No copy, it is copied into images
+                ranges[index] = self.get_intensity_range()
+            else:
+                image, ranges[index] = self.render_array(pose[:3],pose[3:],output_filename)
+            image = image.reshape(image.shape[-2:]) # Drop the single slice of the detector
+            if images is None:
+                images = np.empty((poses.shape[0],)+image.shape,dtype=image.dtype)
+            images[index] = image
+
+        if return_range:
+            return images, ranges
+        return images
+
+    def write(self,output_filename,image=None):
+        '''Write the last rendered DRR, or the given image, to output_filename.'''
+        if self.writer_queue is not None:
+            if image is None:
+                self.writer_queue.submit(self.get_output(),output_filename)   # Copied, the pipeline output is reused by the next render.
+            else:
+                self.writer_queue.submit(image,output_filename,copy=False)
+            return
+
+        self.writer.SetInput(self.get_output() if image is None else image)
+        self.writer.SetFileName(output_filename)
+
         print("Writing image: " + output_filename)
-        writer.Update()
+        try:
+            self.writer.Update()
+        except (RuntimeError, ValueError) as error:     # ITK raises its ExceptionObject as RuntimeError
+            raise IOError('Failed to write {}: {}'.format(output_filename, error))
         print("Image Printed Successfully")
-    except ValueError: 
-        print("ERROR: ExceptionObject cauth! \n")
-        print(ValueError)
-        sys.exit()
-    
-    if verbose: 
-        print('Details of image: ')
-        print(last_filter_output)
-          
+
+        if self.verbose:
+            print('Details of image: ')
+            print(self.get_output())
+
+def drr(inputImage,output_filename,rot,t,focalPoint,originOutput,sizeOutput,cor,spaceOutput,directionOutput,threshold,InputImageType,OutputImageType,verbose,backend='itk',profiler=None,precision='double'):
+    # Single pose DRR. Use DRRRenderer directly to render many poses of the same volume and detector.
+    # profiler : a profiler.PipelineProfiler recording the time of every stage.
+    # precision : 'double' or 'single' ray sums with the numpy backend, see DRRRenderer.
+    renderer = DRRRenderer(inputImage,focalPoint,originOutput,sizeOutput,spaceOutput,directionOutput,threshold,InputImageType,OutputImageType,verbose,backend,profiler=profiler,precision=precision)
+    renderer.render(rot,t,output_filename)
+
+def drr_batch(inputImage,poses,focalPoint,originOutput,sizeOutput,spaceOutput,directionOutput,threshold,InputImageType,OutputImageType,output_filenames=None,return_range=False,backend='itk',writer_queue=None,cache=None,profiler=None,precision='double'):
+    # In-memory DRRs of an N x 6 array of poses [rx, ry, rz, tx, ty, tz], returned as an (N, H, W) array.
+    # Files are only written when output_filenames is given, in the background if a writer_queue is given.
+    # Poses found in the cache (a drr_cache.DRRCache) are not rendered again. See DRRRenderer.render_batch.
+    renderer = DRRRenderer(inputImage,focalPoint,originOutput,sizeOutput,spaceOutput,directionOutput,threshold,InputImageType,OutputImageType,False,backend,writer_queue,cache,profiler=profiler,precision=precision)
+    return renderer.render_batch(poses,output_filenames,return_range)
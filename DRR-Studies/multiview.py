@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+'''Render several cameras (e.g. stereo fluoroscopy) of one pose together
+
+All cameras share the volume and a single transform, so the pose is set
+once for every view. With the numpy backend the rays of all the cameras
+are cast in one batch through the volume.
+'''
+
+import itk
+import numpy as np
+import main_functions
+import raycast
+
+def make_camera(focalPoint, originOutput, sizeOutput, spaceOutput, directionOutput):
+    '''Group the geometry of one camera.
+
+    Args:
+        focalPoint (list):          Location of the x-ray source (x,y,z)
+        originOutput (list):        Origin of the output image (x,y,z)
+        sizeOutput (list):          Size of the output image (x,y,z)
+        spaceOutput (list):         Spacing of the output image (x,y,z)
+        directionOutput (np.array): Direction matrix of the output image
+
+    Returns:
+        dict:                       The camera
+    '''
+    return {
+        'focalPoint':       focalPoint,
+        'originOutput':     originOutput,
+        'sizeOutput':       sizeOutput,
+        'spaceOutput':      spaceOutput,
+        'directionOutput':  directionOutput,
+    }
+
+class MultiViewRenderer(object):
+    '''Render the DRRs of several cameras for many poses.
+
+    Args:
+        inputImage (itk.Image):     3D input volume
+        cameras (list):             Camera dicts, see make_camera
+        threshold (float):          Only intensities above the threshold are integrated
+        InputImageType:             ITK type of the input image
+        OutputImageType:            ITK type of the output images
+        verbose (bool):             Print the details of the pipelines
+        backend (string):           'itk' or 'numpy', see main_functions.DRRRenderer
+        writer_queue (WriterQueue): Write the files in the background, see writer_queue.py
+        profiler (PipelineProfiler):Record the stages of all the cameras, see profiler.py
+    '''
+    def __init__(self, inputImage, cameras, threshold, InputImageType, OutputImageType, verbose=False, backend='itk', writer_queue=None, profiler=None):
+        self.inputImage = inputImage
+        self.profiler   = profiler
+        self.cameras    = cameras
+        self.threshold  = threshold
+        self.backend    = backend
+
+        TransformType = itk.CenteredEuler3DTransform[itk.D]
+        self.transform = TransformType.New()
+        main_functions.set_drr_transform(self.transform, inputImage, [0., 0., 0.], [0., 0., 0.])
+
+        self.renderers = [main_functions.DRRRenderer(inputImage, camera['focalPoint'], camera['originOutput'], camera['sizeOutput'],
+                                                     camera['spaceOutput'], camera['directionOutput'], threshold, InputImageType,
+                                                     OutputImageType, verbose, backend, writer_queue, transform=self.transform,
+                                                     profiler=profiler)
+                          for camera in cameras]
+
+        if backend == 'numpy':
+            # Detector points of all the cameras, cast as one batch
+            self.points = np.concatenate([renderer.detectorPoints for renderer in self.renderers])
+            self.counts = [renderer.detectorPoints.shape[0] for renderer in self.renderers]
+            self.focalPoints = np.array([camera['focalPoint'] for camera in cameras], dtype=np.float64)
+
+    def set_pose(self, rot, t):
+        '''Update the shared transform for a new pose.'''
+        self.renderers[0].set_pose(rot, t)     # Shared by all the renderers
+
+    def render(self, rot, t, output_filenames=None):
+        '''Render every camera for the pose (rot, t).
+
+        The returned images belong to the pipelines and are overwritten by
+        the next call to render.
+
+        Args:
+            rot (list):                 Rotation in degrees in x, y and z
+            t (list):                   Translation in x, y and z
+            output_filenames (list):    One file name per camera, or None to not write files
+
+        Returns:
+            list:                       One itk.Image per camera
+        '''
+        if output_filenames is None:
+            output_filenames = [None] * len(self.renderers)
+        assert len(output_filenames) == len(self.renderers), 'One output file name is needed per camera'
+
+        self.set_pose(rot, t)
+        if self.backend == 'numpy':
+            with self.renderers[0].stage('raycast_views'):
+                matrix, offset = raycast.get_transform_matrix_offset(self.transform)
+                sources = self.points.dot(matrix.T) + offset
+                targets = np.repeat(self.focalPoints.dot(matrix.T) + offset, self.counts, axis=0)
+                integral = raycast.cast_rays(itk.array_view_from_image(self.inputImage), self.inputImage.GetOrigin(),
+                                             self.inputImage.GetSpacing(), sources, targets, self.threshold,
+                                             occupancy=self.renderers[0].occupancy, **self.renderers[0].raycastOptions)
+                drrArrays = np.split(integral, np.cumsum(self.counts)[:-1])
+        else:
+            drrArrays = [None] * len(self.renderers)
+
+        return [renderer.update(output_filename, drrArray)
+                for renderer, output_filename, drrArray in zip(self.renderers, output_filenames, drrArrays)]
+
+    def render_arrays(self, rot, t, output_filenames=None):
+        '''Render every camera for the pose (rot, t) into new [z,y,x] arrays.'''
+        return [itk.array_from_image(image) for image in self.render(rot, t, output_filenames)]
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+'''Per-stage timing and memory instrumentation of the DRR pipeline
+
+A PipelineProfiler given to main_functions.DRRRenderer records one event
+per stage (transform, raycast or resample, output or rescale and flip, write) and pose
+with its wall time, CPU time and memory:
+
+    profiler = PipelineProfiler(track_memory=True)
+    renderer = main_functions.DRRRenderer(..., profiler=profiler)
+    renderer.render_batch(poses)
+    print(profiler.report())
+    profiler.export_chrome_trace('drr_trace.json')
+
+The trace can be opened in chrome://tracing or https://ui.perfetto.dev.
+Hooks added with add_hook are called with every event as it completes.
+
+Memory is reported two ways. allocated_bytes is the peak of the Python and
+NumPy allocations during the stage (tracemalloc, Python 3 only, with
+track_memory). rss_bytes is the change of the resident memory of the
+process, which includes the ITK buffers (Linux only).
+'''
+
+import os
+import time
+import json
+import threading
+from timeit import default_timer as timer
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+try:
+    cpu_timer = time.process_time
+except AttributeError:  # Python 2
+    cpu_timer = time.clock
+
+def get_rss_bytes():
+    '''Resident memory of this process in bytes, None if unknown.'''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+class NullStage(object):
+    '''Context manager doing nothing, used when no profiler is given.'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+class Stage(object):
+    '''Context manager measuring one stage for a PipelineProfiler.'''
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.memory = self.profiler.track_memory and tracemalloc is not None and tracemalloc.is_tracing()
+        if self.memory:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self.traced = tracemalloc.get_traced_memory()[0]
+        self.rss = get_rss_bytes()
+        self.cpu = cpu_timer()
+        self.start = timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = timer() - self.start
+        cpu = cpu_timer() - self.cpu
+        rss = get_rss_bytes()
+        event = {
+            'stage':        self.name,
+            'pose':         self.profiler.pose,
+            'start':        self.start - self.profiler.origin,
+            'wall':         wall,
+            'cpu':          cpu,
+            'rss_bytes':    None if rss is None or self.rss is None else rss - self.rss,
+            'allocated_bytes': tracemalloc.get_traced_memory()[1] - self.traced if self.memory else None,
+            'thread':       threading.current_thread().name,
+            'args':         self.args,
+        }
+        self.profiler.record(event)
+        return False
+
+class PipelineProfiler(object):
+    '''Record the stages of the DRR pipeline.
+
+    Args:
+        track_memory (bool):    Trace the Python and NumPy allocations with tracemalloc (slower)
+    '''
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.events = []
+        self.hooks = []
+        self.pose = None
+        self.poses = []
+        self.origin = timer()
+        self.lock = threading.Lock()
+        if track_memory and tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def add_hook(self, hook):
+        '''Call hook(event) for every completed stage. The event is a dict, see Stage.'''
+        self.hooks.append(hook)
+
+    def begin_pose(self, rot, t):
+        '''Start a new pose. The next stages are attributed to it.'''
+        with self.lock:
+            self.poses.append({'rot': [float(value) for value in rot], 't': [float(value) for value in t]})
+            self.pose = len(self.poses) - 1
+
+    def stage(self, name, **args):
+        '''Context manager measuring the stage name of the current pose.'''
+        return Stage(self, name, args)
+
+    def record(self, event):
+        '''Store an event and pass it to the hooks.'''
+        with self.lock:
+            self.events.append(event)
+        for hook in self.hooks:
+            hook(event)
+
+    def clear(self):
+        '''Forget the recorded events and poses.'''
+        with self.lock:
+            self.events = []
+            self.poses = []
+            self.pose = None
+            self.origin = timer()
+
+    def summary(self):
+        '''Totals per stage.
+
+        Returns:
+            dict:   For every stage the number of events and the total and mean wall and CPU times
+        '''
+        stages = {}
+        for event in self.events:
+            stage = stages.setdefault(event['stage'], {'count': 0, 'wall': 0., 'cpu': 0., 'rss_bytes': 0, 'allocated_bytes': 0})
+            stage['count'] += 1
+            stage['wall'] += event['wall']
+            stage['cpu'] += event['cpu']
+            stage['rss_bytes'] += event['rss_bytes'] or 0
+            stage['allocated_bytes'] = max(stage['allocated_bytes'], event['allocated_bytes'] or 0)
+        for stage in stages.values():
+            stage['mean_wall'] = stage['wall'] / stage['count']
+            stage['mean_cpu'] = stage['cpu'] / stage['count']
+        return stages
+
+    def report(self):
+        '''Table of the summary, slowest stage first.'''
+        stages = self.summary()
+        total = sum(stage['wall'] for stage in stages.values()) or 1.
+        lines = ['{: <12} {: >6} {: >10} {: >10} {: >10} {: >6} {: >12}'.format('stage', 'count', 'wall [s]', 'mean [ms]', 'cpu [s]', 'wall%', 'peak alloc')]
+        for name, stage in sorted(stages.items(), key=lambda item: -item[1]['wall']):
+            lines.append('{: <12} {: >6d} {: >10.4f} {: >10.3f} {: >10.4f} {: >6.1f} {: >12d}'.format(
+                name, stage['count'], stage['wall'], 1000. * stage['mean_wall'], stage['cpu'],
+                100. * stage['wall'] / total, stage['allocated_bytes']))
+        return '\n'.join(lines)
+
+    def export_chrome_trace(self, file_name):
+        '''Write the events in the Chrome trace event format (chrome://tracing, Perfetto).'''
+        pid = os.getpid()
+        trace = []
+        for event in self.events:
+            args = dict(event['args'])
+            args.update({key: event[key] for key in ('pose', 'cpu', 'rss_bytes', 'allocated_bytes')})
+            if event['pose'] is not None:
+                args.update(self.poses[event['pose']])
+            trace.append({
+                'name':     event['stage'],
+                'cat':      'drr',
+                'ph':       'X',
+                'ts':       event['start'] * 1e6,
+                'dur':      event['wall'] * 1e6,
+                'pid':      pid,
+                'tid':      event['thread'],
+                'args':     args,
+            })
+        with open(file_name, 'w') as trace_file:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, trace_file)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+'''Multi-resolution DRR rendering
+
+The input volume is shrunk once by each factor of the pyramid (averaging
+blocks of factor^3 voxels with BinShrinkImageFilter) and the detector is
+rendered with factor times fewer pixels in x and y over the same physical
+area. A DRR at factor 4 is therefore 16 times fewer rays through a volume
+with 4 times fewer samples per ray.
+
+The ray sums are line integrals, so the levels have comparable intensities,
+apart from the partial volume blurring of the coarse levels.
+
+BinShrinkImageFilter moves the origin of the shrunk volume by
+(factor-1)/2 voxels, which would move the center of rotation of the poses
+(see main_functions.set_drr_transform) with the level. Every level is
+posed about the center of the full resolution volume instead, so a pose
+projects to the same place at every level.
+'''
+
+import itk
+import numpy as np
+import main_functions
+import rigid_transform
+
+def shrink_volume(inputImage, factor):
+    '''Shrink a volume by averaging blocks of factor^3 voxels.
+
+    The physical extent is kept. Voxels left over at the end of an axis
+    whose size is not a multiple of factor are dropped.
+
+    Args:
+        inputImage (itk.Image): The volume
+        factor (int):           Shrink factor
+
+    Returns:
+        itk.Image:              The shrunk volume
+    '''
+    if factor == 1:
+        return inputImage
+    shrinker = itk.BinShrinkImageFilter[type(inputImage), type(inputImage)].New()
+    shrinker.SetInput(inputImage)
+    shrinker.SetShrinkFactors([int(factor)] * 3)
+    shrinker.Update()
+    outputImage = shrinker.GetOutput()
+    outputImage.rescale_slope = getattr(inputImage, 'rescale_slope', 1.)        # Stored values averaged, same rescale
+    outputImage.rescale_intercept = getattr(inputImage, 'rescale_intercept', 0.)
+    return outputImage
+
+def scale_detector(originOutput, sizeOutput, spaceOutput, directionOutput, factor):
+    '''Detector geometry with factor times larger pixels in x and y.
+
+    The detector covers the same physical area. The origin moves to the
+    center of the first (larger) pixel.
+
+    Args:
+        originOutput (list):        Origin of the output image (x,y,z)
+        sizeOutput (list):          Size of the output image (x,y,z)
+        spaceOutput (list):         Spacing of the output image (x,y,z)
+        directionOutput (np.array): Direction matrix of the output image
+        factor (int):               Scale factor
+
+    Returns:
+        tuple:                      (originOutput, sizeOutput, spaceOutput)
+    '''
+    scale = np.array([factor, factor, 1], dtype=np.float64)
+    size = [max(1, int(sizeOutput[0]) // factor), max(1, int(sizeOutput[1]) // factor), int(sizeOutput[2])]
+    space = np.multiply(spaceOutput, scale)
+    shift = np.asarray(directionOutput, dtype=np.float64).dot(0.5 * (scale - 1) * np.asarray(spaceOutput, dtype=np.float64))
+    origin = np.asarray(originOutput, dtype=np.float64) + np.asarray(shift).reshape(-1)
+    return origin.tolist(), size, space.tolist()
+
+class DRRPyramid(object):
+    '''DRR renderers of one volume and detector at several resolutions.
+
+    The shrunk volumes and one DRRRenderer per level are created once.
+
+    Args:
+        inputImage (itk.Image):     3D input volume
+        focalPoint (list):          Location of the x-ray source (x,y,z)
+        originOutput (list):        Origin of the full resolution output image (x,y,z)
+        sizeOutput (list):          Size of the full resolution output image (x,y,z)
+        spaceOutput (list):         Spacing of the full resolution output image (x,y,z)
+        directionOutput (np.array): Direction matrix of the output image
+        threshold (float):          Only intensities above the threshold are integrated
+        InputImageType:             ITK type of the input image
+        OutputImageType:            ITK type of the output image
+        factors (list):             Shrink factors of the levels, 1 is the full resolution
+        backend (string):           'itk' or 'numpy', see main_functions.DRRRenderer
+    '''
+    def __init__(self, inputImage, focalPoint, originOutput, sizeOutput, spaceOutput, directionOutput, threshold,
+                 InputImageType, OutputImageType, factors=(8, 4, 2, 1), backend='itk'):
+        self.factors = sorted(set(int(factor) for factor in factors), reverse=True)   # Coarse to fine
+        self.volumes = {}
+        self.renderers = {}
+        centerImage = rigid_transform.make_reference_image(inputImage)     # Geometry of the full resolution volume, without its voxels
+        for factor in self.factors:
+            volume = shrink_volume(inputImage, factor)
+            origin, size, space = scale_detector(originOutput, sizeOutput, spaceOutput, directionOutput, factor)
+            self.volumes[factor] = volume
+            self.renderers[factor] = main_functions.DRRRenderer(volume, focalPoint, origin, size, space, directionOutput,
+                                                                threshold, InputImageType, OutputImageType, False, backend,
+                                                                centerImage=centerImage)
+
+    def render(self, rot, t, factor=None, output_filename=None):
+        '''Render the pose (rot, t) at one level.
+
+        Args:
+            rot (list):                 Rotation in degrees in x, y and z
+            t (list):                   Translation in x, y and z
+            factor (int):               Level, defaults to the coarsest
+            output_filename (string):   Optional output file
+
+        Returns:
+            np.array:                   The [z,y,x] DRR
+        '''
+        if factor is None:
+            factor = self.factors[0]
+        if factor not in self.renderers:
+            raise ValueError('No level with factor {}. The levels are {}.'.format(factor, self.factors))
+        return self.renderers[factor].render_array(rot, t, output_filename)[0]
+
+    def render_batch(self, poses, factor=None, return_range=False):
+        '''Render an N x 6 array of poses at one level, see DRRRenderer.render_batch.'''
+        if factor is None:
+            factor = self.factors[0]
+        return self.renderers[factor].render_batch(poses, return_range=return_range)
+
+    def progressive(self, rot, t, finest=1):
+        '''Render the pose (rot, t) from the coarsest level to the finest.
+
+        The images are generated one level at a time, so a caller that
+        stops iterating does not pay for the finer levels.
+
+        Args:
+            rot (list):     Rotation in degrees in x, y and z
+            t (list):       Translation in x, y and z
+            finest (int):   Factor of the last level to render
+
+        Yields:
+            tuple:          (factor, [z,y,x] DRR)
+        '''
+        for factor in self.factors:
+            if factor < finest:
+                break
+            yield factor, self.render(rot, t, factor)
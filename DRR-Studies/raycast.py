@@ -0,0 +1,653 @@
+# -*- coding: utf-8 -*-
+'''Vectorized NumPy ray casting for digitally reconstructed radiographs
+
+This is an alternative backend to itk.RayCastInterpolateImageFunction.
+Instead of evaluating the interpolator once per detector pixel, all rays
+of a detector are traversed together as batched NumPy arrays.
+
+The traversal reproduces the ray helper of the ITK interpolator so that
+both backends can be compared pixel for pixel:
+    - A point P is mapped to voxel coordinates (P - O) / S + 0.5, where
+      voxel i spans [i, i+1]. Like ITK, the direction cosines of the
+      volume are ignored by the ray caster.
+    - The ray (an infinite line) is clipped to the volume. Of the two
+      faces it crosses, the one first in ITK's face order is the start.
+    - The ray is traversed one voxel plane at a time along the axis on
+      which it moves the most, starting from the center of the voxel
+      holding the start point. The volume is bilinearly interpolated
+      within every plane.
+    - The ray is shortened until both its first sample and the position
+      one step after its last sample can be interpolated.
+    - Samples above the threshold contribute (value - threshold) and the
+      sum is scaled by the distance in mm between consecutive samples.
+
+Empty space can be skipped with an occupancy grid (build_occupancy_grid):
+every few samples of a ray are tested on the grid, and the ray is only
+integrated between the first and the last of them near voxels above the
+threshold. The skipped samples would have contributed exactly zero, so
+the DRR is identical with and without the grid. Sample k of a ray is at
+first + k * increment (not accumulated) so that it does not depend on
+where the integration starts.
+
+The samples are interpolated and summed in float64, or in float32 with
+dtype=np.float32. The volume can hold stored values, such as the int16
+values of a CT, rescaled to slope * stored + intercept (DICOM rescale
+slope and intercept) with the threshold in rescaled units. Since
+    sum max(slope * v + intercept - threshold, 0)
+        = slope * sum max(v - (threshold - intercept) / slope, 0)
+for a positive slope, the rescale is applied to the threshold and to the
+ray sums instead of every sample (see get_stored_threshold).
+
+Inside the volume both backends agree to floating point precision. The
+first and last voxel plane of a ray can differ: when a ray enters exactly
+on a voxel boundary, ITK keeps or drops that plane depending on the
+rounding of its intercept computation. Volumes with air (or values below
+the threshold) at their border give identical DRRs.
+'''
+
+import itk
+import numpy as np
+import itk_helpers as Functions
+
+def get_detector_points(originOutput, sizeOutput, spaceOutput, directionOutput):
+    '''Physical coordinates of every detector pixel.
+
+    Points follow the ITK convention P = O + D * diag(S) * I and are
+    returned in the memory order of the output image, i.e. the x index
+    varies the fastest.
+
+    Args:
+        originOutput (list):        Origin of the output image (x,y,z)
+        sizeOutput (list):          Size of the output image (x,y,z)
+        spaceOutput (list):         Spacing of the output image (x,y,z)
+        directionOutput (np.array): Direction matrix of the output image
+
+    Returns:
+        np.array:                   Nx3 array of points (x,y,z)
+    '''
+    sizeOutput = [int(s) for s in sizeOutput]
+    kk, jj, ii = np.meshgrid(np.arange(sizeOutput[2]),
+                             np.arange(sizeOutput[1]),
+                             np.arange(sizeOutput[0]), indexing='ij')
+    index = np.stack([ii.ravel(), jj.ravel(), kk.ravel()], axis=1).astype(np.float64)
+    scaled_direction = np.asarray(directionOutput, dtype=np.float64) * np.asarray(spaceOutput, dtype=np.float64)
+    return np.asarray(originOutput, dtype=np.float64) + index.dot(scaled_direction.T)
+
+def get_transform_matrix_offset(transform):
+    '''Matrix and offset of an ITK matrix offset transform.
+
+    The transform maps a point x to  M * x + offset.
+
+    Args:
+        transform (itk.MatrixOffsetTransformBase):  Input transform
+
+    Returns:
+        (np.array, np.array):   The 3x3 matrix and the offset vector
+    '''
+    matrix = Functions.get_vnl_matrix(transform.GetMatrix().GetVnlMatrix())
+    offset = np.array([transform.GetOffset()[ii] for ii in range(3)], dtype=np.float64)
+    return matrix, offset
+
+def clip_rays(size, start, direction):
+    '''Entry and exit points of rays in a volume.
+
+    Faces are tested in the order used by ITK's ray helper
+    (x=0, x=N, y=N, y=0, z=N, z=0). The start of a ray is the crossed face
+    which comes first in this order. If a ray touches more than two faces
+    (edges and corners) the two intercepts furthest apart are kept.
+
+    Args:
+        size (np.array):        Volume size (x,y,z)
+        start (np.array):       Nx3 point on each ray in voxel coordinates
+        direction (np.array):   Nx3 direction of each ray in voxel coordinates
+
+    Returns:
+        (np.array, np.array, np.array): Entry points, exit points and a mask of the rays crossing the volume
+    '''
+    face_axis = [0, 0, 1, 1, 2, 2]
+    face_value = [0., size[0], size[1], 0., size[2], 0.]
+
+    nrays = start.shape[0]
+    distance = np.full((nrays, 6), np.nan)
+    for face in range(6):
+        axis = face_axis[face]
+        others = [ii for ii in range(3) if ii != axis]
+        moving = direction[:, axis] != 0
+        along = (face_value[face] - start[moving, axis]) / direction[moving, axis]
+        inside = np.ones(along.shape, dtype=bool)
+        for other in others:
+            intercept = start[moving, other] + along * direction[moving, other]
+            inside &= (intercept >= 0) & (intercept <= size[other])
+        distance[np.nonzero(moving)[0][inside], face] = along[inside]
+
+    crossed = ~np.isnan(distance)
+    valid = crossed.sum(axis=1) >= 2
+    with np.errstate(invalid='ignore'):
+        nearest = np.where(crossed, distance, np.inf).argmin(axis=1)
+        furthest = np.where(crossed, distance, -np.inf).argmax(axis=1)
+    first_face = np.minimum(nearest, furthest)
+    last_face = np.maximum(nearest, furthest)
+
+    rows = np.arange(nrays)
+    entry = start + np.nan_to_num(distance[rows, first_face])[:, None] * direction
+    exit = start + np.nan_to_num(distance[rows, last_face])[:, None] * direction
+    return entry, exit, valid
+
+def plan_rays(size, entry, exit):
+    '''Voxel plane traversal of rays clipped to a volume.
+
+    Args:
+        size (np.array):        Volume size (x,y,z)
+        entry (np.array):       Nx3 start of the rays in voxel coordinates
+        exit (np.array):        Nx3 end of the rays in voxel coordinates
+
+    Returns:
+        (np.array, np.array, np.array, np.array): Traversal axis, position of
+            the first sample (traversal axis in voxel coordinates, in-plane
+            axes as continuous indices), increment between samples and
+            number of samples of every ray
+    '''
+    nrays = entry.shape[0]
+    rows = np.arange(nrays)
+    span = np.abs(entry - exit)
+    axis = np.where((span[:, 0] >= span[:, 1]) & (span[:, 0] >= span[:, 2]), 0,
+                    np.where(span[:, 1] >= span[:, 2], 1, 2))
+
+    entry_axis = entry[rows, axis]
+    exit_axis = exit[rows, axis]
+    sign = np.where(entry_axis < exit_axis, 1., -1.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        increment = (entry - exit) / (entry_axis - exit_axis)[:, None] * sign[:, None]
+    increment[rows, axis] = sign
+
+    # Move the start to the center of its voxel plane and express the
+    # in-plane coordinates relative to the voxel centers
+    truncated = np.trunc(entry_axis)
+    position = entry + ((truncated - entry_axis) * sign)[:, None] * increment + 0.5 * increment - 0.5
+    position[rows, axis] = truncated + 0.5 * sign
+    count = (sign * (np.trunc(exit_axis) - np.trunc(position[rows, axis]))).astype(np.intp)
+
+    # Shorten the ray until its ends can be interpolated
+    upper = np.tile(np.asarray(size) - 1, (nrays, 1))
+    upper[rows, axis] += 1
+    pending = np.arange(nrays)
+    valid = np.zeros(nrays, dtype=bool)
+    while pending.size:
+        first = np.floor(position[pending])
+        start_ok = np.all((first >= 0) & (first < upper[pending]), axis=1)
+        position[pending[~start_ok]] += increment[pending[~start_ok]]
+        count[pending[~start_ok]] -= 1
+
+        last = np.floor(position[pending] + count[pending, None] * increment[pending])
+        end_ok = np.all((last >= 0) & (last < upper[pending]), axis=1)
+        count[pending[~end_ok]] -= 1
+
+        done = start_ok & end_ok
+        valid[pending[done]] = True
+        pending = pending[~done & (count[pending] > 1)]
+
+    count[~valid] = 0
+    return axis, position, increment, count
+
+def build_occupancy_grid(volume, threshold, block_size=8):
+    '''Blocks of a volume near which a ray can pick up intensity.
+
+    The volume is divided in blocks of B^3 voxels. A block is marked if it,
+    or one of its 26 neighbours, holds a voxel above the threshold (with a
+    margin for the rounding of the interpolation weights). A sample in an
+    unmarked block, and every sample less than B samples away from it
+    along a ray, is therefore zero.
+
+    Args:
+        volume (np.array):      Volume indexed [z,y,x]
+        threshold (float):      Only intensities above the threshold are integrated
+        block_size (int):       Size B of the blocks in voxels
+
+    Returns:
+        np.array:               Boolean grid indexed [z,y,x], True for the blocks to sample
+    '''
+    block_max = volume
+    block_min = volume
+    for axis in range(3):
+        starts = np.arange(0, volume.shape[axis], block_size)
+        block_max = np.maximum.reduceat(block_max, starts, axis=axis)
+        block_min = np.minimum.reduceat(block_min, starts, axis=axis)
+
+    block_max = block_max.astype(np.float64)
+    margin = 1e-6 * np.maximum(np.abs(block_max), np.abs(block_min.astype(np.float64)))
+    occupied = block_max + margin > threshold
+
+    # Dilate by one block
+    padded = np.pad(occupied, 1, mode='constant')
+    dilated = np.zeros_like(occupied)
+    for dz in range(3):
+        for dy in range(3):
+            for dx in range(3):
+                dilated |= padded[dz:dz + occupied.shape[0], dy:dy + occupied.shape[1], dx:dx + occupied.shape[2]]
+    return dilated
+
+def get_stored_threshold(threshold, slope=1., intercept=0.):
+    '''Threshold on the stored values of a volume rescaled to slope * stored + intercept.'''
+    if slope <= 0:
+        raise ValueError('The rescale slope must be positive, not {}.'.format(slope))
+    return (threshold - intercept) / float(slope)
+
+def cast_ray_sums(values, dtype):
+    '''Convert ray sums to the pixel type of an output image.
+
+    Integer types are clamped to their range before the cast (truncation
+    towards zero), as ResampleImageFilter does, instead of wrapping around.
+    '''
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        limits = np.iinfo(dtype)
+        values = np.clip(values, limits.min, limits.max)
+    return np.asarray(values).astype(dtype)
+
+def cast_rays(volume, origin, spacing, sources, targets, threshold, chunk_size=65536, occupancy=None, block_size=8,
+              dtype=np.float64, slope=1., intercept=0.):
+    '''Integrate a volume along a batch of rays.
+
+    The rays are infinite lines through the source and target points; only
+    the part inside the volume contributes. See the module documentation
+    for the sampling scheme.
+
+    Args:
+        volume (np.array):      Volume indexed [z,y,x], e.g. from itk.array_view_from_image
+        origin (list):          Origin of the volume (x,y,z)
+        spacing (list):         Spacing of the volume (x,y,z)
+        sources (np.array):     Nx3 array of ray start points (x,y,z)
+        targets (np.array):     Nx3 array, or a single point, the rays point towards
+        threshold (float):      Only intensities above the threshold are integrated
+        chunk_size (int):       Number of rays integrated together
+        occupancy (np.array):   Grid from build_occupancy_grid to skip empty space, or None
+        block_size (int):       Block size of the occupancy grid
+        dtype:                  Type in which the samples are interpolated and summed, np.float64 or np.float32
+        slope (float):          Rescale slope of the stored values of the volume
+        intercept (float):      Rescale intercept of the stored values of the volume
+
+    Returns:
+        np.array:               Line integral for every ray (N,), of type dtype
+    '''
+    threshold = get_stored_threshold(threshold, slope, intercept)
+    origin = np.asarray(origin, dtype=np.float64)
+    spacing = np.asarray(spacing, dtype=np.float64)
+    sources = np.asarray(sources, dtype=np.float64).reshape(-1, 3)
+
+    # Rays in voxel coordinates
+    start = (sources - origin) / spacing + 0.5
+    direction = (np.asarray(targets, dtype=np.float64) - origin) / spacing + 0.5 - start
+    direction = np.ascontiguousarray(np.broadcast_to(direction, start.shape))
+
+    size = np.array(volume.shape[::-1])
+    strides = np.array([1, size[0], size[0] * size[1]])
+    flat_volume = volume.reshape(-1)
+
+    integral = np.zeros(start.shape[0], dtype=dtype)
+    for first in range(0, start.shape[0], chunk_size):
+        chunk = slice(first, first + chunk_size)
+        entry, exit, crossing = clip_rays(size, start[chunk], direction[chunk])
+        rays = np.nonzero(crossing)[0]
+        axis, position, increment, count = plan_rays(size, entry[rays], exit[rays])
+        if occupancy is None:
+            total = integrate_rays(flat_volume, strides, axis, position, increment, count, threshold, dtype=dtype)
+        else:
+            first_sample, occupied = find_occupied_samples(position, increment, count, occupancy, block_size)
+            total = integrate_rays(flat_volume, strides, axis, position, increment, occupied, threshold, first_sample, dtype=dtype)
+
+        # Distance in mm between two samples
+        step = np.sqrt(np.sum((increment * spacing) ** 2, axis=1))
+        integral[first + rays] = total * step
+    if slope != 1.:
+        integral *= slope
+    return integral
+
+def integrate_rays(flat_volume, strides, axis, position, increment, count, threshold, first=None, moments=False, dtype=np.float64):
+    '''Sum of the thresholded samples along planned rays.
+
+    Sample k of a ray is at position + k * increment. With first, the
+    samples first to first + count - 1 are integrated.
+
+    With moments, the in-plane derivatives of the samples (see
+    sample_rays_gradient) are summed as well, as the Mx4 array
+    [sum du, sum k * du, sum dv, sum k * dv] with u and v the in-plane
+    axes in increasing order.
+
+    Args:
+        flat_volume (np.array): Raveled volume
+        strides (np.array):     Flat strides of the volume (x,y,z)
+        axis (np.array):        Traversal axis of every ray
+        position (np.array):    Mx3 position of the first sample
+        increment (np.array):   Mx3 increment between samples
+        count (np.array):       Number of samples of every ray
+        threshold (float):      Only intensities above the threshold are integrated
+        first (np.array):       Index of the first sample of every ray, 0 if None
+        moments (bool):         Also sum the derivatives of the samples
+        dtype:                  Type in which the samples are interpolated and summed (np.float64 with moments)
+
+    Returns:
+        np.array:               Unscaled sum for every ray (M,), and the
+                                Mx4 moments of the derivatives with moments
+    '''
+    if first is None:
+        first = np.zeros(axis.shape[0], dtype=np.intp)
+    total = np.zeros(axis.shape[0], dtype=dtype)
+    total_moments = np.zeros((axis.shape[0], 4), dtype=np.float64)
+    for traversal in range(3):
+        u_axis, v_axis = [ii for ii in range(3) if ii != traversal]
+
+        # Longest rays first so that the rays still sampled are a prefix
+        rays = np.nonzero((axis == traversal) & (count > 0))[0]
+        rays = rays[np.argsort(-count[rays], kind='stable')]
+        if rays.size == 0:
+            continue
+        remaining = count[rays]
+        start = position[rays]
+        step = increment[rays]
+        skipped = first[rays]
+        group_total = np.zeros(rays.size, dtype=dtype)
+        group_moments = np.zeros((rays.size, 4), dtype=np.float64)
+
+        for sample in range(remaining[0]):
+            active = np.searchsorted(-remaining, -sample, side='left')
+            index = skipped[:active] + sample
+            point = start[:active] + index[:, None] * step[:active]
+            if moments:
+                value, du, dv = sample_rays_gradient(flat_volume, strides, u_axis, v_axis, point, threshold)
+                group_moments[:active, 0] += du
+                group_moments[:active, 1] += index * du
+                group_moments[:active, 2] += dv
+                group_moments[:active, 3] += index * dv
+            else:
+                value = sample_rays(flat_volume, strides, u_axis, v_axis, point, threshold, dtype)
+            group_total[:active] += value
+
+        total[rays] = group_total
+        total_moments[rays] = group_moments
+    if moments:
+        return total, total_moments
+    return total
+
+def find_occupied_samples(position, increment, count, occupancy, block_size):
+    '''Range of the samples of planned rays which can be above the threshold.
+
+    Every block_size-th sample of a ray is tested on the occupancy grid. A
+    sample moves at most one voxel per axis from one sample to the next,
+    so when the tested sample is in an unmarked block the block_size
+    samples from it on are all zero.
+
+    Args:
+        position (np.array):    Mx3 position of the first sample
+        increment (np.array):   Mx3 increment between samples
+        count (np.array):       Number of samples of every ray
+        occupancy (np.array):   Grid from build_occupancy_grid
+        block_size (int):       Block size of the occupancy grid
+
+    Returns:
+        (np.array, np.array):   Index of the first sample to integrate and
+            number of samples to integrate from there (0 for rays which
+            only cross empty space)
+    '''
+    flat_occupancy = occupancy.reshape(-1)
+    block_strides = np.array([1, occupancy.shape[2], occupancy.shape[2] * occupancy.shape[1]])
+
+    first = count.copy()
+    last = np.full(count.shape, -1, dtype=count.dtype)
+    if count.size == 0:
+        return first, count.copy()
+    for sample in range(0, count.max(), block_size):
+        rays = np.nonzero(count > sample)[0]
+        point = position[rays] + sample * increment[rays]     # Same sample positions as the integration
+        block = (np.floor(point) // block_size).astype(np.intp)
+        rays = rays[flat_occupancy[block.dot(block_strides)]]
+        first[rays] = np.minimum(first[rays], sample)
+        last[rays] = np.minimum(sample + block_size - 1, count[rays] - 1)
+    return first, np.maximum(last - first + 1, 0)
+
+def sample_rays(flat_volume, strides, u_axis, v_axis, point, threshold, dtype=np.float64):
+    '''Thresholded bilinear samples of the volume.
+
+    The positions are in float64, the weights and the samples in dtype.
+
+    Args:
+        flat_volume (np.array): Raveled volume
+        strides (np.array):     Flat strides of the volume (x,y,z)
+        u_axis (int):           First in-plane axis
+        v_axis (int):           Second in-plane axis
+        point (np.array):       Mx3 sample positions, see plan_rays
+        threshold (float):      Only intensities above the threshold are integrated
+        dtype:                  Type of the interpolation
+
+    Returns:
+        np.array:               Contribution of every sample (M,)
+    '''
+    corner = np.floor(point)
+    fraction = point - corner
+    corner = corner.astype(np.intp)
+    base = corner.dot(strides)
+    fu = fraction[:, u_axis].astype(dtype)
+    fv = fraction[:, v_axis].astype(dtype)
+    value = ((1. - fu) * (1. - fv) * flat_volume[base]
+             + fu * (1. - fv) * flat_volume[base + strides[u_axis]]
+             + (1. - fu) * fv * flat_volume[base + strides[v_axis]]
+             + fu * fv * flat_volume[base + strides[u_axis] + strides[v_axis]])
+    if value.dtype != dtype:        # A float64 volume
+        value = value.astype(dtype)
+
+    value -= threshold
+    np.maximum(value, 0., out=value)
+    return value
+
+def sample_rays_gradient(flat_volume, strides, u_axis, v_axis, point, threshold):
+    '''Thresholded bilinear samples of the volume and their in-plane derivatives.
+
+    The derivatives are those of the bilinear interpolation, in intensity
+    per voxel along u_axis and v_axis, and are 0 where the sample is not
+    above the threshold.
+
+    Args:
+        flat_volume (np.array): Raveled volume
+        strides (np.array):     Flat strides of the volume (x,y,z)
+        u_axis (int):           First in-plane axis
+        v_axis (int):           Second in-plane axis
+        point (np.array):       Mx3 sample positions, see plan_rays
+        threshold (float):      Only intensities above the threshold are integrated
+
+    Returns:
+        (np.array, np.array, np.array): Contribution of every sample (M,) and its derivatives along u and v
+    '''
+    corner = np.floor(point)
+    fraction = point - corner
+    corner = corner.astype(np.intp)
+    base = corner.dot(strides)
+    fu = fraction[:, u_axis]
+    fv = fraction[:, v_axis]
+    v00 = flat_volume[base]
+    v10 = flat_volume[base + strides[u_axis]]
+    v01 = flat_volume[base + strides[v_axis]]
+    v11 = flat_volume[base + strides[u_axis] + strides[v_axis]]
+    value = (1. - fu) * (1. - fv) * v00 + fu * (1. - fv) * v10 + (1. - fu) * fv * v01 + fu * fv * v11
+
+    value -= threshold
+    above = value > 0.
+    np.maximum(value, 0., out=value)
+    du = np.where(above, (1. - fv) * (v10 - v00) + fv * (v11 - v01), 0.)
+    dv = np.where(above, (1. - fu) * (v01 - v00) + fu * (v11 - v10), 0.)
+    return value, du, dv
+
+def cast_rays_gradient(volume, origin, spacing, sources, targets, source_derivatives, target_derivatives, threshold,
+                       chunk_size=65536, occupancy=None, block_size=8, slope=1., intercept=0.):
+    '''Integrate a volume along a batch of rays, with the derivatives of the integrals.
+
+    The rays move with P parameters: source_derivatives and
+    target_derivatives give the derivatives of the source and target
+    points. Every sample stays in its voxel plane and slides within it, so
+    the derivative of a sample is the in-plane gradient of the bilinear
+    interpolation times the in-plane displacement, and the derivative of
+    the distance between samples is added. This is the exact derivative of
+    cast_rays except where a ray gains or loses a sample (volume border)
+    or a sample crosses the threshold or a voxel boundary.
+
+    Args:
+        volume (np.array):              Volume indexed [z,y,x]
+        origin (list):                  Origin of the volume (x,y,z)
+        spacing (list):                 Spacing of the volume (x,y,z)
+        sources (np.array):             Nx3 array of ray start points (x,y,z)
+        targets (np.array):             Nx3 array, or a single point, the rays point towards
+        source_derivatives (np.array):  NxPx3 derivatives of the sources
+        target_derivatives (np.array):  NxPx3, or Px3 for a single target, derivatives of the targets
+        threshold (float):              Only intensities above the threshold are integrated
+        chunk_size (int):               Number of rays integrated together
+        occupancy (np.array):           Grid from build_occupancy_grid to skip empty space, or None
+        block_size (int):               Block size of the occupancy grid
+        slope (float):                  Rescale slope of the stored values of the volume
+        intercept (float):              Rescale intercept of the stored values of the volume
+
+    Returns:
+        (np.array, np.array):           Line integral for every ray (N,) and its derivatives (N,P), in float64
+    '''
+    threshold = get_stored_threshold(threshold, slope, intercept)
+    origin = np.asarray(origin, dtype=np.float64)
+    spacing = np.asarray(spacing, dtype=np.float64)
+    sources = np.asarray(sources, dtype=np.float64).reshape(-1, 3)
+    source_derivatives = np.asarray(source_derivatives, dtype=np.float64).reshape(sources.shape[0], -1, 3)
+    nparameters = source_derivatives.shape[1]
+
+    # Rays and their derivatives in voxel coordinates
+    start = (sources - origin) / spacing + 0.5
+    direction = (np.asarray(targets, dtype=np.float64) - origin) / spacing + 0.5 - start
+    direction = np.ascontiguousarray(np.broadcast_to(direction, start.shape))
+    start_derivatives = source_derivatives / spacing
+    direction_derivatives = np.broadcast_to(np.asarray(target_derivatives, dtype=np.float64) / spacing, start_derivatives.shape) - start_derivatives
+
+    size = np.array(volume.shape[::-1])
+    strides = np.array([1, size[0], size[0] * size[1]])
+    flat_volume = volume.reshape(-1)
+
+    integral = np.zeros(start.shape[0], dtype=np.float64)
+    gradient = np.zeros((start.shape[0], nparameters), dtype=np.float64)
+    for first in range(0, start.shape[0], chunk_size):
+        chunk = slice(first, first + chunk_size)
+        entry, exit, crossing = clip_rays(size, start[chunk], direction[chunk])
+        rays = np.nonzero(crossing)[0]
+        axis, position, increment, count = plan_rays(size, entry[rays], exit[rays])
+        if occupancy is None:
+            total, moments = integrate_rays(flat_volume, strides, axis, position, increment, count, threshold, moments=True)
+        else:
+            first_sample, occupied = find_occupied_samples(position, increment, count, occupancy, block_size)
+            total, moments = integrate_rays(flat_volume, strides, axis, position, increment, occupied, threshold, first_sample, moments=True)
+
+        step = np.sqrt(np.sum((increment * spacing) ** 2, axis=1))
+        integral[first + rays] = total * step
+
+        # Line parameter of sample k: lambda0 + k * delta, along start + lambda * direction
+        rows = np.arange(rays.size)
+        ray_start = start[chunk][rays]
+        ray_direction = direction[chunk][rays]
+        ray_start_derivatives = start_derivatives[chunk][rays]
+        ray_direction_derivatives = direction_derivatives[chunk][rays]
+        direction_axis = ray_direction[rows, axis]
+        delta = increment[rows, axis] / direction_axis
+        lambda0 = (position[rows, axis] - ray_start[rows, axis]) / direction_axis
+
+        # Displacement within its plane of the sample at lambda: a + lambda * b
+        ray_gradient = np.zeros((rays.size, nparameters), dtype=np.float64)
+        start_axis = ray_start_derivatives[rows, :, axis]
+        direction_derivative_axis = ray_direction_derivatives[rows, :, axis]
+        for traversal in range(3):
+            group = axis == traversal
+            u_axis, v_axis = [ii for ii in range(3) if ii != traversal]
+            for in_plane, column in ((u_axis, 0), (v_axis, 2)):
+                ratio = (ray_direction[group, in_plane] / direction_axis[group])[:, None]
+                a = ray_start_derivatives[group, :, in_plane] - start_axis[group] * ratio
+                b = ray_direction_derivatives[group, :, in_plane] - direction_derivative_axis[group] * ratio
+                sum_derivative = moments[group, column][:, None]
+                sum_lambda_derivative = (lambda0[group][:, None] * sum_derivative + delta[group][:, None] * moments[group, column + 1][:, None])
+                ray_gradient[group] += a * sum_derivative + b * sum_lambda_derivative
+
+        # Derivative of the distance between samples
+        scaled_direction = ray_direction * spacing
+        scaled_derivatives = ray_direction_derivatives * spacing
+        step_derivatives = step[:, None] * (np.einsum('ri,rpi->rp', scaled_direction, scaled_derivatives) / np.sum(scaled_direction ** 2, axis=1)[:, None]
+                                            - direction_derivative_axis / direction_axis[:, None])
+        gradient[first + rays] = ray_gradient * step[:, None] + total[:, None] * step_derivatives
+    if slope != 1.:
+        integral *= slope
+        gradient *= slope
+    return integral, gradient
+
+def raycast_drr(inputImage, transform, focalPoint, originOutput, sizeOutput, spaceOutput, directionOutput, threshold, points=None, occupancy=None, block_size=8,
+                dtype=np.float64, slope=1., intercept=0.):
+    '''Compute a DRR with the NumPy ray caster.
+
+    The geometry follows main_functions.drr: every output pixel is mapped
+    through the transform and integrated along the ray towards the
+    transformed focal point.
+
+    Args:
+        inputImage (itk.Image):     3D input volume
+        transform (itk.Transform):  Transform from the output to the input space
+        focalPoint (list):          Location of the x-ray source (x,y,z)
+        originOutput (list):        Origin of the output image (x,y,z)
+        sizeOutput (list):          Size of the output image (x,y,z)
+        spaceOutput (list):         Spacing of the output image (x,y,z)
+        directionOutput (np.array): Direction matrix of the output image
+        threshold (float):          Only intensities above the threshold are integrated
+        points (np.array):          Detector points from get_detector_points, computed if None
+        occupancy (np.array):       Grid from build_occupancy_grid to skip empty space, or None
+        block_size (int):           Block size of the occupancy grid
+        dtype:                      Type of the interpolation and sums, see cast_rays
+        slope (float):              Rescale slope of the stored values of the volume
+        intercept (float):          Rescale intercept of the stored values of the volume
+
+    Returns:
+        np.array:                   The DRR indexed [z,y,x]
+    '''
+    volume = itk.array_view_from_image(inputImage)  # No copy of the volume
+    origin = np.array(inputImage.GetOrigin(), dtype=np.float64)
+    spacing = np.array(inputImage.GetSpacing(), dtype=np.float64)
+
+    matrix, offset = get_transform_matrix_offset(transform)
+    if points is None:
+        points = get_detector_points(originOutput, sizeOutput, spaceOutput, directionOutput)
+    sources = points.dot(matrix.T) + offset
+    target = matrix.dot(np.asarray(focalPoint, dtype=np.float64)) + offset
+
+    integral = cast_rays(volume, origin, spacing, sources, target, threshold, occupancy=occupancy, block_size=block_size,
+                         dtype=dtype, slope=slope, intercept=intercept)
+    return integral.reshape([int(s) for s in sizeOutput][::-1])
+
+def raycast_drr_gradient(inputImage, transform, focalPoint, points, threshold, matrix_derivatives, offset_derivatives, occupancy=None, block_size=8,
+                         slope=1., intercept=0.):
+    '''Compute the ray sums of a DRR and their derivatives with respect to the pose.
+
+    Args:
+        inputImage (itk.Image):         3D input volume
+        transform (itk.Transform):      Transform from the output to the input space
+        focalPoint (list):              Location of the x-ray source (x,y,z)
+        points (np.array):              Nx3 detector points from get_detector_points
+        threshold (float):              Only intensities above the threshold are integrated
+        matrix_derivatives (np.array):  Px3x3 derivatives of the matrix of the transform
+        offset_derivatives (np.array):  Px3 derivatives of the offset of the transform
+        occupancy (np.array):           Grid from build_occupancy_grid to skip empty space, or None
+        block_size (int):               Block size of the occupancy grid
+        slope (float):                  Rescale slope of the stored values of the volume
+        intercept (float):              Rescale intercept of the stored values of the volume
+
+    Returns:
+        (np.array, np.array):           Ray sums (N,) and their derivatives (P,N)
+    '''
+    volume = itk.array_view_from_image(inputImage)
+    origin = np.array(inputImage.GetOrigin(), dtype=np.float64)
+    spacing = np.array(inputImage.GetSpacing(), dtype=np.float64)
+
+    matrix, offset = get_transform_matrix_offset(transform)
+    focalPoint = np.asarray(focalPoint, dtype=np.float64)
+    sources = points.dot(matrix.T) + offset
+    target = matrix.dot(focalPoint) + offset
+    source_derivatives = np.einsum('pij,nj->npi', matrix_derivatives, points) + offset_derivatives
+    target_derivatives = matrix_derivatives.dot(focalPoint) + offset_derivatives
+
+    integral, gradient = cast_rays_gradient(volume, origin, spacing, sources, target, source_derivatives, target_derivatives,
+                                            threshold, occupancy=occupancy, block_size=block_size, slope=slope, intercept=intercept)
+    return integral, gradient.T
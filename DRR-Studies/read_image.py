@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
-'''Read a medical image'''
+'''Read a medical image
+
+VTK is only imported by get_vtk_reader_from_file_name, so reading the
+image type or orientation with ITK does not load it.
+'''
 
-import vtk
 import itk
 import numpy as np
 
@@ -21,9 +24,13 @@ def get_vtk_reader_from_file_name(file_name):
         vtk.vtkImageReader2:    The vtkImageReader2
     '''
 
-    # Add readers which are not registered by default
-    vtk.vtkImageReader2Factory.RegisterReader(vtk.vtkNIFTIImageReader())
-    vtk.vtkImageReader2Factory.RegisterReader(vtk.vtkNrrdReader())
+    import vtk
+
+    # Add readers which are not registered by default, once per process
+    if not get_vtk_reader_from_file_name.readers_registered:
+        vtk.vtkImageReader2Factory.RegisterReader(vtk.vtkNIFTIImageReader())
+        vtk.vtkImageReader2Factory.RegisterReader(vtk.vtkNrrdReader())
+        get_vtk_reader_from_file_name.readers_registered = True
 
     # Disable the DICOM reader. It prints too many errors.
     # vtk.vtkImageReader2Factory.RegisterReader(vtk.vtkDICOMImageReader())
@@ -32,7 +39,63 @@ def get_vtk_reader_from_file_name(file_name):
     reader = vtk.vtkImageReader2Factory.CreateImageReader2(file_name)
     return reader
 
-def get_itk_homogeneous_coordinate_matrix(file_name):
+# The factory keeps the registered readers
+get_vtk_reader_from_file_name.readers_registered = False
+
+def read_image_information(file_name):
+    '''Create the itk.ImageIO of a file and read its header.
+
+    The same ImageIO can be given to get_image_header,
+    get_itk_homogeneous_coordinate_matrix and get_itk_image_type so that
+    the header is only read once.
+
+    Args:
+        file_name (string):     Input file name on disk
+
+    Returns:
+        itk.ImageIOBase:        The ImageIO, None if no itk.ImageIO can read the file
+    '''
+    # The file modes moved to itk.CommonEnums in ITK 5
+    read_mode = getattr(itk.ImageIOFactory, 'ReadMode', None)
+    if read_mode is None:
+        read_mode = itk.CommonEnums.IOFileMode_ReadMode
+    imageIO = itk.ImageIOFactory.CreateImageIO(file_name, read_mode)
+    if imageIO is None:
+        return None
+    imageIO.SetFileName(file_name)
+    imageIO.ReadImageInformation()
+    return imageIO
+
+def get_image_header(file_name, imageIO=None):
+    '''Read the pixel type and geometry of a file on disk, without its pixels.
+
+    Args:
+        file_name (string):         Input file name on disk
+        imageIO (itk.ImageIOBase):  ImageIO of the file from read_image_information, created if None
+
+    Returns:
+        dict:                       pixel_type (ImageIO component type, e.g. 'float'), components,
+                                    dimensions, size, spacing, origin and direction (D[row][column],
+                                    the columns are the directions of the axes). None if no
+                                    itk.ImageIO can read the file.
+    '''
+    if imageIO is None:
+        imageIO = read_image_information(file_name)
+        if imageIO is None:
+            return None
+    dimensions = imageIO.GetNumberOfDimensions()
+    directions = [list(imageIO.GetDirection(ii)) for ii in range(dimensions)]
+    return {
+        'pixel_type':   imageIO.GetComponentTypeAsString(imageIO.GetComponentType()),
+        'components':   int(imageIO.GetNumberOfComponents()),
+        'dimensions':   int(dimensions),
+        'size':         [int(imageIO.GetDimensions(ii)) for ii in range(dimensions)],
+        'spacing':      [float(imageIO.GetSpacing(ii)) for ii in range(dimensions)],
+        'origin':       [float(imageIO.GetOrigin(ii)) for ii in range(dimensions)],
+        'direction':    [[float(directions[ii][jj]) + 0. for ii in range(dimensions)] for jj in range(dimensions)],
+    }
+
+def get_itk_homogeneous_coordinate_matrix(file_name, imageIO=None, header=None):
     '''Read the homogeneous coordinates matrix in ITK.
 
     The coordinates are in the ITK frame of reference. In general, the
@@ -52,35 +115,30 @@ def get_itk_homogeneous_coordinate_matrix(file_name):
     expect.
 
     Args:
-        file_name (string):     Input file name on disk
+        file_name (string):         Input file name on disk
+        imageIO (itk.ImageIOBase):  ImageIO of the file from read_image_information, created if None
+        header (dict):              Header of the file from get_image_header (e.g. from a catalog), the file is not read if given
 
     Returns:
         np.array:               The orientation matrix in homogeneous coordinates
     '''
-    # Try to get the ImageIO given the file name
-    imageIO = itk.ImageIOFactory.CreateImageIO(file_name, itk.ImageIOFactory.ReadMode)
-    if imageIO is None:
-        return None
-    imageIO.SetFileName(file_name)
-    imageIO.ReadImageInformation()
+    if header is None:
+        header = get_image_header(file_name, imageIO)
+        if header is None:
+            return None
 
-    # Read the direction matrix, multiply by spacing
-    image_dimensions = imageIO.GetNumberOfDimensions()
+    # Read the direction matrix
+    image_dimensions = header['dimensions']
     orientation_matrix = np.zeros((image_dimensions+1, image_dimensions+1))
-    for ii in range(image_dimensions):
-        this_direction = imageIO.GetDirection(ii)
-        # this_spacing = imageIO.GetSpacing(ii)
-        for jj in range(image_dimensions):
-            orientation_matrix[jj, ii] = this_direction[jj]
+    orientation_matrix[:image_dimensions, :image_dimensions] = header['direction']
 
     # Read the origin
-    for i in range(image_dimensions):
-        orientation_matrix[i, image_dimensions] = imageIO.GetOrigin(i)
+    orientation_matrix[:image_dimensions, image_dimensions] = header['origin']
     orientation_matrix[image_dimensions, image_dimensions] = 1
 
     return orientation_matrix
 
-def get_itk_image_type(file_name):
+def get_itk_image_type(file_name, imageIO=None, header=None):
     '''Determine the image type for a file on disk.
 
     This can largely be replaced with itk.imread except for DICOM images
@@ -95,24 +153,22 @@ def get_itk_image_type(file_name):
     reading those images as short.
 
     Args:
-        file_name (string): Input file name on disk
+        file_name (string):         Input file name on disk
+        imageIO (itk.ImageIOBase):  ImageIO of the file from read_image_information, created if None
+        header (dict):              Header of the file from get_image_header (e.g. from a catalog), the file is not read if given
 
     Returns:
         itk.Image:  The created image type
     '''
-    # Try to get the ImageIO given the file name
-    imageIO = itk.ImageIOFactory.CreateImageIO(file_name, itk.ImageIOFactory.ReadMode)
-    if imageIO is None:
-        return None
-    imageIO.SetFileName(file_name)
-    imageIO.ReadImageInformation()
+    if header is None:
+        header = get_image_header(file_name, imageIO)
+        if header is None:
+            return None
 
     # Get pixel type and dimension
-    pixel_type_as_string = imageIO.GetComponentTypeAsString(imageIO.GetComponentType())
-    pixel_type = get_itk_image_type.component_type_to_itk_type_dict[pixel_type_as_string]
-    dimensions = imageIO.GetNumberOfDimensions()
+    pixel_type = get_itk_image_type.component_type_to_itk_type_dict[header['pixel_type']]
 
-    return itk.Image[pixel_type, dimensions]
+    return itk.Image[pixel_type, header['dimensions']]
 
 # Create dictionary to map from ImageIOBase type to ctype
 get_itk_image_type.component_type_to_itk_type_dict = {
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+'''Rigid transforms of a volume in memory
+
+itk_helpers.rigid_body_transform3D reads a file, resamples it and writes
+the result. rigid_body_transform3D_image does the same on an ITK image or
+array in memory. A chain of moves [(rot1, t1), (rot2, t2), ...] is
+composed into one transform first, so the volume is resampled (and
+blurred by the interpolation) once, with the result of resampling after
+every move:
+
+    moved = rigid_body_transform3D_image(inputImage, [(rot1, t1), (rot2, t2)], threads=8)
+
+The resample filter of ITK splits the output into slabs along z, one per
+work unit, rendered by its threads.
+
+For DRRs the volume does not need to be resampled at all: fold_into_pose
+returns the pose which renders the original volume as the pose (rot, t)
+renders the moved volume:
+
+    rot, t = fold_into_pose(inputImage, [(rot1, t1), (rot2, t2)], rot, t)
+    main_functions.drr(inputImage, ..., rot, t, ...)
+'''
+
+import itk
+import numpy as np
+import itk_helpers as Functions
+import main_functions
+import raycast
+
+def make_reference_image(inputImage, origin=None):
+    '''Image with the geometry of inputImage, and optionally another origin, without pixel buffer.'''
+    image = type(inputImage).New()
+    image.SetRegions(inputImage.GetLargestPossibleRegion())
+    image.SetSpacing(inputImage.GetSpacing())
+    image.SetDirection(inputImage.GetDirection())
+    image.SetOrigin(inputImage.GetOrigin() if origin is None else [float(value) for value in origin])
+    return image
+
+def get_rigid_transform(inputImage, rot, t):
+    '''Transform and output origin of itk_helpers.rigid_body_transform3D for one move.
+
+    Args:
+        inputImage (itk.Image): Volume moved (only its geometry is used)
+        rot (list):             Rotation in degrees in x, y and z
+        t (list):               Translation in x, y and z
+
+    Returns:
+        tuple:                  (matrix, offset, output origin), the output voxel at x takes the input value at matrix * x + offset
+    '''
+    inOrigin = inputImage.GetOrigin()
+    inSpacing = inputImage.GetSpacing()
+    inSize = inputImage.GetLargestPossibleRegion().GetSize()
+    direction_mat = Functions.get_vnl_matrix(inputImage.GetDirection().GetVnlMatrix())
+
+    # Same construction as rigid_body_transform3D
+    rot = direction_mat.dot(np.transpose(np.dot(-1, rot)))
+    t = direction_mat.dot(np.transpose(np.dot(-1, t)))
+    transform = itk.CenteredEuler3DTransform[itk.D].New()
+    transform.SetRotation(np.deg2rad(rot[0]), np.deg2rad(rot[1]), np.deg2rad(rot[2]))
+    transform.SetTranslation(itk.Vector.D3(t))
+    transform.SetComputeZYX(True)
+    center = direction_mat.dot(inOrigin) + np.multiply(inSpacing, inSize) / 2.
+    center = direction_mat.dot(center) - t
+    transform.SetCenter(center)
+
+    matrix, offset = raycast.get_transform_matrix_offset(transform)
+    return matrix, offset, np.asarray(inOrigin, dtype=np.float64) - t
+
+def compose_rigid_transforms(inputImage, moves):
+    '''Compose a chain of moves into one transform.
+
+    Every move is defined, as by rigid_body_transform3D, on the geometry of
+    the result of the previous moves.
+
+    Args:
+        inputImage (itk.Image): Volume moved (only its geometry is used)
+        moves (list):           List of (rot, t) applied in order
+
+    Returns:
+        tuple:                  (matrix, offset, output origin) of the whole chain
+    '''
+    matrix, offset = np.eye(3), np.zeros(3)
+    reference = inputImage
+    for rot, t in moves:
+        move_matrix, move_offset, origin = get_rigid_transform(reference, rot, t)
+        # The output of this move samples the previous output at move_matrix * x + move_offset
+        matrix, offset = matrix.dot(move_matrix), matrix.dot(move_offset) + offset
+        reference = make_reference_image(reference, origin)
+    return matrix, offset, np.asarray(reference.GetOrigin(), dtype=np.float64)
+
+def rigid_body_transform3D_image(inputImage, moves, threads=None, default_pixel_value=0, origin=None, spacing=None, direction=None):
+    '''Rigid transform of a volume in memory, with a single resampling for a chain of moves.
+
+    Args:
+        inputImage:                 itk.Image, or np.array indexed [z,y,x]
+        moves (list):               List of (rot, t) applied in order, or a single (rot, t)
+        threads (int):              Number of work units (slabs along z) of the resampling, ITK's default if None
+        default_pixel_value:        Value of the voxels mapped outside the input
+        origin (list):              Origin of an array input, 0 if None
+        spacing (list):             Spacing of an array input, 1 if None
+        direction (np.array):       Direction of an array input, identity if None
+
+    Returns:
+        itk.Image or np.array:      The moved volume, of the type of the input, linearly interpolated
+    '''
+    if len(moves) == 2 and np.ndim(moves[0]) == 1:
+        moves = [moves]
+    is_array = isinstance(inputImage, np.ndarray)
+    if is_array:
+        inputImage = itk.image_view_from_array(np.ascontiguousarray(inputImage))
+        inputImage.SetOrigin([0., 0., 0.] if origin is None else [float(value) for value in origin])
+        inputImage.SetSpacing([1., 1., 1.] if spacing is None else [float(value) for value in spacing])
+        if direction is not None:
+            inputImage.SetDirection(itk.matrix_from_array(np.asarray(direction, dtype=np.float64)))
+
+    matrix, offset, outOrigin = compose_rigid_transforms(inputImage, moves)
+    transform = itk.AffineTransform[itk.D, 3].New()
+    transform.SetMatrix(itk.matrix_from_array(matrix))
+    transform.SetOffset(itk.Vector.D3(offset))
+
+    ImageType = type(inputImage)
+    resamplefilter = itk.ResampleImageFilter[ImageType, ImageType].New()
+    resamplefilter.SetInput(inputImage)
+    resamplefilter.SetDefaultPixelValue(default_pixel_value)
+    resamplefilter.SetInterpolator(itk.LinearInterpolateImageFunction[ImageType, itk.D].New())
+    resamplefilter.SetTransform(transform)
+    resamplefilter.SetSize(inputImage.GetLargestPossibleRegion().GetSize())
+    resamplefilter.SetOutputSpacing(inputImage.GetSpacing())
+    resamplefilter.SetOutputOrigin(outOrigin)
+    resamplefilter.SetOutputDirection(inputImage.GetDirection())
+    if threads is not None:
+        resamplefilter.SetNumberOfWorkUnits(threads)
+    resamplefilter.Update()
+
+    output = resamplefilter.GetOutput()
+    if is_array:
+        return itk.array_from_image(output)
+    output.DisconnectPipeline()
+    return output
+
+def get_pose_from_transform(inputImage, matrix, offset):
+    '''Pose (rot, t) for which main_functions.set_drr_transform gives the transform matrix * x + offset.
+
+    Args:
+        inputImage (itk.Image): Volume rendered (only its geometry is used)
+        matrix (np.array):      3x3 rotation matrix
+        offset (np.array):      Offset of the transform
+
+    Returns:
+        tuple:                  (rot in degrees, t)
+    '''
+    # The matrix is Rz * Ry * Rx of the angles -direction * rot
+    angle_y = np.arctan2(-matrix[2, 0], np.sqrt(matrix[0, 0] ** 2 + matrix[1, 0] ** 2))
+    angle_x = np.arctan2(matrix[2, 1], matrix[2, 2])
+    angle_z = np.arctan2(matrix[1, 0], matrix[0, 0])
+    direction_mat = Functions.get_vnl_matrix(inputImage.GetDirection().GetVnlMatrix())
+    rot = -direction_mat.T.dot(np.rad2deg([angle_x, angle_y, angle_z]))
+
+    # With center c0 - t and translation -direction * t, the offset is (I - M) c0 - (I + direction - M) t
+    inOrigin = inputImage.GetOrigin()
+    center = direction_mat.dot(direction_mat.dot(inOrigin) + np.multiply(inputImage.GetSpacing(), inputImage.GetLargestPossibleRegion().GetSize()) / 2.)
+    t = np.linalg.solve(np.eye(3) + direction_mat - matrix, (np.eye(3) - matrix).dot(center) - offset)
+    return rot, t
+
+def fold_into_pose(inputImage, moves, rot, t):
+    '''Pose rendering inputImage as (rot, t) renders the volume moved by moves.
+
+    The DRR of the moved volume samples it at T_pose(x), that is the
+    original volume at T_moves(T_pose(x)). The returned pose gives this
+    composed transform on the original volume, so no resampling is needed.
+    The ray casters ignore the direction of the volume (see raycast.py),
+    so T_moves is expressed in their frame, origin + index * spacing.
+
+    Args:
+        inputImage (itk.Image): Original volume (only its geometry is used)
+        moves (list):           List of (rot, t) applied in order, as for rigid_body_transform3D_image
+        rot (list):             Rotation in degrees of the DRR of the moved volume
+        t (list):               Translation of the DRR of the moved volume
+
+    Returns:
+        tuple:                  (rot, t) for main_functions.drr of inputImage
+    '''
+    if len(moves) == 2 and np.ndim(moves[0]) == 1:
+        moves = [moves]
+    matrix, offset, outOrigin = compose_rigid_transforms(inputImage, moves)
+
+    # Frame of the ray casters: the voxel at origin + index * spacing is at origin + direction * index * spacing
+    direction_mat = Functions.get_vnl_matrix(inputImage.GetDirection().GetVnlMatrix())
+    inOrigin = np.asarray(inputImage.GetOrigin(), dtype=np.float64)
+    offset = inOrigin + direction_mat.T.dot(matrix.dot(outOrigin - direction_mat.dot(outOrigin)) + offset - inOrigin)
+    matrix = direction_mat.T.dot(matrix).dot(direction_mat)
+
+    transform = itk.CenteredEuler3DTransform[itk.D].New()
+    main_functions.set_drr_transform(transform, make_reference_image(inputImage, outOrigin), rot, t)
+    pose_matrix, pose_offset = raycast.get_transform_matrix_offset(transform)
+    return get_pose_from_transform(inputImage, matrix.dot(pose_matrix), matrix.dot(pose_offset) + offset)
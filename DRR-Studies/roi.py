@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+'''Render a region of interest of the detector, optionally in parallel tiles
+
+Every detector pixel is an independent ray, so a sub-rectangle of the
+detector can be rendered on its own: it is a smaller detector whose origin
+is the physical position of its first pixel. ROIRenderer renders the
+bounding box of a rectangle and/or a binary mask, split in tiles rendered
+by a pool of threads. With the numpy backend only the rays of the mask
+pixels are cast. The tiles share the transform of the pose and, with the
+numpy backend, the occupancy grid of the volume, so a tile only costs its
+rays (and a resample filter with the itk backend).
+
+The results are the ray sums, before the 0-255 rescaling of the DRR
+pipeline, since that rescaling depends on the minimum and maximum of the
+rendered pixels. Pixels outside the mask are 0.
+
+With the numpy backend the tiles give exactly the ray sums of a full
+render. The resample filter of ITK steps the transformed points along each
+row of its output, and its ray caster can change by a voxel with that
+rounding: with the itk backend, tiles as wide as the region of interest
+give the same sums, narrower tiles can differ at a few pixels.
+'''
+
+import itk
+import numpy as np
+from multiprocessing.pool import ThreadPool
+import itk_helpers as Functions
+import main_functions
+import raycast
+
+def get_pixel_dtype(ImageType):
+    '''NumPy type of the pixels of an ITK image type.'''
+    image = ImageType.New()
+    image.SetRegions([1, 1, 1])
+    image.Allocate()
+    return itk.array_view_from_image(image).dtype
+
+def get_roi_geometry(originOutput, spaceOutput, directionOutput, roi):
+    '''Detector geometry of a sub-rectangle of the detector.
+
+    Args:
+        originOutput (list):        Origin of the output image (x,y,z)
+        spaceOutput (list):         Spacing of the output image (x,y,z)
+        directionOutput (np.array): Direction matrix of the output image
+        roi (list):                 [x, y, width, height] of the sub-rectangle in pixels
+
+    Returns:
+        tuple:                      (originOutput, sizeOutput) of the sub-rectangle
+    '''
+    x, y, width, height = [int(value) for value in roi]
+    index = np.array([x, y, 0], dtype=np.float64)
+    shift = np.asarray(directionOutput, dtype=np.float64).dot(index * np.asarray(spaceOutput, dtype=np.float64))
+    origin = np.asarray(originOutput, dtype=np.float64) + np.asarray(shift).reshape(-1)
+    return origin.tolist(), [width, height, 1]
+
+def get_mask_roi(mask):
+    '''Bounding box [x, y, width, height] of a (H, W) binary mask, None if it is empty.'''
+    rows = np.nonzero(np.any(mask, axis=1))[0]
+    columns = np.nonzero(np.any(mask, axis=0))[0]
+    if rows.size == 0:
+        return None
+    return [int(columns[0]), int(rows[0]), int(columns[-1] - columns[0] + 1), int(rows[-1] - rows[0] + 1)]
+
+def split_tiles(roi, tile_size):
+    '''Split [x, y, width, height] in tiles of at most tile_size = (width, height) pixels.'''
+    x, y, width, height = roi
+    if tile_size is None:
+        return [list(roi)]
+    tiles = []
+    for tile_y in range(y, y + height, tile_size[1]):
+        for tile_x in range(x, x + width, tile_size[0]):
+            tiles.append([tile_x, tile_y, min(tile_size[0], x + width - tile_x), min(tile_size[1], y + height - tile_y)])
+    return tiles
+
+class ROIRenderer(object):
+    '''Render the ray sums of part of a detector.
+
+    Args:
+        inputImage (itk.Image):     3D input volume
+        focalPoint (list):          Location of the x-ray source (x,y,z)
+        originOutput (list):        Origin of the full output image (x,y,z)
+        sizeOutput (list):          Size of the full output image (x,y,z)
+        spaceOutput (list):         Spacing of the output image (x,y,z)
+        directionOutput (np.array): Direction matrix of the output image
+        threshold (float):          Only intensities above the threshold are integrated
+        InputImageType:             ITK type of the input image
+        OutputImageType:            ITK type of the output image
+        roi (list):                 [x, y, width, height] in pixels, the full detector if None
+        mask (np.array):            (H, W) binary mask of the full detector, restricting the pixels rendered
+        tile_size (list):           (width, height) of the tiles, a single tile if None
+        threads (int):              Number of threads rendering the tiles, defaults to the number of cores
+        backend (string):           'itk' or 'numpy', see main_functions.DRRRenderer
+        precision (string):         'double' or 'single', see main_functions.DRRRenderer
+    '''
+    def __init__(self, inputImage, focalPoint, originOutput, sizeOutput, spaceOutput, directionOutput, threshold,
+                 InputImageType, OutputImageType, roi=None, mask=None, tile_size=None, threads=None, backend='numpy',
+                 precision='double'):
+        self.sizeOutput      = [int(s) for s in sizeOutput]
+        self.spaceOutput     = spaceOutput
+        self.directionOutput = directionOutput
+        self.backend         = backend
+
+        if roi is None:
+            roi = [0, 0, self.sizeOutput[0], self.sizeOutput[1]]
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool).reshape(self.sizeOutput[1], self.sizeOutput[0])
+            clipped = np.zeros_like(mask)
+            clipped[roi[1]:roi[1] + roi[3], roi[0]:roi[0] + roi[2]] = mask[roi[1]:roi[1] + roi[3], roi[0]:roi[0] + roi[2]]
+            mask = clipped
+            roi = get_mask_roi(mask)
+            if roi is None:
+                raise ValueError('The mask does not select any pixel of the region of interest.')
+        if roi[0] < 0 or roi[1] < 0 or roi[0] + roi[2] > self.sizeOutput[0] or roi[1] + roi[3] > self.sizeOutput[1]:
+            raise ValueError('The region of interest {} is not inside the detector {}.'.format(roi, self.sizeOutput[:2]))
+        self.roi = [int(value) for value in roi]
+        self.mask = mask
+        self.originROI, self.sizeROI = get_roi_geometry(originOutput, spaceOutput, directionOutput, self.roi)
+
+        # The pose is set once per render on a single transform shared by the tiles
+        self.inputImage = inputImage
+        self.focalPoint = focalPoint
+        self.threshold = threshold
+        self.transform = itk.CenteredEuler3DTransform[itk.D].New()
+        main_functions.set_drr_transform(self.transform, inputImage, [0., 0., 0.], [0., 0., 0.])
+        self.raycastOptions = main_functions.get_raycast_options(inputImage, backend, precision)
+        self.dtype = get_pixel_dtype(OutputImageType)
+
+        # The tiles holding pixels to render. The pixels keep the positions
+        # computed for the full detector (start index of a resample filter per
+        # tile for itk, points of the full detector for numpy) so the rays do not change.
+        if backend == 'numpy':
+            points = raycast.get_detector_points(originOutput, sizeOutput, spaceOutput, directionOutput)
+            points = points.reshape(self.sizeOutput[1], self.sizeOutput[0], 3)
+            stored_threshold = raycast.get_stored_threshold(threshold, self.raycastOptions['slope'], self.raycastOptions['intercept'])
+            self.volume = itk.array_view_from_image(inputImage)
+            self.occupancy = raycast.build_occupancy_grid(self.volume, stored_threshold)     # Once for all the tiles
+        elif backend != 'itk':
+            raise ValueError('Unknown backend "{}". Use "itk" or "numpy".'.format(backend))
+        self.tiles = []
+        self.tilePoints = []
+        self.resamplers = []
+        for tile in split_tiles(self.roi, tile_size):
+            x, y, width, height = tile
+            tile_mask = None if mask is None else mask[y:y + height, x:x + width]
+            if tile_mask is not None and not tile_mask.any():
+                continue
+            self.tiles.append((tile, tile_mask))
+            if backend == 'numpy':
+                tile_points = points[y:y + height, x:x + width].reshape(-1, 3)
+                if tile_mask is not None:
+                    tile_points = tile_points[tile_mask.reshape(-1)]    # Only cast the rays of the mask
+                self.tilePoints.append(tile_points)
+            else:
+                self.resamplers.append(self.get_resampler(InputImageType, OutputImageType, originOutput, tile))
+
+        self.pool = ThreadPool(threads) if len(self.tiles) > 1 else None
+
+    def get_resampler(self, InputImageType, OutputImageType, originOutput, tile):
+        '''Resample filter casting the rays of a tile with RayCastInterpolateImageFunction, as main_functions.DRRRenderer.'''
+        x, y, width, height = tile
+        interpolator = itk.RayCastInterpolateImageFunction[InputImageType, itk.D].New()
+        interpolator.SetInputImage(self.inputImage)
+        interpolator.SetThreshold(self.threshold)
+        interpolator.SetFocalPoint(itk.Point.D3(self.focalPoint))
+        interpolator.SetTransform(self.transform)
+        resampler = itk.ResampleImageFilter[InputImageType, OutputImageType].New()
+        resampler.SetInput(self.inputImage)
+        resampler.SetDefaultPixelValue(0)
+        resampler.SetInterpolator(interpolator)
+        resampler.SetTransform(self.transform)
+        resampler.SetSize([width, height, 1])
+        resampler.SetOutputSpacing(self.spaceOutput)
+        resampler.SetOutputOrigin(originOutput)
+        resampler.SetOutputStartIndex([x, y, 0])
+        Functions.change_image_direction(oldDirection=resampler.GetOutputDirection(), newDirection=self.directionOutput, DimensionOut=3)
+        return resampler
+
+    def render_tile(self, index, matrix=None, offset=None):
+        '''Render one tile into a new [y,x] array, for the pose of the transform (given as matrix and offset for numpy).'''
+        (x, y, width, height), tile_mask = self.tiles[index]
+        if self.backend == 'numpy':
+            points = self.tilePoints[index]
+            target = matrix.dot(np.asarray(self.focalPoint, dtype=np.float64)) + offset
+            values = raycast.cast_rays(self.volume, self.inputImage.GetOrigin(), self.inputImage.GetSpacing(),
+                                       points.dot(matrix.T) + offset, target, self.threshold, occupancy=self.occupancy,
+                                       **self.raycastOptions)
+            values = raycast.cast_ray_sums(values, self.dtype)      # Clamped to the output pixel type, as by the resampler
+            if tile_mask is None:
+                return values.reshape(height, width)
+            tile = np.zeros((height, width), dtype=self.dtype)
+            tile[tile_mask] = values
+            return tile
+        resampler = self.resamplers[index]
+        resampler.Modified()        # The transform was changed in place, force the resampling.
+        resampler.UpdateLargestPossibleRegion()
+        tile = itk.array_from_image(resampler.GetOutput()).reshape(height, width)
+        if tile_mask is not None:
+            tile[~tile_mask] = 0
+        return tile
+
+    def render(self, rot, t):
+        '''Render the region of interest for the pose (rot, t).
+
+        Returns:
+            np.array:   (height, width) ray sums of the region of interest, whose first pixel is at originROI
+        '''
+        main_functions.set_drr_transform(self.transform, self.inputImage, rot, t)
+        matrix, offset = raycast.get_transform_matrix_offset(self.transform) if self.backend == 'numpy' else (None, None)
+        if self.pool is None:
+            tiles = [self.render_tile(index, matrix, offset) for index in range(len(self.tiles))]
+        else:
+            tiles = self.pool.map(lambda index: self.render_tile(index, matrix, offset), range(len(self.tiles)))
+
+        # Stitch the tiles
+        output = np.zeros((self.roi[3], self.roi[2]), dtype=tiles[0].dtype)
+        for ((x, y, width, height), tile_mask), tile in zip(self.tiles, tiles):
+            output[y - self.roi[1]:y - self.roi[1] + height, x - self.roi[0]:x - self.roi[0] + width] = tile
+        return output
+
+    def render_full(self, rot, t):
+        '''Render the region of interest into a (H, W) array of the full detector, 0 outside.'''
+        array = self.render(rot, t)
+        full = np.zeros((self.sizeOutput[1], self.sizeOutput[0]), dtype=array.dtype)
+        full[self.roi[1]:self.roi[1] + self.roi[3], self.roi[0]:self.roi[0] + self.roi[2]] = array
+        return full
+
+    def to_image(self, array):
+        '''ITK image of a render() result, placed at the region of interest of the detector.'''
+        image = itk.image_from_array(np.ascontiguousarray(array).reshape(1, self.roi[3], self.roi[2]))
+        image.SetOrigin(self.originROI)
+        image.SetSpacing(self.spaceOutput)
+        image.SetDirection(itk.matrix_from_array(np.asarray(self.directionOutput, dtype=np.float64)))
+        return image
+
+    def close(self):
+        '''Stop the threads rendering the tiles.'''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
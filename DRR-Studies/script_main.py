@@ -10,6 +10,8 @@ import itk
 import numpy as np
 from read_image import get_itk_image_type
 import main_functions 
+import sweep
+import volume_cache
 import os
 
 from StereoFlouroscopyRegistration.io.read_image import get_itk_image_type
@@ -25,7 +27,7 @@ InputImageType = get_itk_image_type(input_filename)
 OutputImageType= InputImageType
 
 
-inputImage = itk.imread(input_filename)
+inputImage = volume_cache.load_volume(input_filename) # Decoded once, then memory-mapped from the cache
 
 #%% Set input information
 sizeOutput = [1024,1400,1] # The size of output image
@@ -44,20 +46,26 @@ originOutput = [delta,delta,-200.0]
 directionOutput = np.matrix([[  1.,  0.,  0.],
                              [  0.,  1.,  0.],
                              [  0.,  0.,  1.]])
-#%%
-
-for counter_x in range(0,5,5): # Rotation in x
-    for counter_y in range(0,5,5): # Rotation in y
-        for counter_z in range(0,5,5): # Rotation in z
-            rot = [float(counter_x),float(counter_y),float(counter_z)] # Making the rotation into an array
-            print(rot)
-            output_directory = "/Users/pzandiyeh/Desktop/OutputImages" # output directory
-            if not os.path.exists(output_directory): # If the directory is not existing , create one. 
-                os.mkdir(output_directory) # Make the directory
-            filetype = '.nii' # type of output image ... it can be nifti or dicom
-            filename = 'rx_'+str(int(rot[0])) + 'ry_'+str(int(rot[1])) + 'rz_'+str(int(rot[2]))+filetype # makes the complete path
-            output_filename = os.path.join(output_directory,filename) # creating the output directory where all the images are stored.
-            main_functions.drr(inputImage,output_filename,rot,t,focalPoint,originOutput,sizeOutput,cor,spaceOutput,directionOutput,threshold,InputImageType,OutputImageType,verbose) # creating drr. 
+#%% Poses of the sweep, in the order of the nested rotation loops (x, y, z)
+poses = sweep.pose_grid(range(0,5,5), # Rotation in x
+                        range(0,5,5), # Rotation in y
+                        range(0,5,5), # Rotation in z
+                        t)
+
+output_directory = "/Users/pzandiyeh/Desktop/OutputImages" # output directory
+if not os.path.exists(output_directory): # If the directory is not existing , create one. 
+    os.mkdir(output_directory) # Make the directory
+filetype = '.nii' # type of output image ... it can be nifti or dicom
+
+output_filenames = []
+for rot, _ in poses:
+    filename = 'rx_'+str(int(rot[0])) + 'ry_'+str(int(rot[1])) + 'rz_'+str(int(rot[2]))+filetype # makes the complete path
+    output_filenames.append(os.path.join(output_directory,filename)) # creating the output directory where all the images are stored.
+
+#%% Render the poses on all cores. The volume is shared with the workers through a memory-mapped file.
+if __name__ == '__main__': # Worker processes must not run the sweep again when they import this script.
+    sweep.run_sweep(inputImage,poses,focalPoint,originOutput,sizeOutput,spaceOutput,directionOutput,threshold,
+                    output_filenames=output_filenames,return_images=False) # creating drrs. 
             
             
 #%% For later. 
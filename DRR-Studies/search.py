@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+'''Coarse-to-fine search of the pose of a DRR matching a target image
+
+PoseSearch is a pattern search over the six pose parameters
+[rx, ry, rz, tx, ty, tz]. Each level polls moves of one step around the
+best poses found so far (the beam), moving the beam while the score
+improves by at least tolerance, and then halves the steps. A level which
+finds no better move only halves the steps. Poses scoring more than
+prune_margin below the best are dropped from the beam. The search stops
+after the level of the smallest step (min_step), or when max_evaluations
+is reached.
+
+Poses are scored in batches through a score function, such as the one of
+make_scorer which renders them with DRRRenderer.render_batch and compares
+them with the target using similarity.TargetImage:
+
+    renderer = main_functions.DRRRenderer(..., backend='numpy')
+    search = PoseSearch(make_scorer(renderer, fluoro, metric='ncc'), steps=[4, 4, 4, 4, 4, 4])
+    pose, score = search.search([0, 0, 0, 0, 0, 0])
+    search.write_log('search_log.json')
+
+Every evaluation is logged with its level, step and score. A pose is
+never rendered twice.
+'''
+
+import json
+import itertools
+import numpy as np
+from timeit import default_timer as timer
+import similarity
+
+def make_scorer(renderer, target, metric='ncc', mask=None, bins=32):
+    '''Score function rendering a batch of poses and comparing them with a target.
+
+    Args:
+        renderer (DRRRenderer):     Renderer of the volume and detector, see main_functions
+        target (np.array):          Target image of the size of the detector
+        metric (string):            'ncc', 'gc' or 'mi', see similarity.py
+        mask (np.array):            Pixels compared, all if None
+        bins (int):                 Number of bins of the mutual information
+
+    Returns:
+        function:                   Maps an N x 6 array of poses to their N scores
+    '''
+    target_image = similarity.TargetImage(target, mask, bins)
+    def score(poses):
+        return target_image.evaluate(renderer.render_batch(poses), [metric])[metric]
+    return score
+
+def get_moves(pattern):
+    '''Unit moves polled around a pose: 'axes' (12, one parameter at a time) or 'grid' (728, all the neighbours).'''
+    if pattern == 'axes':
+        return np.concatenate([np.eye(6), -np.eye(6)])
+    if pattern == 'grid':
+        moves = np.array(list(itertools.product([-1., 0., 1.], repeat=6)))
+        return moves[np.any(moves != 0, axis=1)]
+    raise ValueError('Unknown pattern "{}". Use "axes" or "grid".'.format(pattern))
+
+class PoseSearch(object):
+    '''Coarse-to-fine pattern search maximizing a score over the pose.
+
+    Args:
+        score_function (function):  Maps an N x 6 array of poses to N scores, higher is better
+        steps (list):               Steps of the first level, degrees for rotations and units of the image for translations
+        levels (int):               Number of levels, the steps are halved from one level to the next
+        min_step (float):           Replaces levels if given: the steps are halved as long as the largest
+                                    one stays at least min_step
+        beam_width (int):           Number of best poses refined at every level
+        prune_margin (float):       Poses scoring more than this below the best leave the beam, None to keep the beam_width best
+        tolerance (float):          Halve the steps when a move of the beam improves the best score by less
+        max_evaluations (int):      Maximum number of poses scored
+        pattern (string):           'axes' or 'grid', see get_moves
+        bounds (np.array):          6 x 2 minimum and maximum of every parameter, or None
+        max_moves (int):            Maximum number of moves of the beam within a level
+    '''
+    def __init__(self, score_function, steps=(4., 4., 4., 4., 4., 4.), levels=5, beam_width=3, prune_margin=None,
+                 tolerance=1e-4, max_evaluations=5000, pattern='axes', bounds=None, max_moves=50, min_step=None):
+        self.score_function  = score_function
+        self.steps           = np.asarray(steps, dtype=np.float64)
+        if min_step is not None:
+            levels = 1
+            while self.steps.max() / 2. ** levels >= min_step:
+                levels += 1
+        self.levels          = levels
+        self.beam_width      = beam_width
+        self.prune_margin    = prune_margin
+        self.tolerance       = tolerance
+        self.max_evaluations = max_evaluations
+        self.moves           = get_moves(pattern)
+        self.bounds          = None if bounds is None else np.asarray(bounds, dtype=np.float64)
+        self.max_moves       = max_moves
+        self.clear()
+
+    def clear(self):
+        '''Forget the evaluations of previous searches.'''
+        self.scores = {}
+        self.log = []
+        self.best_pose = None
+        self.best_score = -np.inf
+        self.stop_reason = None
+
+    def evaluate(self, poses, level, step):
+        '''Scores of poses, scoring in one batch the poses not seen before.'''
+        poses = np.atleast_2d(np.asarray(poses, dtype=np.float64))
+        keys = [tuple(np.round(pose, 9)) for pose in poses]
+        new, pending = [], set()
+        for index, key in enumerate(keys):
+            if key not in self.scores and key not in pending:
+                pending.add(key)
+                new.append(index)
+        new = new[:max(self.max_evaluations - len(self.log), 0)]
+        if new:
+            start = timer()
+            scores = np.asarray(self.score_function(poses[new]), dtype=np.float64)
+            duration = (timer() - start) / len(new)
+            for index, score in zip(new, scores):
+                self.scores[keys[index]] = float(score)
+                self.log.append({
+                    'evaluation':   len(self.log),
+                    'level':        level,
+                    'step':         step.tolist(),
+                    'pose':         poses[index].tolist(),
+                    'score':        float(score),
+                    'seconds':      duration,
+                })
+                if score > self.best_score:
+                    self.best_score, self.best_pose = float(score), poses[index].copy()
+        return np.array([self.scores.get(key, -np.inf) for key in keys])
+
+    def select_beam(self, poses, scores):
+        '''Best distinct poses, without those pruned by prune_margin.'''
+        order = np.argsort(-scores, kind='stable')
+        beam, seen = [], set()
+        for index in order:
+            key = tuple(np.round(poses[index], 9))
+            if key in seen or not np.isfinite(scores[index]):
+                continue
+            if self.prune_margin is not None and scores[index] < self.best_score - self.prune_margin:
+                break
+            seen.add(key)
+            beam.append(index)
+            if len(beam) == self.beam_width:
+                break
+        return poses[beam], scores[beam]
+
+    def search(self, initial_pose):
+        '''Search the pose maximizing the score, starting from initial_pose.
+
+        Args:
+            initial_pose (list):    [rx, ry, rz, tx, ty, tz]
+
+        Returns:
+            tuple:                  (best pose as a 6 array, its score)
+        '''
+        self.clear()
+        beam = np.atleast_2d(np.asarray(initial_pose, dtype=np.float64))
+        beam_scores = self.evaluate(beam, 0, self.steps)
+
+        for level in range(self.levels):
+            step = self.steps / 2. ** level
+            for _ in range(self.max_moves):
+                before = self.best_score
+                candidates = (beam[:, None, :] + self.moves[None, :, :] * step).reshape(-1, 6)
+                if self.bounds is not None:
+                    inside = np.all((candidates >= self.bounds[:, 0]) & (candidates <= self.bounds[:, 1]), axis=1)
+                    candidates = candidates[inside]
+                scores = self.evaluate(candidates, level, step)
+                beam, beam_scores = self.select_beam(np.concatenate([beam, candidates]), np.concatenate([beam_scores, scores]))
+                if len(self.log) >= self.max_evaluations:
+                    self.stop_reason = 'max_evaluations'
+                    return self.best_pose, self.best_score
+                if self.best_score - before <= self.tolerance:
+                    break       # No better move at this step, refine with the next level
+
+        self.stop_reason = 'min_step'
+        return self.best_pose, self.best_score
+
+    def write_log(self, file_name):
+        '''Write the evaluations and the result of the last search as JSON.'''
+        with open(file_name, 'w') as log_file:
+            json.dump({
+                'best_pose':    None if self.best_pose is None else self.best_pose.tolist(),
+                'best_score':   self.best_score,
+                'stop_reason':  self.stop_reason,
+                'evaluations':  self.log,
+            }, log_file, indent=1)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+'''Similarity of a batch of DRRs with a target image (e.g. a fluoroscopy frame)
+
+TargetImage precomputes what only depends on the target and its mask:
+the masked pixels, their mean and norm, the image gradients and the
+histogram bins. Each metric then compares a whole (N, H, W) batch, for
+instance from DRRRenderer.render_batch, in a few array operations:
+
+    target = TargetImage(fluoro, mask=mask)
+    drrs = renderer.render_batch(poses)
+    scores = target.evaluate(drrs)          # {'ncc': (N,), 'gc': (N,), 'mi': (N,)}
+
+compare() does the same for a target given as an array, keeping the
+TargetImage of the last targets so that their statistics are computed once.
+
+All the metrics are invariant to a linear rescaling of the DRRs, so the
+0-255 output of the pipeline and the ray sums give the same scores.
+'''
+
+import hashlib
+import numpy as np
+
+METRICS = ('ncc', 'gc', 'mi')
+
+def as_batch(images, shape):
+    '''View images as an (N, H, W) float batch of images of the given (H, W) shape.'''
+    images = np.asarray(images)
+    if images.size % (shape[0] * shape[1]) != 0:
+        raise ValueError('The images of shape {} do not match the target {}.'.format(images.shape, shape))
+    return images.reshape(-1, shape[0], shape[1])
+
+def get_image_gradients(images):
+    '''Central differences along x and y of a (N, H, W) batch.'''
+    return np.gradient(images.astype(np.float64), axis=(1, 2))[::-1]
+
+def correlate(values, target_centered, target_norm):
+    '''Normalized cross correlation of the rows of values with a centered target.'''
+    centered = values - values.mean(axis=1)[:, None]
+    norm = np.sqrt(np.einsum('ij,ij->i', centered, centered)) * target_norm
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = centered.dot(target_centered) / norm
+    return np.where(norm > 0, score, 0.)
+
+class TargetImage(object):
+    '''Target image and its statistics, compared with batches of DRRs.
+
+    Args:
+        target (np.array):  Target image, (H, W) or of any shape holding H x W pixels (e.g. [1,H,W])
+        mask (np.array):    Boolean mask of the pixels compared, all the pixels if None
+        bins (int):         Number of intensity bins of the mutual information
+    '''
+    def __init__(self, target, mask=None, bins=32):
+        target = np.asarray(target, dtype=np.float64)
+        self.shape = target.shape[-2:]
+        target = target.reshape(self.shape)
+        if mask is None:
+            mask = np.ones(self.shape, dtype=bool)
+        self.mask = np.asarray(mask, dtype=bool).reshape(self.shape)
+        self.count = int(self.mask.sum())
+        if self.count == 0:
+            raise ValueError('The mask does not select any pixel.')
+        self.bins = int(bins)
+
+        # Normalized cross correlation
+        values = target[self.mask]
+        self.mean = values.mean()
+        self.centered = values - self.mean
+        self.norm = np.sqrt(self.centered.dot(self.centered))
+
+        # Gradient correlation
+        self.gradients = []
+        for gradient in get_image_gradients(target[None]):
+            gradient = gradient[0][self.mask]
+            gradient = gradient - gradient.mean()
+            self.gradients.append((gradient, np.sqrt(gradient.dot(gradient))))
+
+        # Mutual information
+        self.binned = self.bin_values(values[None])[0]
+        self.histogram = np.bincount(self.binned, minlength=self.bins) / float(self.count)
+
+    def bin_values(self, values):
+        '''Bin index of the rows of values, each row spread over its own range.'''
+        low = values.min(axis=1)[:, None]
+        span = values.max(axis=1)[:, None] - low
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scaled = np.where(span > 0, (values - low) / span, 0.)
+        return np.minimum((scaled * self.bins).astype(np.intp), self.bins - 1)
+
+    def ncc(self, drrs):
+        '''Normalized cross correlation of every DRR with the target, in [-1, 1].'''
+        drrs = as_batch(drrs, self.shape)
+        return correlate(drrs[:, self.mask].astype(np.float64), self.centered, self.norm)
+
+    def gradient_correlation(self, drrs):
+        '''Mean of the normalized cross correlations of the x and y gradients, in [-1, 1].'''
+        drrs = as_batch(drrs, self.shape)
+        score = np.zeros(drrs.shape[0])
+        for gradient, (target_gradient, target_norm) in zip(get_image_gradients(drrs), self.gradients):
+            score += correlate(gradient[:, self.mask], target_gradient, target_norm)
+        return score / 2.
+
+    def mutual_information(self, drrs):
+        '''Mutual information in nats of every DRR with the target, from joint histograms.'''
+        drrs = as_batch(drrs, self.shape)
+        batch = drrs.shape[0]
+        binned = self.bin_values(drrs[:, self.mask].astype(np.float64))
+
+        # Joint histograms of the whole batch with one bincount
+        joint_index = (np.arange(batch)[:, None] * self.bins + binned) * self.bins + self.binned
+        joint = np.bincount(joint_index.ravel(), minlength=batch * self.bins * self.bins)
+        joint = joint.reshape(batch, self.bins, self.bins) / float(self.count)
+        marginal = joint.sum(axis=2)
+
+        expected = marginal[:, :, None] * self.histogram[None, None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = np.where(joint > 0, joint * np.log(joint / expected), 0.)
+        return terms.sum(axis=(1, 2))
+
+    def evaluate(self, drrs, metrics=METRICS):
+        '''Scores of a batch of DRRs.
+
+        Args:
+            drrs (np.array):    (N, H, W) batch, or a single DRR
+            metrics (list):     Names of the metrics among 'ncc', 'gc' and 'mi'
+
+        Returns:
+            dict:               (N,) scores per metric, higher is more similar
+        '''
+        functions = {'ncc': self.ncc, 'gc': self.gradient_correlation, 'mi': self.mutual_information}
+        unknown = [metric for metric in metrics if metric not in functions]
+        if unknown:
+            raise ValueError('Unknown metrics {}. Use {}.'.format(unknown, list(METRICS)))
+        drrs = as_batch(drrs, self.shape)
+        return dict((metric, functions[metric](drrs)) for metric in metrics)
+
+# TargetImage of the last targets given to compare
+_targets = {}
+_max_targets = 8
+
+def get_target(target, mask=None, bins=32):
+    '''TargetImage of an array, reused while the same target, mask and bins are given.'''
+    digest = hashlib.sha1()
+    for array in (target, mask):
+        if array is not None:
+            array = np.ascontiguousarray(array)
+            digest.update(str((array.dtype.str, array.shape)).encode('utf-8'))
+            digest.update(array.data)
+    key = (digest.hexdigest(), mask is None, bins)
+    if key not in _targets:
+        if len(_targets) >= _max_targets:
+            _targets.pop(next(iter(_targets)))
+        _targets[key] = TargetImage(target, mask, bins)
+    return _targets[key]
+
+def compare(target, drrs, metrics=METRICS, mask=None, bins=32):
+    '''Scores of a batch of DRRs against a target array, see TargetImage.evaluate.'''
+    return get_target(target, mask, bins).evaluate(drrs, metrics)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+'''Fast startup of short-lived DRR workers
+
+ITK wraps its templates lazily: the first use of, e.g.,
+itk.ResampleImageFilter loads the module holding it, and the first DRR
+of a process pays for all the modules of the pipeline. warm_up loads and
+instantiates the templates of the pipeline for the image types of a job
+before its first pose, and reports the time of each:
+
+    ImageType = itk.Image[itk.F,3]
+    timings = startup.warm_up(ImageType, ImageType, backends=['itk'])
+
+VTK (read_image.get_vtk_reader_from_file_name) and scipy
+(dicom_functions.mean_confidence_interval) are only imported when they
+are used, so they do not slow down the import of main_functions. The
+fused output of DRRRenderer does not create the rescale filter, whose
+ITK module is the slowest to load.
+
+measure_startup runs a new interpreter and measures its import time, the
+warm-up and the latency of its first DRR, which is what a batch worker
+pays before producing its first image:
+
+    python startup.py --pixel-type F --backend itk
+    python startup.py --pixel-type F --backend itk --no-warm-up
+'''
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from timeit import default_timer as timer
+
+# Time of the imports, only meaningful when this module is the first to import them (see measure_startup)
+import_seconds = {}
+import_start = timer()
+import itk
+import numpy as np
+import_seconds['itk'] = timer() - import_start
+import_start = timer()
+import main_functions
+import_seconds['main_functions'] = timer() - import_start
+
+def get_pipeline_templates(InputImageType, OutputImageType, backend='itk', output_pixel_type=None, fused=True):
+    '''ITK templates instantiated by a DRRRenderer of these image types.
+
+    Returns:
+        list:   (name, function returning the instantiated template), the templates are only looked up when the function is called
+    '''
+    if fused:
+        pixel_type = itk.template(OutputImageType)[1][0] if output_pixel_type is None else output_pixel_type
+        FinalImageType = lambda: itk.Image[pixel_type,3]
+    else:
+        FinalImageType = lambda: OutputImageType
+    templates = [('CenteredEuler3DTransform', lambda: itk.CenteredEuler3DTransform[itk.D])]
+    if backend == 'itk':
+        templates += [
+            ('RayCastInterpolateImageFunction', lambda: itk.RayCastInterpolateImageFunction[InputImageType,itk.D]),
+            ('ResampleImageFilter', lambda: itk.ResampleImageFilter[InputImageType,OutputImageType]),
+        ]
+    if not fused:
+        templates.append(('RescaleIntensityImageFilter', lambda: itk.RescaleIntensityImageFilter[InputImageType,OutputImageType]))
+    templates += [
+        ('FlipImageFilter', lambda: itk.FlipImageFilter[OutputImageType]),
+        ('Image', FinalImageType),
+        ('ImageFileWriter', lambda: itk.ImageFileWriter[FinalImageType()]),
+    ]
+    return templates
+
+def make_volume(ImageType, size=16):
+    '''Cube of 1000 in air, centered on the origin, of the given image type.'''
+    image = ImageType.New()
+    image.SetRegions([size,size,size])
+    image.Allocate()
+    image.FillBuffer(0)
+    image.SetOrigin([-size/2.]*3)
+    itk.array_view_from_image(image)[size//4:-(size//4),size//4:-(size//4),size//4:-(size//4)] = 1000
+    return image
+
+def make_renderer(inputImage, detector_size=16, backend='itk', OutputImageType=None, **kwargs):
+    '''DRRRenderer of inputImage on a detector covering it.'''
+    ImageType = type(inputImage)
+    OutputImageType = ImageType if OutputImageType is None else OutputImageType
+    size = inputImage.GetLargestPossibleRegion().GetSize()[0]
+    spacing = size*inputImage.GetSpacing()[0]*1.2/detector_size
+    return main_functions.DRRRenderer(inputImage,[0.,0.,1000.],[-detector_size*spacing/2.,-detector_size*spacing/2.,-200.],
+                                      [detector_size,detector_size,1],[spacing,spacing,1.],np.eye(3),0.,ImageType,OutputImageType,
+                                      backend=backend,**kwargs)
+
+def warm_up(InputImageType, OutputImageType, backends=('itk',), output_pixel_type=None, fused=True, render=True):
+    '''Load and instantiate the ITK templates of the DRR pipeline.
+
+    Args:
+        InputImageType (itk.Image):     Type of the volumes of the job
+        OutputImageType (itk.Image):    Type of the DRRs of the job
+        backends (list):                Backends of DRRRenderer used by the job, 'itk' and/or 'numpy'
+        output_pixel_type:              output_pixel_type of DRRRenderer
+        fused (bool):                   fused of DRRRenderer
+        render (bool):                  Also render a small DRR per backend, which runs the pipeline once
+
+    Returns:
+        dict:                           Seconds spent per template ('templates') and per small DRR ('render')
+    '''
+    timings = {'templates': {}, 'render': {}}
+    for backend in backends:
+        for name, get_template in get_pipeline_templates(InputImageType, OutputImageType, backend, output_pixel_type, fused):
+            if name in timings['templates']:
+                continue
+            start = timer()
+            get_template().New()
+            timings['templates'][name] = timer() - start
+    if render:
+        volume = make_volume(InputImageType)
+        for backend in backends:
+            start = timer()
+            make_renderer(volume, backend=backend, OutputImageType=OutputImageType, fused=fused,
+                          output_pixel_type=output_pixel_type).render([0.,0.,0.],[0.,0.,0.])
+            timings['render'][backend] = timer() - start
+    return timings
+
+def run_startup(pixel_type='F', backend='itk', warm=True, size=64, detector_size=64):
+    '''Warm up (optionally) and render a first DRR in this process.
+
+    Returns:
+        dict:   Seconds of the imports ('import'), of the warm-up ('warm_up', None if not warm) and of the first DRR ('first_drr')
+    '''
+    ImageType = itk.Image[getattr(itk,pixel_type),3]
+    result = {'import': dict(import_seconds), 'warm_up': None}
+    if warm:
+        start = timer()
+        result['warm_up_detail'] = warm_up(ImageType, ImageType, [backend])
+        result['warm_up'] = timer() - start
+    volume = make_volume(ImageType, size)
+    start = timer()
+    make_renderer(volume, detector_size, backend).render([0.,0.,0.],[0.,0.,0.])
+    result['first_drr'] = timer() - start
+    return result
+
+def measure_startup(pixel_type='F', backend='itk', warm=True, size=64, detector_size=64):
+    '''Run run_startup in a new interpreter, so that nothing is imported or instantiated yet.
+
+    Returns:
+        dict:   See run_startup, with the wall time of the whole process ('process')
+    '''
+    command = [sys.executable, os.path.abspath(__file__), '--pixel-type', pixel_type, '--backend', backend,
+               '--size', str(size), '--detector-size', str(detector_size)]
+    if not warm:
+        command.append('--no-warm-up')
+    start = timer()
+    output = subprocess.check_output(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+    process = timer() - start
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    result['process'] = process
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the import, warm-up and first DRR latency of a DRR worker.')
+    parser.add_argument('--pixel-type', default='F', help='ITK pixel type of the volume and the DRR, e.g. F, D, SS')
+    parser.add_argument('--backend', default='itk', choices=['itk', 'numpy'])
+    parser.add_argument('--size', type=int, default=64, help='Voxels per axis of the test volume')
+    parser.add_argument('--detector-size', type=int, default=64, help='Pixels per axis of the detector')
+    parser.add_argument('--no-warm-up', dest='warm', action='store_false', help='Render the first DRR without warm-up')
+    args = parser.parse_args(argv)
+    print(json.dumps(run_startup(args.pixel_type, args.backend, args.warm, args.size, args.detector_size), sort_keys=True))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+'''Render a sweep of poses on several cores
+
+The volume is written once to a memory-mapped file (in /dev/shm when
+available) and every worker process attaches to it instead of reading the
+input image again. Each worker builds one DRRRenderer and renders the poses
+it is given. Results are returned in pose order and are identical to the
+serial path.
+'''
+
+import os
+import shutil
+import tempfile
+import json
+import multiprocessing
+import itk
+import numpy as np
+import main_functions
+import volume_cache
+
+def pose_grid(rx_values, ry_values, rz_values, t=[0., 0., 0.]):
+    '''Create a grid of poses.
+
+    The order is the one of the nested loops in script_main.py: rotation
+    in x is the outer loop and rotation in z the inner loop.
+
+    Args:
+        rx_values (list):   Rotations in x (degrees)
+        ry_values (list):   Rotations in y (degrees)
+        rz_values (list):   Rotations in z (degrees)
+        t (list):           Translation used for every pose
+
+    Returns:
+        list:               List of (rot, t) tuples
+    '''
+    poses = []
+    for rx in rx_values:
+        for ry in ry_values:
+            for rz in rz_values:
+                poses.append(([float(rx), float(ry), float(rz)], [float(tt) for tt in t]))
+    return poses
+
+def share_volume(inputImage, directory=None):
+    '''Write an image to a memory-mapped file which workers can attach to.
+
+    An image loaded with volume_cache.load_volume is already backed by a
+    file and is shared as it is.
+
+    Args:
+        inputImage (itk.Image): The volume to share
+        directory (string):     Where to write the file. Defaults to /dev/shm if it exists.
+
+    Returns:
+        dict:                   Handle to pass to attach_volume
+    '''
+    shared_array = getattr(inputImage, 'shared_array', None)
+    if isinstance(shared_array, np.memmap) and shared_array.filename is not None:
+        handle = {
+            'file_name':    shared_array.filename,
+            'directory':    None,               # Not owned by the sweep, release_volume keeps it.
+            'dtype':        shared_array.dtype.str,
+            'shape':        list(shared_array.shape),
+            'origin':       list(inputImage.GetOrigin()),
+            'spacing':      list(inputImage.GetSpacing()),
+            'direction':    itk.array_from_matrix(inputImage.GetDirection()).tolist(),
+            'rescale':      volume_cache.get_volume_rescale(inputImage),
+        }
+        return handle
+
+    if directory is None and os.path.isdir('/dev/shm'):
+        directory = '/dev/shm'
+    directory = tempfile.mkdtemp(prefix='drr_volume_', dir=directory)
+
+    handle = volume_cache.write_raw_volume(inputImage, os.path.join(directory, 'volume.raw'))
+    handle['directory'] = directory
+    with open(os.path.join(directory, 'volume.json'), 'w') as sidecar:
+        json.dump(handle, sidecar)
+    return handle
+
+def attach_volume(handle):
+    '''Wrap a shared volume as an ITK image without copying it.
+
+    The memory map is kept alive as an attribute of the returned image.
+
+    Args:
+        handle (dict):  Handle returned by share_volume
+
+    Returns:
+        itk.Image:      The image viewing the shared memory
+    '''
+    return volume_cache.read_raw_volume(handle)
+
+def release_volume(handle):
+    '''Remove the files created by share_volume.'''
+    if handle['directory'] is not None:
+        shutil.rmtree(handle['directory'], ignore_errors=True)
+
+# State of a worker process, set once by init_worker
+worker_state = {}
+
+def init_worker(handle, geometry, itk_threads):
+    '''Attach to the shared volume and build the renderer of a worker.'''
+    if itk_threads is not None:
+        itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(itk_threads)
+    inputImage = attach_volume(handle)
+    InputImageType = type(inputImage)
+    OutputImageType = itk.Image[itk.ctype(geometry.get('output_pixel_type') or 'float'), 3]
+
+    worker_state['image'] = inputImage
+    worker_state['renderer'] = main_functions.DRRRenderer(
+        inputImage, geometry['focalPoint'], geometry['originOutput'], geometry['sizeOutput'],
+        geometry['spaceOutput'], np.asarray(geometry['directionOutput']), geometry['threshold'],
+        InputImageType, OutputImageType, False, geometry['backend'], precision=geometry.get('precision', 'double'))
+
+def render_task(task):
+    '''Render one pose in a worker. Returns the DRR array or None.'''
+    rot, t, output_filename, return_image = task
+    image = worker_state['renderer'].render(rot, t, output_filename)
+    if return_image:
+        return itk.array_from_image(image)
+    return None
+
+def run_sweep(inputImage, poses, focalPoint, originOutput, sizeOutput, spaceOutput, directionOutput, threshold,
+              output_filenames=None, return_images=True, processes=None, backend='itk',
+              output_pixel_type='float', itk_threads=1, directory=None, precision='double'):
+    '''Render a list of poses with a pool of worker processes.
+
+    With processes=1 the poses are rendered in this process by the same
+    code path, which is useful as a reference.
+
+    Args:
+        inputImage (itk.Image):     3D input volume
+        poses (list):               List of (rot, t) tuples, e.g. from pose_grid
+        focalPoint (list):          Location of the x-ray source (x,y,z)
+        originOutput (list):        Origin of the output image (x,y,z)
+        sizeOutput (list):          Size of the output image (x,y,z)
+        spaceOutput (list):         Spacing of the output image (x,y,z)
+        directionOutput (np.array): Direction matrix of the output image
+        threshold (float):          Only intensities above the threshold are integrated
+        output_filenames (list):    One file name per pose, or None to not write files
+        return_images (bool):       Return the DRR arrays
+        processes (int):            Number of worker processes, defaults to the number of cores
+        backend (string):           'itk' or 'numpy', see main_functions.DRRRenderer
+        output_pixel_type (string): Pixel type of the ray sums before they are rescaled to the DRR. An integer type
+                                    saturates the sums at its maximum, as the ITK resampler does.
+        itk_threads (int):          ITK threads per worker, None keeps the ITK default
+        directory (string):         Where to place the shared volume
+        precision (string):         'double' or 'single', see main_functions.DRRRenderer
+
+    Returns:
+        list:                       The DRR arrays (or None) in pose order
+    '''
+    if output_filenames is None:
+        output_filenames = [None] * len(poses)
+    assert len(output_filenames) == len(poses), 'One output file name is needed per pose'
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    geometry = {
+        'focalPoint':           list(focalPoint),
+        'originOutput':         list(originOutput),
+        'sizeOutput':           [int(s) for s in sizeOutput],
+        'spaceOutput':          list(spaceOutput),
+        'directionOutput':      np.asarray(directionOutput).tolist(),
+        'threshold':            threshold,
+        'backend':              backend,
+        'output_pixel_type':    output_pixel_type,
+        'precision':            precision,
+    }
+    tasks = [(list(rot), list(t), output_filename, return_images)
+             for (rot, t), output_filename in zip(poses, output_filenames)]
+
+    handle = share_volume(inputImage, directory)
+    try:
+        if processes == 1:
+            init_worker(handle, geometry, None)
+            results = [render_task(task) for task in tasks]
+            worker_state.clear()
+        else:
+            pool = multiprocessing.Pool(processes, init_worker, (handle, geometry, itk_threads))
+            try:
+                chunksize = max(1, len(tasks) // (4 * processes))
+                results = pool.map(render_task, tasks, chunksize)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        release_volume(handle)
+    return results
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import os
+import pytest
+import atomic_file
+
+def test_replaces_the_file(tmpdir):
+    file_name = str(tmpdir.join('catalog.json'))
+    atomic_file.write_atomic('old', file_name)
+    atomic_file.write_atomic('new', file_name)
+    with open(file_name) as catalog:
+        assert catalog.read() == 'new'
+    assert os.listdir(str(tmpdir)) == ['catalog.json']
+
+def test_failed_write_keeps_the_file(tmpdir):
+    file_name = str(tmpdir.join('drr.nii.gz'))
+    atomic_file.write_atomic('old', file_name)
+    with pytest.raises(RuntimeError):
+        with atomic_file.atomic_path(file_name) as temporary:
+            assert temporary.endswith('drr.nii.gz')
+            with open(temporary, 'w') as output:
+                output.write('partial')
+            raise RuntimeError('Interrupted')
+    with open(file_name) as drr:
+        assert drr.read() == 'old'
+    assert os.listdir(str(tmpdir)) == ['drr.nii.gz']
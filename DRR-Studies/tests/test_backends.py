@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import itk
+import numpy as np
+import pytest
+import main_functions
+import raycast
+
+FloatImageType = itk.Image[itk.F, 3]
+ShortImageType = itk.Image[itk.SS, 3]
+
+def make_phantom(size=48, value=100., dtype=np.float32):
+    '''Off-center block in air, the border of the volume is empty so that both backends agree exactly.'''
+    array = np.zeros((size, size, size), dtype=dtype)
+    array[12:30, 16:34, 20:40] = value
+    array[30:36, 20:26, 8:20] = 0.5 * value
+    image = itk.image_from_array(array)
+    image.SetOrigin([-size / 2.] * 3)
+    image.SetSpacing([1.] * 3)
+    return image
+
+def render(image, backend, ImageType, skip_empty=True, poses=(([0., 0., 0.], [0., 0., 0.]), ([20., -10., 5.], [3., -2., 8.]))):
+    detector = 48
+    renderer = main_functions.DRRRenderer(image, [0., 0., 1000.], [-detector / 2., -detector / 2., -200.], [detector, detector, 1],
+                                          [1., 1., 1.], np.eye(3), 0., ImageType, ImageType, backend=backend,
+                                          skip_empty=skip_empty)
+    arrays = []
+    for rot, t in poses:
+        renderer.render(rot, t)
+        arrays.append((renderer.get_raycast_array().copy(), itk.array_from_image(renderer.get_output())))
+    return arrays
+
+@pytest.mark.parametrize('ImageType, dtype', [(FloatImageType, np.float32), (ShortImageType, np.int16)])
+def test_numpy_backend_matches_itk(ImageType, dtype):
+    # Rays through the block sum up to about 2e5, beyond the range of SS
+    image = make_phantom(value=10000., dtype=dtype)
+    for (itk_sums, itk_drr), (numpy_sums, numpy_drr) in zip(render(image, 'itk', ImageType), render(image, 'numpy', ImageType)):
+        assert numpy_sums.dtype == itk_sums.dtype
+        if np.issubdtype(itk_sums.dtype, np.integer):
+            assert itk_sums.max() == np.iinfo(itk_sums.dtype).max      # Saturated, not wrapped around
+            assert numpy_sums.min() >= 0
+            assert np.abs(numpy_sums.astype(np.int64) - itk_sums).max() <= 1
+        else:
+            np.testing.assert_allclose(numpy_sums, itk_sums, rtol=1e-5, atol=1e-2)
+        assert np.abs(numpy_drr.astype(np.int64) - itk_drr).max() <= 1
+
+def test_skip_empty_gives_the_same_drr():
+    image = make_phantom()
+    for (skipped_sums, skipped_drr), (full_sums, full_drr) in zip(render(image, 'numpy', FloatImageType, skip_empty=True),
+                                                                  render(image, 'numpy', FloatImageType, skip_empty=False)):
+        assert full_sums.max() > 0
+        np.testing.assert_allclose(skipped_sums, full_sums, rtol=1e-9, atol=1e-6)
+        np.testing.assert_array_equal(skipped_drr, full_drr)
+
+@pytest.mark.parametrize('block_size', [4, 8])
+def test_occupancy_grid_skips_only_zero_samples(block_size):
+    random = np.random.RandomState(0)
+    volume = np.zeros((40, 36, 32))
+    volume[10:20, 5:15, 18:30] = random.uniform(0., 200., (10, 10, 12))
+    volume[30:33, 25:30, 2:6] = 150.
+    threshold = 50.
+    occupancy = raycast.build_occupancy_grid(volume, threshold, block_size)
+    assert occupancy.shape == tuple((size + block_size - 1) // block_size for size in volume.shape)
+    assert 0 < occupancy.sum() < occupancy.size
+    # Rays from random sources to random targets, crossing the volume in every direction
+    origin, spacing = [-16., -18., -20.], [1., 1., 1.]
+    sources = random.uniform(-100., 100., (2000, 3))
+    targets = random.uniform(-15., 15., (2000, 3))
+    full = raycast.cast_rays(volume, origin, spacing, sources, targets, threshold)
+    skipped = raycast.cast_rays(volume, origin, spacing, sources, targets, threshold, occupancy=occupancy, block_size=block_size)
+    assert (full > 0).sum() > 100
+    np.testing.assert_allclose(skipped, full, rtol=1e-12, atol=1e-9)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import numpy as np
+import pytest
+import drr_stack
+
+STORAGES = ['npy', pytest.param('hdf5', marks=pytest.mark.skipif(drr_stack.h5py is None, reason='h5py is not installed'))]
+
+def make_images(count, shape=(6, 8)):
+    return [np.linspace(0., 255., shape[0] * shape[1]).reshape(shape)[::-1] * (ii + 1) / count for ii in range(count)]
+
+@pytest.mark.parametrize('storage', STORAGES)
+@pytest.mark.parametrize('dtype', ['uint8', 'uint16', 'float32'])
+def test_round_trip(tmpdir, storage, dtype):
+    file_name = str(tmpdir.join('drrs'))
+    images = make_images(3)
+    poses = [[0., 5. * ii, 0., 0., 0., 1.] for ii in range(3)]
+    with drr_stack.DRRStackWriter(file_name, (6, 8), 3, dtype, storage, geometry={'threshold': 0.}) as stack:
+        for image, pose in zip(images, poses):
+            stack.append(image, pose, (10., 20.))
+    stack = drr_stack.DRRStack(file_name)
+    assert len(stack) == 3
+    assert stack.geometry == {'threshold': 0.}
+    tolerance = 0.5 if dtype == 'uint8' else 0.01
+    for ii, (image, pose) in enumerate(zip(images, poses)):
+        assert stack.find(pose) == ii
+        assert np.abs(stack.read(ii) - image).max() <= tolerance
+        assert np.abs(stack.read_ray_sums(ii) - (10. + image * 10. / 255.)).max() <= tolerance
+    stack.close()
+
+@pytest.mark.parametrize('storage', STORAGES)
+def test_interrupted_stack_is_incomplete(tmpdir, storage):
+    file_name = str(tmpdir.join('drrs'))
+    with pytest.raises(RuntimeError):
+        with drr_stack.DRRStackWriter(file_name, (6, 8), 3, storage=storage) as stack:
+            stack.append(make_images(1)[0], [0.] * 6)
+            raise RuntimeError('render failed')
+    with open(drr_stack.get_stack_files(file_name, storage)[2]) as sidecar:
+        header = json.load(sidecar)
+    assert header['complete'] is False and header['count'] == 1
+    with pytest.raises(ValueError):
+        drr_stack.DRRStack(file_name)
+    assert [name for name in os.listdir(str(tmpdir)) if name.endswith('.json')] == ['drrs.json']
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import itk
+import numpy as np
+import pyramid
+
+ImageType = itk.Image[itk.F, 3]
+
+def make_phantom(size=64, spacing=1.):
+    '''Off-center cube of 100 in air.'''
+    array = np.zeros((size, size, size), dtype=np.float32)
+    array[20:36, 24:44, 36:52] = 100.
+    image = itk.image_from_array(array)
+    image.SetOrigin([-size * spacing / 2.] * 3)
+    image.SetSpacing([spacing] * 3)
+    return image
+
+def get_centroid(drr, spacing, factor):
+    '''Centroid (x, y) of a [z,y,x] DRR in mm from the first full resolution pixel.'''
+    image = np.asarray(drr, dtype=np.float64)[0]
+    y, x = np.mgrid[:image.shape[0], :image.shape[1]]
+    pixel = factor * spacing
+    offset = 0.5 * (factor - 1) * spacing       # Center of the first pixel of the level
+    total = image.sum()
+    return np.array([(x * image).sum() / total * pixel + offset, (y * image).sum() / total * pixel + offset])
+
+def test_same_projection_at_every_level():
+    detector = 128
+    spacing = 0.75
+    levels = pyramid.DRRPyramid(make_phantom(), [0., 0., 1000.], [-detector * spacing / 2., -detector * spacing / 2., -200.],
+                                [detector, detector, 1], [spacing, spacing, 1.], np.eye(3), 0., ImageType, ImageType,
+                                factors=(8, 4, 1), backend='numpy')
+    for rot, t in [([40., 0., 0.], [0., 0., 0.]), ([0., -30., 15.], [5., -3., 10.])]:
+        centroids = dict((factor, get_centroid(levels.render(rot, t, factor), spacing, factor)) for factor in levels.factors)
+        for factor in (8, 4):
+            # Within the partial volume blurring of the coarse levels, well below their pixel size
+            assert np.abs(centroids[factor] - centroids[1]).max() < 0.25 * factor * spacing
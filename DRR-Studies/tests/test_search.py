@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import json
+import numpy as np
+import search
+
+OPTIMUM = np.array([3.25, -1.5, 0.75, 2., -2.5, 1.25])     # On the grid of the 0.25 step
+
+def make_quadratic(optimum=OPTIMUM, weights=(1., 2., 0.5, 1., 3., 1.)):
+    '''Score with a single maximum at optimum, counting its calls.'''
+    calls = []
+    def score(poses):
+        calls.append(len(poses))
+        return -((poses - optimum) ** 2 * np.asarray(weights)).sum(axis=1)
+    score.calls = calls
+    return score
+
+def test_converges_to_the_optimum(tmpdir):
+    score = make_quadratic()
+    pose_search = search.PoseSearch(score, steps=[4.] * 6, min_step=0.25)
+    assert pose_search.levels == 5          # Steps 4, 2, 1, 0.5 and 0.25
+    pose, best = pose_search.search([0.] * 6)
+    np.testing.assert_allclose(pose, OPTIMUM)
+    assert best == 0.
+    assert pose_search.stop_reason == 'min_step'
+    assert max(entry['level'] for entry in pose_search.log) == 4
+    # Every pose is scored once
+    poses = [tuple(entry['pose']) for entry in pose_search.log]
+    assert len(set(poses)) == len(poses) == sum(score.calls)
+
+    file_name = str(tmpdir.join('search_log.json'))
+    pose_search.write_log(file_name)
+    with open(file_name) as log_file:
+        log = json.load(log_file)
+    assert log['stop_reason'] == 'min_step'
+    assert log['best_pose'] == OPTIMUM.tolist()
+    assert len(log['evaluations']) == len(poses)
+
+def test_respects_the_evaluation_budget():
+    score = make_quadratic()
+    pose_search = search.PoseSearch(score, steps=[4.] * 6, min_step=0.25, max_evaluations=40)
+    pose, best = pose_search.search([0.] * 6)
+    assert pose_search.stop_reason == 'max_evaluations'
+    assert len(pose_search.log) == sum(score.calls) == 40
+    assert best == max(entry['score'] for entry in pose_search.log)
+    assert best > score(np.zeros((1, 6)))[0]
+
+def test_stays_within_the_bounds():
+    bounds = np.array([[-4., 4.]] * 6)
+    bounds[0] = [-1., 1.]                   # Excludes the optimum of rx
+    pose_search = search.PoseSearch(make_quadratic(), steps=[1.] * 6, min_step=0.25, bounds=bounds)
+    pose, _ = pose_search.search([0.] * 6)
+    assert all(np.all((entry['pose'] >= bounds[:, 0]) & (entry['pose'] <= bounds[:, 1])) for entry in pose_search.log)
+    np.testing.assert_allclose(pose, [1.] + OPTIMUM[1:].tolist())
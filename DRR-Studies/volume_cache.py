@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+'''Cache decoded volumes as memory-mapped raw files
+
+Reading a NIfTI, NRRD or DICOM volume decodes (and often decompresses)
+the whole image. load_volume does this once, writes the voxels to a raw
+binary file next to a small JSON sidecar (origin, spacing, direction,
+pixel type) and, on later loads, memory-maps the raw file and wraps it as
+an ITK image without copying it. Pages are only read from disk when they
+are used and are shared by all the processes mapping the same file.
+
+A cache entry is valid while the source path, modification time and size
+are unchanged. For a DICOM directory the size is the total of its files
+and the modification time the latest of its files. DICOM series are
+decoded in parallel by dicom_functions.read_dicom_series and cached under
+their series UID. The UID of a directory is remembered in the cache
+(dicom_series.json) with the names, modification times and sizes of its
+files, so GDCM only parses the directory again when one of them changed. The rescale slope and intercept of a series kept in its
+stored values (stored_values=True) are cached with it.
+'''
+
+import os
+import json
+import hashlib
+import shutil
+import itk
+import numpy as np
+import dicom_functions as dfun
+import atomic_file
+
+# Increase when the layout of the cache changes, older entries are then rebuilt
+CACHE_VERSION = 1
+
+def default_cache_directory():
+    '''Directory of the cache, $DRR_VOLUME_CACHE or ~/.cache/drr_volumes.'''
+    return os.environ.get('DRR_VOLUME_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'drr_volumes'))
+
+def get_source_signature(file_name):
+    '''Identify the version of a source image on disk.
+
+    Args:
+        file_name (string): Image file or DICOM directory
+
+    Returns:
+        dict:               Absolute path, modification time and size
+    '''
+    file_name = os.path.abspath(file_name)
+    if os.path.isdir(file_name):
+        mtime, size = os.path.getmtime(file_name), 0
+        for entry in os.listdir(file_name):
+            path = os.path.join(file_name, entry)
+            if os.path.isfile(path):
+                mtime = max(mtime, os.path.getmtime(path))
+                size += os.path.getsize(path)
+    else:
+        mtime, size = os.path.getmtime(file_name), os.path.getsize(file_name)
+    return {'source': file_name, 'mtime': mtime, 'size': size}
+
+def write_raw_volume(inputImage, raw_file_name):
+    '''Write the voxels of an image to a raw file.
+
+    The voxels start at offset 0 of the file, which is page aligned.
+
+    Args:
+        inputImage (itk.Image):     Image to write
+        raw_file_name (string):     Output raw file name
+
+    Returns:
+        dict:                       Header needed by read_raw_volume
+    '''
+    array = itk.array_view_from_image(inputImage)
+    raw = np.memmap(raw_file_name, dtype=array.dtype, mode='w+', shape=array.shape)
+    raw[:] = array
+    raw.flush()
+    del raw
+
+    return {
+        'file_name':    raw_file_name,
+        'dtype':        array.dtype.str,
+        'shape':        list(array.shape),
+        'origin':       list(inputImage.GetOrigin()),
+        'spacing':      list(inputImage.GetSpacing()),
+        'direction':    itk.array_from_matrix(inputImage.GetDirection()).tolist(),
+        'rescale':      get_volume_rescale(inputImage),
+    }
+
+def get_volume_rescale(inputImage):
+    '''Rescale slope and intercept of the values of an image, [1, 0] unless set by dicom_functions.read_dicom_series.'''
+    return [float(getattr(inputImage, 'rescale_slope', 1.)), float(getattr(inputImage, 'rescale_intercept', 0.))]
+
+def read_raw_volume(header):
+    '''Wrap a raw file as an ITK image without copying it.
+
+    The memory map is read-only and kept alive as the shared_array
+    attribute of the returned image.
+
+    Args:
+        header (dict):  Header returned by write_raw_volume
+
+    Returns:
+        itk.Image:      The image viewing the memory-mapped file
+    '''
+    array = np.memmap(header['file_name'], dtype=np.dtype(header['dtype']), mode='r', shape=tuple(header['shape']))
+    image = itk.image_view_from_array(array)
+    image.SetOrigin(header['origin'])
+    image.SetSpacing(header['spacing'])
+    image.SetDirection(itk.matrix_from_array(np.array(header['direction'], dtype=np.float64)))
+    image.shared_array = array
+    image.rescale_slope, image.rescale_intercept = header.get('rescale', [1., 0.])
+    return image
+
+def get_directory_signature(directory):
+    '''SHA-1 of the sorted names, modification times and sizes of the files of a directory.'''
+    sha = hashlib.sha1()
+    for entry in sorted(os.listdir(directory)):
+        path = os.path.join(directory, entry)
+        if os.path.isfile(path):
+            sha.update('{} {!r} {}\n'.format(entry, os.path.getmtime(path), os.path.getsize(path)).encode('utf-8'))
+    return sha.hexdigest()
+
+def get_series_uid(directory, cache_directory):
+    '''UID of the DICOM series of a directory, parsed by GDCM only if the files of the directory changed.'''
+    directory = os.path.abspath(directory)
+    signature = get_directory_signature(directory)
+    index_file_name = os.path.join(cache_directory, 'dicom_series.json')
+    index = {}
+    if os.path.exists(index_file_name):
+        with open(index_file_name) as index_file:
+            index = json.load(index_file)
+    entry = index.get(directory)
+    if entry is not None and entry['signature'] == signature:
+        return entry['series_uid']
+
+    series_uid = dfun.get_dicom_series(directory)[0]
+    index[directory] = {'signature': signature, 'series_uid': series_uid}
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+    with atomic_file.open_atomic(index_file_name) as index_file:    # Concurrent updates may drop an entry, which is only parsed again
+        json.dump(index, index_file)
+    return series_uid
+
+def get_cache_entry(file_name, cache_directory=None, pixel_type=None, stored_values=False):
+    '''Paths of the raw file and sidecar caching a source image.
+
+    Image files are cached under their absolute path, DICOM directories
+    under the UID of their series.
+
+    Args:
+        file_name (string):         Image file or DICOM directory
+        cache_directory (string):   Cache directory, defaults to default_cache_directory()
+        pixel_type:                 ITK pixel type the source is read as, None for the default
+        stored_values (bool):       Whether a DICOM series is read in its stored values
+
+    Returns:
+        tuple:                      (raw file name, sidecar file name)
+    '''
+    if cache_directory is None:
+        cache_directory = default_cache_directory()
+    if os.path.isdir(file_name):
+        key = 'dicom series ' + get_series_uid(file_name, cache_directory)
+    else:
+        key = os.path.abspath(file_name)
+    if pixel_type is not None:
+        key += ' as ' + str(pixel_type)
+    if stored_values:
+        key += ' stored'
+    key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(cache_directory, key + '.raw'), os.path.join(cache_directory, key + '.json')
+
+def read_source_volume(file_name, verbose=False, pixel_type=None, stored_values=False):
+    '''Decode a source image, reading DICOM series from directories.'''
+    if os.path.isdir(file_name):
+        return dfun.read_dicom_series(file_name, verbose, itk.F if pixel_type is None else pixel_type, stored_values=stored_values)
+    return itk.imread(str(file_name), pixel_type)
+
+def load_volume(file_name, cache_directory=None, verbose=False, pixel_type=None, stored_values=False):
+    '''Load a volume through the cache.
+
+    The first load decodes the source and fills the cache. Later loads
+    memory-map the cached voxels as long as the source is unchanged.
+
+    Args:
+        file_name (string):         Image file (NIfTI, NRRD, ...) or DICOM directory
+        cache_directory (string):   Cache directory, defaults to default_cache_directory()
+        verbose (bool):             Print whether the cache was used
+        pixel_type:                 ITK pixel type to read the source as (e.g. itk.SS to keep
+                                    the int16 values of a CT series). Defaults to the pixel type
+                                    of the file, and to itk.F for DICOM series.
+        stored_values (bool):       Keep a DICOM series in its stored values, with pixel_type itk.SS
+                                    or itk.US (see dicom_functions.read_dicom_series)
+
+    Returns:
+        itk.Image:                  The volume, read-only and backed by the cache file
+    '''
+    raw_file_name, sidecar_file_name = get_cache_entry(file_name, cache_directory, pixel_type, stored_values)
+    signature = get_source_signature(file_name)
+
+    if os.path.exists(sidecar_file_name):
+        with open(sidecar_file_name) as sidecar:
+            header = json.load(sidecar)
+        if header.get('version') == CACHE_VERSION and header.get('signature') == signature and os.path.exists(raw_file_name):
+            if verbose:
+                print('Loading {} from the cache {}'.format(file_name, raw_file_name))
+            return read_raw_volume(header)
+
+    if verbose:
+        print('Decoding {} into the cache {}'.format(file_name, raw_file_name))
+    inputImage = read_source_volume(file_name, verbose, pixel_type, stored_values)
+
+    # The sidecar is written last, an entry is only read once both files are complete
+    directory = os.path.dirname(raw_file_name)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with atomic_file.atomic_path(raw_file_name) as temporary_raw:
+        header = write_raw_volume(inputImage, temporary_raw)
+    header['file_name'] = raw_file_name
+    header['version'] = CACHE_VERSION
+    header['signature'] = signature
+
+    with atomic_file.open_atomic(sidecar_file_name) as sidecar:
+        json.dump(header, sidecar)
+
+    return read_raw_volume(header)
+
+def clear_cache(file_name=None, cache_directory=None, pixel_type=None, stored_values=False):
+    '''Remove the cache entry of file_name, or the whole cache if file_name is None.'''
+    if file_name is None:
+        if cache_directory is None:
+            cache_directory = default_cache_directory()
+        shutil.rmtree(cache_directory, ignore_errors=True)
+        return
+    for path in get_cache_entry(file_name, cache_directory, pixel_type, stored_values):
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+'''Write images in background threads
+
+Rendering and writing a DRR are serialised in the pipeline: the next pose
+only starts when the writer has compressed and written the previous image.
+A WriterQueue takes a copy of the image and hands it to writer threads so
+the next pose can be rendered in the meantime. The queue is bounded, so
+submit blocks when the writers fall behind instead of filling the memory.
+
+Errors do not stop the writers. They are collected per file and returned
+by flush and close.
+'''
+
+import threading
+import itk
+import dicom_functions as dfun
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+def copy_image(image):
+    '''Deep copy of an ITK image, including origin, spacing and direction.
+
+    Args:
+        image (itk.Image):  Image to copy
+
+    Returns:
+        itk.Image:          The copy
+    '''
+    copied = itk.image_from_array(itk.array_from_image(image))
+    copied.CopyInformation(image)
+    return copied
+
+class WriterQueue(object):
+    '''Bounded queue of images drained by writer threads.
+
+    Args:
+        max_pending (int):  Number of images waiting to be written before submit blocks
+        threads (int):      Number of writer threads
+        overwrite (string): Policy for existing files, 'overwrite', 'skip' or 'error' (see dicom_functions.check_output_file)
+        compression (bool): Ask the image IO to compress the files
+        verbose (bool):     Print every written file
+    '''
+    def __init__(self, max_pending=4, threads=1, overwrite='overwrite', compression=False, verbose=False):
+        if overwrite == 'prompt':
+            raise ValueError('The writer threads cannot prompt. Use "overwrite", "skip" or "error".')
+        dfun.check_output_file('', overwrite) # Validate the policy before starting the threads
+
+        self.overwrite   = overwrite
+        self.compression = compression
+        self.verbose     = verbose
+        self.errors      = []
+        self.written     = 0
+        self.closed      = False
+
+        self.queue  = queue.Queue(max_pending)
+        self.lock   = threading.Lock()
+        self.threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self._drain)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, image, output_file_name, copy=True):
+        '''Queue an image to be written. Blocks while the queue is full.
+
+        Args:
+            image (itk.Image):          Image to write
+            output_file_name (string):  Output file name
+            copy (bool):                Write a copy of the image. Needed when the image
+                                        belongs to a pipeline that is updated again, e.g. DRRRenderer.render
+        '''
+        if self.closed:
+            raise RuntimeError('The writer queue is closed.')
+        if copy:
+            image = copy_image(image)
+        self.queue.put((image, str(output_file_name)))
+
+    def _drain(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                image, output_file_name = item
+                try:
+                    if dfun.check_output_file(output_file_name, self.overwrite):
+                        itk.imwrite(image, output_file_name, self.compression)
+                        with self.lock:
+                            self.written += 1
+                        if self.verbose:
+                            print('Image written: {}'.format(output_file_name))
+                except Exception as error:
+                    with self.lock:
+                        self.errors.append((output_file_name, error))
+            finally:
+                self.queue.task_done()
+
+    def _take_errors(self):
+        with self.lock:
+            errors, self.errors = self.errors, []
+        return errors
+
+    def flush(self):
+        '''Wait until every submitted image is written.
+
+        Returns:
+            list:   (output_file_name, exception) of the files that failed since the last flush
+        '''
+        self.queue.join()
+        return self._take_errors()
+
+    def close(self):
+        '''Write the pending images and stop the writer threads.
+
+        Returns:
+            list:   (output_file_name, exception) of the files that failed since the last flush
+        '''
+        if not self.closed:
+            self.closed = True
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+        return self._take_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        errors = self.close()
+        if errors and exc_type is None:
+            raise IOError('Failed to write {} file(s): {}'.format(
+                len(errors), ', '.join('{} ({})'.format(name, error) for name, error in errors)))